@@ -0,0 +1,180 @@
+"""Baseline schema
+
+Creates the tables on an empty database.
+
+Databases created before migrations, with db.create_all(), are brought up to the
+same schema instead: missing tables, columns and indexes are added and backfilled,
+as the old "upgrade-db" command did. Safe on databases that ran "upgrade-db".
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 11:04:47.130848
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+# In the order of their bits in dietary_mask, see DIETARY_TAGS
+DIETARY_TAG_COLUMNS = ["is_vegan", "is_vegetarian", "is_gluten_free",
+                       "is_dairy_free", "is_nut_free", "is_egg_free"]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    tables = set(inspector.get_table_names())
+
+    if "dietary_tags" not in tables:
+        op.create_table('dietary_tags',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('is_vegan', sa.Boolean(), nullable=False),
+        sa.Column('is_vegetarian', sa.Boolean(), nullable=False),
+        sa.Column('is_gluten_free', sa.Boolean(), nullable=False),
+        sa.Column('is_dairy_free', sa.Boolean(), nullable=False),
+        sa.Column('is_nut_free', sa.Boolean(), nullable=False),
+        sa.Column('is_egg_free', sa.Boolean(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+        )
+
+    if "stored_images" not in tables:
+        op.create_table('stored_images',
+        sa.Column('image_url', sa.String(length=300), nullable=False),
+        sa.Column('backend', sa.String(length=20), nullable=False),
+        sa.Column('size', sa.Integer(), nullable=True),
+        sa.Column('checked_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('image_url')
+        )
+
+    if "users" not in tables:
+        op.create_table('users',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('username', sa.String(length=20), nullable=False),
+        sa.Column('password', sa.String(), nullable=False),
+        sa.Column('user_type', sa.String(length=20), nullable=False),
+        sa.Column('must_change_password', sa.Boolean(), server_default=sa.false(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('username')
+        )
+    else:
+        add_missing_column(inspector, 'users', sa.Column(
+            'must_change_password', sa.Boolean(), server_default=sa.false(), nullable=False))
+
+    if "recipes" not in tables:
+        op.create_table('recipes',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('title', sa.String(length=40), nullable=False),
+        sa.Column('desc', sa.String(length=200), nullable=False),
+        sa.Column('ingredients', sa.String(length=500), nullable=False),
+        sa.Column('instructions', sa.String(length=1000), nullable=False),
+        sa.Column('image_url', sa.String(length=300), nullable=True),
+        sa.Column('dietary_tags_id', sa.Integer(), nullable=False),
+        sa.Column('dietary_mask', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['dietary_tags_id'], ['dietary_tags.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+    else:
+        upgrade_recipe_table(inspector, 'recipes')
+
+    if "modified_recipes" not in tables:
+        op.create_table('modified_recipes',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('modified_by_id', sa.Integer(), nullable=False),
+        sa.Column('recipe_id', sa.Integer(), nullable=False),
+        sa.Column('extended_desc', sa.String(length=100), nullable=False),
+        sa.Column('ingredients', sa.String(length=500), nullable=False),
+        sa.Column('instructions', sa.String(length=1000), nullable=False),
+        sa.Column('dietary_tags_id', sa.Integer(), nullable=False),
+        sa.Column('dietary_mask', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['dietary_tags_id'], ['dietary_tags.id'], ),
+        sa.ForeignKeyConstraint(['modified_by_id'], ['users.id'], ),
+        sa.ForeignKeyConstraint(['recipe_id'], ['recipes.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+    else:
+        upgrade_recipe_table(inspector, 'modified_recipes')
+
+    if "saved_recipes" not in tables:
+        op.create_table('saved_recipes',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('recipe_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['recipe_id'], ['recipes.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+    else:
+        # Keep each user's first save of a recipe, so the unique index can be created
+        op.execute("DELETE FROM saved_recipes WHERE id NOT IN "
+                   "(SELECT MIN(id) FROM saved_recipes GROUP BY user_id, recipe_id)")
+
+    create_missing_index(inspector, tables, 'ix_recipes_dietary_mask',
+                         'recipes', ['dietary_mask'])
+    create_missing_index(inspector, tables, 'ix_modified_recipes_dietary_mask',
+                         'modified_recipes', ['dietary_mask'])
+    create_missing_index(inspector, tables, 'ix_saved_recipes_user_id_recipe_id',
+                         'saved_recipes', ['user_id', 'recipe_id'], unique=True)
+
+
+def add_missing_column(inspector, table, column):
+    """Adds a column to an existing table, unless it's already there.
+
+    Returns:
+        bool: True if the column was added.
+    """
+    if column.name in {existing["name"] for existing in inspector.get_columns(table)}:
+        return False
+    with op.batch_alter_table(table, schema=None) as batch_op:
+        batch_op.add_column(column)
+    return True
+
+
+def create_missing_index(inspector, tables, name, table, columns, unique=False):
+    """Creates an index, unless the table existed before and already has it."""
+    if table in tables and name in {
+            index["name"] for index in inspector.get_indexes(table)}:
+        return
+    with op.batch_alter_table(table, schema=None) as batch_op:
+        batch_op.create_index(name, columns, unique=unique)
+
+
+def upgrade_recipe_table(inspector, table):
+    """Adds and backfills the dietary_mask and updated_at columns of an existing recipe table."""
+    if add_missing_column(inspector, table, sa.Column(
+            'dietary_mask', sa.Integer(), server_default='0', nullable=False)):
+        mask = " + ".join(f"CASE WHEN dietary_tags.{column} THEN {1 << bit} ELSE 0 END"
+                          for bit, column in enumerate(DIETARY_TAG_COLUMNS))
+        op.execute(f"UPDATE {table} SET dietary_mask = (SELECT {mask} FROM dietary_tags "
+                   f"WHERE dietary_tags.id = {table}.dietary_tags_id)")
+
+    if add_missing_column(inspector, table, sa.Column('updated_at', sa.DateTime(), nullable=True)):
+        recipes = sa.table(table, sa.column('updated_at', sa.DateTime()))
+        op.execute(recipes.update().values(updated_at=datetime.utcnow()))
+
+
+def downgrade():
+    with op.batch_alter_table('saved_recipes', schema=None) as batch_op:
+        batch_op.drop_index('ix_saved_recipes_user_id_recipe_id')
+
+    op.drop_table('saved_recipes')
+    with op.batch_alter_table('modified_recipes', schema=None) as batch_op:
+        batch_op.drop_index('ix_modified_recipes_dietary_mask')
+
+    op.drop_table('modified_recipes')
+    with op.batch_alter_table('recipes', schema=None) as batch_op:
+        batch_op.drop_index('ix_recipes_dietary_mask')
+
+    op.drop_table('recipes')
+    op.drop_table('users')
+    op.drop_table('stored_images')
+    op.drop_table('dietary_tags')
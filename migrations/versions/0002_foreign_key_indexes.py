@@ -0,0 +1,45 @@
+"""Index the foreign keys
+
+Looking up a user's recipes, the modified versions of a recipe, or who saved it,
+and the cascades when deleting users and recipes, scanned whole tables without these.
+saved_recipes.user_id is already covered by the unique (user_id, recipe_id) index.
+
+On PostgreSQL the indexes are built concurrently, so the tables stay writable.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 11:20:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+FOREIGN_KEY_INDEXES = [
+    ('ix_recipes_user_id', 'recipes', ['user_id']),
+    ('ix_recipes_dietary_tags_id', 'recipes', ['dietary_tags_id']),
+    ('ix_modified_recipes_recipe_id', 'modified_recipes', ['recipe_id']),
+    ('ix_modified_recipes_modified_by_id', 'modified_recipes', ['modified_by_id']),
+    ('ix_modified_recipes_dietary_tags_id', 'modified_recipes', ['dietary_tags_id']),
+    ('ix_saved_recipes_recipe_id', 'saved_recipes', ['recipe_id']),
+]
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns in FOREIGN_KEY_INDEXES:
+            op.create_index(name, table, columns, if_not_exists=True,
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _ in FOREIGN_KEY_INDEXES:
+            op.drop_index(name, table_name=table, if_exists=True,
+                          postgresql_concurrently=True)
@@ -0,0 +1,33 @@
+"""Record bulk import progress
+
+The "import-recipes" command records each import's progress in import_jobs,
+so an interrupted import resumes after the last batch it committed.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 12:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('import_jobs',
+    sa.Column('name', sa.String(length=300), nullable=False),
+    sa.Column('rows_done', sa.Integer(), nullable=False),
+    sa.Column('finished', sa.Boolean(), server_default=sa.false(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('import_jobs')
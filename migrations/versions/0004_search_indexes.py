@@ -0,0 +1,64 @@
+"""Create the full-text search indexes
+
+The "fulltext" search backend needs the FTS5 table recipe_search on SQLite, and GIN
+indexes over tsvector expressions on PostgreSQL. They used to be created by
+db.create_all(), which the migrations replaced, so they're created here instead.
+
+On SQLite the table is filled from the existing recipes. On PostgreSQL the indexes
+are built concurrently, so the tables stay writable. SQLite builds without FTS5
+are skipped, they can use the "trigram" backend.
+
+The DDL comes from myrecipe.search, as the PostgreSQL indexes must use the exact
+expressions the search queries use.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 13:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from myrecipe.search import FTS_TABLE, POSTGRES_INDEXES, SQLITE_FTS_TABLE
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+# Recipes use even rowids and modified recipes odd ones, see get_fts_rowid()
+FILL_FTS_TABLE = [
+    f"INSERT INTO {FTS_TABLE} (rowid, title, description, ingredients, instructions) "
+    "SELECT id * 2, title, \"desc\", ingredients, instructions FROM recipes",
+    f"INSERT INTO {FTS_TABLE} (rowid, title, description, ingredients, instructions) "
+    "SELECT id * 2 + 1, '', extended_desc, ingredients, instructions FROM modified_recipes",
+]
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == "postgresql":
+        # CREATE INDEX CONCURRENTLY can't run inside a transaction
+        with op.get_context().autocommit_block():
+            for statement in POSTGRES_INDEXES:
+                op.execute(statement.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1))
+    elif dialect == "sqlite":
+        try:
+            op.execute(SQLITE_FTS_TABLE)
+        except sa.exc.OperationalError as error:
+            print(f"Skipping the full-text search table, FTS5 isn't available: {error}")
+            return
+        op.execute(f"DELETE FROM {FTS_TABLE}")
+        for statement in FILL_FTS_TABLE:
+            op.execute(statement)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == "postgresql":
+        with op.get_context().autocommit_block():
+            op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_modified_recipes_search")
+            op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_recipes_search")
+    elif dialect == "sqlite":
+        op.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
@@ -14,6 +14,7 @@ from pyexpat import model
 from flask import Flask
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from flask_migrate import Migrate
 from sqlalchemy.orm import DeclarativeBase
 from flask_login import LoginManager
 
@@ -38,11 +39,46 @@ else:
     app.config["SQLALCHEMY_DATABASE_URI"] = URI
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['PACKAGE_NAME'] = PACKAGE_NAME
+# Number of recipe cards shown per page of the homepage feed
+app.config['RECIPES_PER_PAGE'] = int(os.environ.get("RECIPES_PER_PAGE", 24))
+# "ilike" searches titles and descriptions, "fulltext" uses the database's full-text search
+app.config['SEARCH_BACKEND'] = os.environ.get("SEARCH_BACKEND", "ilike")
+# Cache rendered pages for anonymous visitors, up to PAGE_CACHE_MAX_BYTES per worker
+app.config['PAGE_CACHE'] = os.environ.get("PAGE_CACHE") == "True"
+app.config['PAGE_CACHE_MAX_BYTES'] = int(
+    os.environ.get("PAGE_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+# Seconds a cached page is kept for. Other workers only see a change once their copy expires
+app.config['PAGE_CACHE_TTL'] = float(os.environ.get("PAGE_CACHE_TTL", 30))
 
 has_cloudinary_creds = os.environ.get("cloud_name") is not None and os.environ.get(
     "api_key") is not None and os.environ.get("api_secret") is not None
 
 app.config['SAVE_IMAGES_LOCALLY'] = not has_cloudinary_creds
+# Commit recipes with a local placeholder image and upload it to Cloudinary in the background
+app.config['BACKGROUND_IMAGE_UPLOADS'] = os.environ.get("BACKGROUND_IMAGE_UPLOADS") == "True"
+app.config['IMAGE_UPLOAD_WORKERS'] = int(os.environ.get("IMAGE_UPLOAD_WORKERS", 2))
+app.config['IMAGE_UPLOAD_RETRIES'] = int(os.environ.get("IMAGE_UPLOAD_RETRIES", 3))
+# Seconds before the first retry, doubled after each failed attempt
+app.config['IMAGE_UPLOAD_RETRY_DELAY'] = float(os.environ.get("IMAGE_UPLOAD_RETRY_DELAY", 2))
+# "X-Sendfile" or "X-Accel-Redirect" to let a front proxy send locally saved images
+app.config['IMAGE_PROXY_HEADER'] = os.environ.get("IMAGE_PROXY_HEADER", "")
+app.config['IMAGE_ACCEL_REDIRECT_PREFIX'] = os.environ.get(
+    "IMAGE_ACCEL_REDIRECT_PREFIX", "/internal-image-uploads/")
+# bcrypt cost for new password hashes. Existing hashes are upgraded when their user logs in
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get("BCRYPT_LOG_ROUNDS", 12))
+# Threads that hash passwords, 0 to hash on the request thread
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get("PASSWORD_HASH_WORKERS", 0))
+app.config['PASSWORD_HASH_TIMEOUT'] = float(os.environ.get("PASSWORD_HASH_TIMEOUT", 10))
+# Seconds each worker caches logged in users for, 0 to load them from the database every request
+app.config['USER_CACHE_TTL'] = float(os.environ.get("USER_CACHE_TTL", 30))
+# "warn" or "raise" to check each request's SQL statements against its view's query budget
+app.config['QUERY_GUARD'] = os.environ.get("QUERY_GUARD", "")
+# Times a request may run the same statement before it's reported as an N+1 query
+app.config['QUERY_GUARD_REPEAT_LIMIT'] = int(os.environ.get("QUERY_GUARD_REPEAT_LIMIT", 3))
+# Add a Server-Timing header with each request's time spent running SQL statements
+app.config['DB_TIMING'] = os.environ.get("DB_TIMING") == "True"
+# Log SQL statements slower than this many milliseconds, 0 to log none
+app.config['SLOW_QUERY_MS'] = float(os.environ.get("SLOW_QUERY_MS", 0))
 
 
 class Base(DeclarativeBase):
@@ -54,6 +90,16 @@ db = SQLAlchemy(model_class=Base)
 
 db.init_app(app)
 
+
+def include_in_migrations(obj, name, type_, reflected, compare_to):
+    """Leaves tables and indexes that aren't in the models, like the full-text
+    search index, out of autogenerated migrations."""
+    return not (reflected and compare_to is None)
+
+
+# Schema migrations, run with "flask --app myrecipe db upgrade". Batch mode lets SQLite alter tables
+migrate = Migrate(app, db, render_as_batch=True, include_object=include_in_migrations)
+
 bcrypt = Bcrypt(app)
 login_manager = LoginManager(app)
 login_manager.init_app(app)
@@ -69,4 +115,4 @@ class UserType(Enum):
     STANDARD = "STANDARD"
     ADMIN = "ADMIN"
 
-from myrecipe import routes
+from myrecipe import routes, commands, api, timing
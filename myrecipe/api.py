@@ -0,0 +1,223 @@
+"""
+Contains the JSON API for My Recipe.
+
+Version 1 is served under /api/v1. It's read only and public, like the recipe pages.
+
+    GET /api/v1/recipes: One page of recipes and modified recipes, in the homepage feed's order.
+        cursor: The next_cursor of the previous page. Omit for the first page.
+            A malformed cursor is an error, rather than starting again from the first page.
+        limit: Recipes per page. Defaults to RECIPES_PER_PAGE, at most API_MAX_PAGE_SIZE.
+        dietary_tags: Only recipes with all of these tags, e.g. "vv,gf".
+        fields: The fields to include, e.g. "id,title,dietary_tags".
+            Defaults to LIST_FIELDS, which leaves out the ingredients and instructions.
+    GET /api/v1/recipes/<id>: A recipe. Supports fields, defaulting to every field.
+    GET /api/v1/modified-recipes/<id>: A modified recipe. Supports fields too.
+
+Only the columns needed for the requested fields are loaded, and each page is
+serialized from a fixed number of queries, see get_recipe_feed() and hydrate_api_recipes().
+
+Responses have an ETag. A recipe's ETag comes from its updated_at and the host, so a matching
+If-None-Match is answered with 304 Not Modified without loading the recipe.
+Errors are JSON too, e.g. {"error": "Unknown field: foo"}.
+"""
+
+import hashlib
+from flask import jsonify, request, url_for, make_response
+from werkzeug.http import is_resource_modified
+from myrecipe import app, DIETARY_TAGS
+from myrecipe.models import Recipe, ModifiedRecipe
+from myrecipe.helpers import (get_recipe_feed, get_feed_load_option, get_recipe_last_modified,
+                              add_recipe_data_to_modified_recipes, is_feed_cursor,
+                              get_usernames, is_modified_recipe, dietary_tag_data_to_mask)
+from myrecipe.bulk import dietary_mask_to_data
+from myrecipe.queries import query_budget
+
+API_MAX_PAGE_SIZE = 100
+FIELDS = ["id", "type", "url", "title", "desc", "extended_desc", "image_url", "recipe_id",
+          "created_by", "modified_by", "ingredients", "instructions", "dietary_tags",
+          "updated_at"]
+LIST_FIELDS = ["id", "type", "url", "title", "desc", "extended_desc", "image_url",
+               "recipe_id", "created_by", "modified_by", "dietary_tags", "updated_at"]
+# A modified recipe shows its original recipe's title, description and image
+ORIGINAL_RECIPE_FIELDS = {"title", "desc", "image_url", "created_by"}
+
+
+def api_error(message, status):
+    """Returns a JSON error response, e.g. {"error": "Recipe not found."}."""
+    return jsonify(error=message), status
+
+
+def parse_fields(default):
+    """Reads the fields query parameter.
+
+    Args:
+        default (list): The fields to use if none were requested.
+
+    Returns:
+        list: The requested fields, in FIELDS order. Raises ValueError for unknown fields.
+    """
+    requested = {field.strip() for field in request.args.get("fields", "").split(",")
+                 if field.strip()}
+    unknown = requested - set(FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown field: {', '.join(sorted(unknown))}")
+    return [field for field in FIELDS if field in requested] if requested else default
+
+
+def parse_dietary_mask():
+    """Reads the dietary_tags query parameter, e.g. "vv,gf".
+
+    Returns:
+        int: The dietary tags as a bitmask. Raises ValueError for unknown tags.
+    """
+    tags = {tag.strip() for tag in request.args.get("dietary_tags", "").split(",")
+            if tag.strip()}
+    unknown = tags - set(DIETARY_TAGS)
+    if unknown:
+        raise ValueError(f"Unknown dietary tag: {', '.join(sorted(unknown))}")
+    return dietary_tag_data_to_mask(tags)
+
+
+def parse_cursor():
+    """Reads the cursor query parameter.
+
+    Returns:
+        str: The cursor, or None for the first page. Raises ValueError if it's malformed.
+    """
+    cursor = request.args.get("cursor")
+    if cursor and not is_feed_cursor(cursor):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return cursor or None
+
+
+def hydrate_api_recipes(recipes, fields):
+    """Loads what the requested fields need from other tables, in one query each.
+
+    Modified recipes get their original recipe and modifier's username,
+    and every recipe gets its creator's username, but only if those fields were asked for.
+
+    Args:
+        recipes (list): Recipes and modified recipes.
+        fields (list): The requested fields.
+    """
+    modified_recipes = [recipe for recipe in recipes if is_modified_recipe(recipe)]
+    if ORIGINAL_RECIPE_FIELDS & set(fields) or "modified_by" in fields:
+        add_recipe_data_to_modified_recipes(modified_recipes)
+    if "created_by" in fields:
+        usernames = get_usernames({recipe.original_recipe.user_id if is_modified_recipe(recipe)
+                                   else recipe.user_id for recipe in recipes})
+        for recipe in recipes:
+            recipe.created_by = usernames.get(
+                recipe.original_recipe.user_id if is_modified_recipe(recipe)
+                else recipe.user_id)
+
+
+def serialize_recipe(recipe, fields):
+    """Returns dict: The requested fields of a hydrated recipe or modified recipe.
+
+    Fields that don't apply, e.g. extended_desc for a recipe, are null.
+    """
+    modified = is_modified_recipe(recipe)
+    values = {
+        "id": lambda: recipe.id,
+        "type": lambda: "modified" if modified else "recipe",
+        "url": lambda: url_for("api_modified_recipe" if modified else "api_recipe",
+                               recipe_id=recipe.id, _external=True),
+        "title": lambda: recipe.title,
+        "desc": lambda: recipe.desc,
+        "extended_desc": lambda: recipe.extended_desc if modified else None,
+        "image_url": lambda: recipe.image_url,
+        "recipe_id": lambda: recipe.recipe_id if modified else None,
+        "created_by": lambda: recipe.created_by,
+        "modified_by": lambda: recipe.modified_by if modified else None,
+        "ingredients": lambda: recipe.ingredients,
+        "instructions": lambda: recipe.instructions,
+        "dietary_tags": lambda: dietary_mask_to_data(recipe.dietary_mask),
+        "updated_at": lambda: recipe.updated_at.isoformat() if recipe.updated_at else None,
+    }
+    return {field: values[field]() for field in fields}
+
+
+def add_api_cache_headers(response):
+    """Adds an ETag from the response's content and answers 304 if the client has it."""
+    response.add_etag()
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@app.route("/api/v1/recipes", methods=["GET"])
+@query_budget(5)
+def api_recipes():
+    """Returns one page of recipes and modified recipes as JSON.
+
+    Returns:
+        JSON: {"recipes": [...], "next_cursor": "r24"}. next_cursor is null on the last page.
+    """
+    try:
+        cursor = parse_cursor()
+        fields = parse_fields(LIST_FIELDS)
+        dietary_mask = parse_dietary_mask()
+        limit = min(request.args.get("limit", app.config["RECIPES_PER_PAGE"], type=int)
+                    or app.config["RECIPES_PER_PAGE"], API_MAX_PAGE_SIZE)
+    except ValueError as error:
+        return api_error(str(error), 400)
+
+    recipes, next_cursor = get_recipe_feed(cursor, max(limit, 1),
+                                           dietary_mask=dietary_mask, columns=fields)
+    hydrate_api_recipes(recipes, fields)
+    response = jsonify(recipes=[serialize_recipe(recipe, fields) for recipe in recipes],
+                       next_cursor=next_cursor)
+    return add_api_cache_headers(response)
+
+
+def get_api_recipe(recipe_id, get_modified):
+    """Returns a recipe or modified recipe as JSON, or 304 if the client's copy is current.
+
+    Args:
+        recipe_id (int): The ID of the recipe.
+        get_modified (bool): True for a modified recipe.
+    """
+    try:
+        fields = parse_fields(FIELDS)
+    except ValueError as error:
+        return api_error(str(error), 400)
+
+    last_modified = get_recipe_last_modified(recipe_id, get_modified)
+    if last_modified is None:
+        etag = None
+    else:
+        version = f"{'m' if get_modified else 'r'}{recipe_id}:{last_modified.isoformat()}"
+        # The response has absolute URLs, so it differs between hosts
+        etag = hashlib.sha1(f"{version}:{','.join(fields)}:{request.host_url}".encode(
+            "utf-8")).hexdigest()
+
+    if etag is not None and not is_resource_modified(request.environ, etag=etag):
+        response = make_response("", 304)
+    else:
+        model = ModifiedRecipe if get_modified else Recipe
+        recipe = model.query.options(get_feed_load_option(model, fields)).filter(
+            model.id == recipe_id).first()
+        if recipe is None:
+            return api_error("Recipe not found.", 404)
+        hydrate_api_recipes([recipe], fields)
+        response = jsonify(serialize_recipe(recipe, fields))
+
+    if etag is None:
+        return add_api_cache_headers(response)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route("/api/v1/recipes/<int:recipe_id>", methods=["GET"])
+@query_budget(3)
+def api_recipe(recipe_id):
+    """Returns a recipe as JSON."""
+    return get_api_recipe(recipe_id, get_modified=False)
+
+
+@app.route("/api/v1/modified-recipes/<int:recipe_id>", methods=["GET"])
+@query_budget(5)
+def api_modified_recipe(recipe_id):
+    """Returns a modified recipe as JSON."""
+    return get_api_recipe(recipe_id, get_modified=True)
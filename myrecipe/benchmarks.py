@@ -0,0 +1,307 @@
+"""
+Contains the benchmark suite for My Recipe.
+
+seed_data() fills the database with synthetic users, recipes, modified recipes,
+dietary tags and saved recipes. The data comes from a seeded random generator,
+so the same arguments always create the same catalogue.
+
+run_benchmarks() times the hot pages through the Flask test client: the homepage,
+text, tag-only and combined searches, a recipe page, My Recipes, saved recipes and
+logging in. Each page is requested several times and the latency percentiles and
+SQL statements per request are reported.
+
+Used by the "seed-data" and "benchmark" commands. Run them against a scratch
+database, e.g. DB_URL=sqlite:////tmp/myrecipe-benchmark.db, never the live one.
+"""
+
+import math
+import platform
+import random
+import time
+from datetime import datetime
+from sqlalchemy import event, func, select
+from myrecipe import app, db, UserType, DIETARY_TAGS
+from myrecipe.models import User, Recipe, ModifiedRecipe, SavedRecipe
+from myrecipe.passwords import hash_password
+from myrecipe.helpers import create_dietary_tags, dietary_tag_data_to_mask
+
+SEED_USERNAME_PREFIX = "bench"
+SEED_PASSWORD = "bench-password"
+SEED_BATCH_SIZE = 1000
+SEED_DISHES = ["pasta", "soup", "curry", "salad", "pie", "stew", "risotto", "tacos",
+               "pancakes", "bread", "noodles", "chili", "burger", "cake", "omelette"]
+SEED_ADJECTIVES = ["spicy", "creamy", "quick", "classic", "smoky", "zesty", "hearty",
+                   "sweet", "crispy", "rustic", "fresh", "roasted"]
+SEED_INGREDIENTS = ["flour", "eggs", "milk", "butter", "garlic", "onion", "tomatoes",
+                    "rice", "chickpeas", "spinach", "cheese", "basil", "lentils", "peppers"]
+PERCENTILES = [50, 90, 95, 99]
+
+
+def get_seeded_counts():
+    """Returns dict: How many users, recipes, modified recipes and saves are in the database."""
+    return {"users": db.session.scalar(select(func.count()).select_from(User)),
+            "recipes": db.session.scalar(select(func.count()).select_from(Recipe)),
+            "modified_recipes": db.session.scalar(
+                select(func.count()).select_from(ModifiedRecipe)),
+            "saved_recipes": db.session.scalar(
+                select(func.count()).select_from(SavedRecipe))}
+
+
+def create_seed_users(count):
+    """Adds the benchmark users that don't exist yet, all with SEED_PASSWORD.
+
+    The password is hashed once and shared, as hashing is slow on purpose.
+
+    Returns:
+        list: The IDs of all the benchmark users.
+    """
+    existing = set(db.session.scalars(select(User.username).where(
+        User.username.like(f"{SEED_USERNAME_PREFIX}%"))))
+    password = hash_password(SEED_PASSWORD)
+    db.session.add_all(User(username=f"{SEED_USERNAME_PREFIX}{number}", password=password,
+                            user_type=UserType.STANDARD.value)
+                       for number in range(1, count + 1)
+                       if f"{SEED_USERNAME_PREFIX}{number}" not in existing)
+    db.session.commit()
+    return list(db.session.scalars(select(User.id).where(
+        User.username.like(f"{SEED_USERNAME_PREFIX}%")).order_by(User.id)))
+
+
+def create_seed_recipe_fields(rng):
+    """Returns dict: The text and dietary tags of a random recipe."""
+    dish = rng.choice(SEED_DISHES)
+    ingredients = rng.sample(SEED_INGREDIENTS, rng.randint(3, 8))
+    return {"title": f"{rng.choice(SEED_ADJECTIVES).title()} {dish}",
+            "desc": f"A {rng.choice(SEED_ADJECTIVES)} {dish} for any day of the week.",
+            "ingredients": "\n".join(f"{rng.randint(1, 500)}g {name}" for name in ingredients),
+            "instructions": " ".join(f"Add the {name} and stir well." for name in ingredients)
+            * rng.randint(1, 4),
+            "dietary_tags": [tag for tag in DIETARY_TAGS if rng.random() < 0.3]}
+
+
+def seed_data(recipes, users=None, modified_recipes=None, saves_per_user=10, seed=0):
+    """Adds synthetic data to the database, until it has the given number of recipes.
+
+    Safe to call again with larger numbers, it only adds what's missing.
+    Rows are inserted in batches of SEED_BATCH_SIZE, one commit each.
+
+    Args:
+        recipes (int): How many recipes the database should have.
+        users (int): How many benchmark users to create. Defaults to one per 10 recipes.
+        modified_recipes (int): How many modified recipes the database should have.
+            Defaults to one per 5 recipes.
+        saves_per_user (int): How many recipes each new benchmark user saves.
+        seed (int): The random seed.
+
+    Returns:
+        dict: The counts of each kind of row in the database afterwards.
+    """
+    rng = random.Random(seed)
+    users = users or max(1, recipes // 10)
+    modified_recipes = recipes // 5 if modified_recipes is None else modified_recipes
+    user_ids = create_seed_users(users)
+    counts = get_seeded_counts()
+
+    def add_in_batches(count, create):
+        for start in range(0, count, SEED_BATCH_SIZE):
+            db.session.add_all(create() for _ in range(min(SEED_BATCH_SIZE, count - start)))
+            db.session.commit()
+
+    def create_recipe():
+        fields = create_seed_recipe_fields(rng)
+        return Recipe(user_id=rng.choice(user_ids), title=fields["title"],
+                      desc=fields["desc"], ingredients=fields["ingredients"],
+                      instructions=fields["instructions"],
+                      dietary_tags=create_dietary_tags(fields["dietary_tags"]),
+                      dietary_mask=dietary_tag_data_to_mask(fields["dietary_tags"]))
+
+    add_in_batches(recipes - counts["recipes"], create_recipe)
+    recipe_ids = list(db.session.scalars(select(Recipe.id).order_by(Recipe.id)))
+
+    def create_modified_recipe():
+        fields = create_seed_recipe_fields(rng)
+        return ModifiedRecipe(modified_by_id=rng.choice(user_ids),
+                              recipe_id=rng.choice(recipe_ids),
+                              extended_desc=f"With more {rng.choice(SEED_INGREDIENTS)}",
+                              ingredients=fields["ingredients"],
+                              instructions=fields["instructions"],
+                              dietary_tags=create_dietary_tags(fields["dietary_tags"]),
+                              dietary_mask=dietary_tag_data_to_mask(fields["dietary_tags"]))
+
+    if recipe_ids:
+        add_in_batches(modified_recipes - counts["modified_recipes"], create_modified_recipe)
+
+        # Only users who haven't saved anything yet, so reseeding doesn't duplicate saves
+        savers = set(user_ids) - set(db.session.scalars(select(SavedRecipe.user_id).where(
+            SavedRecipe.user_id.in_(user_ids)).distinct()))
+        saves = [SavedRecipe(user_id=user_id, recipe_id=recipe_id)
+                 for user_id in sorted(savers)
+                 for recipe_id in rng.sample(recipe_ids, min(saves_per_user, len(recipe_ids)))]
+        for start in range(0, len(saves), SEED_BATCH_SIZE):
+            db.session.add_all(saves[start:start + SEED_BATCH_SIZE])
+            db.session.commit()
+    return get_seeded_counts()
+
+
+def get_percentile(sorted_values, percentile):
+    """Returns the percentile of sorted values, by the nearest-rank method."""
+    rank = max(1, math.ceil(percentile / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize_timings(timings, statements):
+    """Summarizes the timings and statement counts of a benchmark's requests.
+
+    Args:
+        timings (list): The latency of each request, in seconds.
+        statements (list): The number of SQL statements of each request.
+
+    Returns:
+        dict: The latency percentiles, mean and max in milliseconds,
+            and the mean and max SQL statements per request.
+    """
+    timings = sorted(timings)
+    summary = {"requests": len(timings)}
+    for percentile in PERCENTILES:
+        summary[f"p{percentile}_ms"] = round(get_percentile(timings, percentile) * 1000, 3)
+    summary["mean_ms"] = round(sum(timings) / len(timings) * 1000, 3)
+    summary["max_ms"] = round(timings[-1] * 1000, 3)
+    summary["sql_mean"] = round(sum(statements) / len(statements), 2)
+    summary["sql_max"] = max(statements)
+    return summary
+
+
+def get_benchmark_requests():
+    """Returns the benchmarked requests.
+
+    Returns:
+        dict: (method, URL, form data, client) keyed by benchmark name. The client is
+            "anonymous", "user" for a logged in benchmark user, or "new" for a new
+            anonymous client for every request.
+    """
+    recipe_id = db.session.scalar(select(func.min(Recipe.id))) or 1
+    login = {"username": f"{SEED_USERNAME_PREFIX}1", "password": SEED_PASSWORD}
+    return {
+        "home": ("GET", "/", None, "anonymous"),
+        "search_text": ("GET", "/search?search_bar=pasta", None, "anonymous"),
+        "search_tags": ("GET", "/search?search_bar=&dietary_tags=vv", None, "anonymous"),
+        "search_combined": ("GET", "/search?search_bar=soup&dietary_tags=gf", None,
+                            "anonymous"),
+        "view_recipe": ("GET", f"/recipe/{recipe_id}", None, "anonymous"),
+        "my_recipes": ("GET", "/my-recipes", None, "user"),
+        "view_saved_recipes": ("GET", "/view-saved-recipes", None, "user"),
+        # A new client each time, so every request does a full login
+        "login": ("POST", "/login", login, "new"),
+    }
+
+
+def run_benchmark(method, url, data, client_type, repeat):
+    """Times one request, repeated, through the Flask test client.
+
+    Args:
+        method (str): The HTTP method.
+        url (str): The URL to request.
+        data (dict): The form data to send, if any.
+        client_type (str): The client to send it with, see get_benchmark_requests().
+        repeat (int): How many times to time the request.
+
+    Returns:
+        dict: The summary of the timings, see summarize_timings().
+    """
+    statements = [0]
+
+    def count_statement(*args):
+        statements[0] += 1
+
+    client = app.test_client()
+    if client_type == "user":
+        with app.app_context():
+            client.post("/login", data={"username": f"{SEED_USERNAME_PREFIX}1",
+                                        "password": SEED_PASSWORD})
+    timings, counts, errors = [], [], 0
+    event.listen(db.engine, "before_cursor_execute", count_statement)
+    try:
+        # The first request warms up caches and isn't counted
+        for attempt in range(repeat + 1):
+            if client_type == "new":
+                client = app.test_client()
+            statements[0] = 0
+            # A request reuses the app context already pushed, e.g. by the CLI,
+            # so push a new one to give it its own "g" and database session
+            with app.app_context():
+                start = time.perf_counter()
+                response = client.open(url, method=method, data=data)
+                elapsed = time.perf_counter() - start
+            if response.status_code >= 400:
+                errors += 1
+            if attempt:
+                timings.append(elapsed)
+                counts.append(statements[0])
+    finally:
+        event.remove(db.engine, "before_cursor_execute", count_statement)
+
+    summary = summarize_timings(timings, counts)
+    summary["errors"] = errors
+    return summary
+
+
+def run_benchmarks(sizes, repeat=20, names=None, report=print):
+    """Seeds the database up to each catalogue size and benchmarks the pages at it.
+
+    CSRF protection is turned off while the benchmarks run, so the test client can log in.
+
+    Args:
+        sizes (list): The numbers of recipes to benchmark at, smallest first.
+        repeat (int): How many times to time each request.
+        names (list): The benchmarks to run. Defaults to all of them.
+        report (callable): Called with a progress message as each size finishes seeding.
+
+    Returns:
+        dict: The results, ready to be saved as JSON.
+    """
+    results = {"created_at": datetime.utcnow().isoformat(),
+               "database": db.engine.dialect.name,
+               "python": platform.python_version(),
+               "config": {name: app.config[name] for name in
+                          ["SEARCH_BACKEND", "PAGE_CACHE", "RECIPES_PER_PAGE",
+                           "BCRYPT_LOG_ROUNDS", "USER_CACHE_TTL"]},
+               "repeat": repeat,
+               "runs": []}
+    csrf_enabled = app.config.get("WTF_CSRF_ENABLED", True)
+    app.config["WTF_CSRF_ENABLED"] = False
+    try:
+        for size in sorted(sizes):
+            start = time.perf_counter()
+            counts = seed_data(size)
+            report(f"Seeded {size} recipes in {time.perf_counter() - start:.1f}s.")
+            benchmarks = {}
+            for name, (method, url, data, client_type) in get_benchmark_requests().items():
+                if names and name not in names:
+                    continue
+                benchmarks[name] = run_benchmark(method, url, data, client_type, repeat)
+            results["runs"].append({"size": size, "counts": counts, "benchmarks": benchmarks})
+    finally:
+        app.config["WTF_CSRF_ENABLED"] = csrf_enabled
+    return results
+
+
+def compare_results(results, previous):
+    """Compares the median latency of two benchmark results.
+
+    Args:
+        results (dict): The new results.
+        previous (dict): The results to compare against.
+
+    Returns:
+        list: (size, benchmark name, previous p50, new p50, change in percent) tuples,
+            for each benchmark at each size both results have.
+    """
+    previous_runs = {run["size"]: run["benchmarks"] for run in previous.get("runs", [])}
+    changes = []
+    for run in results["runs"]:
+        for name, summary in run["benchmarks"].items():
+            before = previous_runs.get(run["size"], {}).get(name)
+            if before and before["p50_ms"]:
+                change = (summary["p50_ms"] - before["p50_ms"]) / before["p50_ms"] * 100
+                changes.append((run["size"], name, before["p50_ms"], summary["p50_ms"], change))
+    return changes
@@ -0,0 +1,353 @@
+"""
+Contains the bulk import and export of recipes for My Recipe.
+
+Used by the "import-recipes" command to bring in recipes from another system.
+
+Rows are streamed from a JSON Lines or CSV file and validated with the same forms
+as the add recipe pages. Valid rows are inserted in batches, one commit per batch,
+so only one batch is held in memory however large the file is.
+
+Each import's progress is recorded in the import_jobs table, in the same commit as
+each batch. An interrupted import resumes after the last batch it committed.
+
+Each row is a recipe or a modified recipe, with the fields:
+    type: "recipe" (the default) or "modified".
+    username: The user who created the recipe. They must already exist.
+    title, desc: Recipes only.
+    image_url: Recipes only, optional. Stored as is, the image isn't copied.
+    recipe_id, extended_desc: Modified recipes only. recipe_id is the original recipe's ID.
+    ingredients, instructions: Both.
+    dietary_tags: Optional. A list of tag values, e.g. ["vv", "gf"],
+        or in CSV a comma separated string, e.g. "vv,gf".
+
+export_recipes() streams every recipe and modified recipe out in the same format,
+with their IDs, when they were last updated and how many users saved them added.
+Rows are fetched from the database a batch at a time, with a server-side cursor
+on PostgreSQL, and written out as each batch arrives. Used by the "export-recipes"
+command and the /export/recipes.<format> page.
+"""
+
+import csv
+import io
+import json
+import os
+import time
+from datetime import datetime
+from sqlalchemy import func, select
+from werkzeug.datastructures import MultiDict
+from myrecipe import app, db, DIETARY_TAGS
+from myrecipe.models import User, Recipe, ModifiedRecipe, SavedRecipe, ImportJob
+from myrecipe.forms import AddRecipeForm, AddModifiedRecipeForm
+from myrecipe.helpers import create_dietary_tags, dietary_tag_data_to_mask
+
+IMPORT_FORMATS = {".jsonl": "jsonl", ".ndjson": "jsonl", ".csv": "csv"}
+ROW_FORMS = {"recipe": AddRecipeForm, "modified": AddModifiedRecipeForm}
+# The text fields of each form, read from the row
+ROW_FIELDS = {"recipe": ["title", "desc", "ingredients", "instructions"],
+              "modified": ["extended_desc", "ingredients", "instructions"]}
+EXPORT_FIELDS = ["type", "id", "username", "title", "desc", "image_url", "recipe_id",
+                 "extended_desc", "ingredients", "instructions", "dietary_tags",
+                 "saved_count", "updated_at"]
+EXPORT_MIMETYPES = {"jsonl": "application/x-ndjson", "csv": "text/csv"}
+# Rows fetched from the database, and written out, at a time
+EXPORT_BATCH_SIZE = 1000
+
+
+def get_import_format(path):
+    """Returns the format of an import file from its extension, "jsonl" or "csv", or None."""
+    return IMPORT_FORMATS.get(os.path.splitext(path)[1].lower())
+
+
+def read_rows(file, file_format):
+    """Reads the rows of an import file one at a time.
+
+    Args:
+        file (file): The open import file.
+        file_format (str): "jsonl" or "csv".
+
+    Yields:
+        tuple: (row number, row dict, error). The row is None if it couldn't be parsed.
+    """
+    if file_format == "csv":
+        for number, row in enumerate(csv.DictReader(file), 1):
+            yield number, row, None
+        return
+
+    number = 0
+    for line in file:
+        if not line.strip():
+            continue
+        number += 1
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            yield number, None, f"Invalid JSON: {error}"
+            continue
+        if isinstance(row, dict):
+            yield number, row, None
+        else:
+            yield number, None, "Expected a JSON object."
+
+
+def get_row_dietary_tags(row):
+    """Returns list: The dietary tag values of a row, from a list or a comma separated string."""
+    tags = row.get("dietary_tags") or []
+    if isinstance(tags, str):
+        tags = tags.split(",")
+    return [str(tag).strip() for tag in tags if str(tag).strip()]
+
+
+def validate_row(row):
+    """Validates a row with the form for its type of recipe.
+
+    Must be called within a request context, as the forms need one.
+
+    Args:
+        row (dict): The row from the import file.
+
+    Returns:
+        tuple: (fields, error). fields has the validated column values and the
+            row's type and username, or is None if the row is invalid.
+    """
+    row_type = row.get("type") or "recipe"
+    if row_type not in ROW_FORMS:
+        return None, f'Unknown type "{row_type}", expected "recipe" or "modified".'
+    username = str(row.get("username") or "").strip()
+    if not username:
+        return None, "username is required."
+
+    formdata = MultiDict((name, str(row[name])) for name in ROW_FIELDS[row_type]
+                         if row.get(name) is not None)
+    dietary_tags = get_row_dietary_tags(row)
+    for tag in dietary_tags:
+        formdata.add("dietary_tags", tag)
+
+    form = ROW_FORMS[row_type](formdata=formdata, meta={"csrf": False})
+    if not form.validate():
+        return None, "; ".join(f"{name}: {' '.join(messages)}"
+                               for name, messages in form.errors.items())
+
+    fields = {"type": row_type,
+              "username": username,
+              "ingredients": form.ingredients.data.strip(),
+              "instructions": form.instructions.data.strip(),
+              "dietary_tags": dietary_tags}
+    if row_type == "recipe":
+        image_url = str(row.get("image_url") or "").strip() or None
+        if image_url and len(image_url) > 300:
+            return None, "image_url: Field cannot be longer than 300 characters."
+        fields.update(title=form.title.data, desc=form.desc.data, image_url=image_url)
+    else:
+        try:
+            fields["recipe_id"] = int(row.get("recipe_id"))
+        except (TypeError, ValueError):
+            return None, "recipe_id: A recipe ID is required."
+        fields["extended_desc"] = form.extended_desc.data
+    return fields, None
+
+
+def create_recipe_from_fields(fields, user_id):
+    """Creates a Recipe or ModifiedRecipe, with its dietary tags, from validated fields.
+
+    Returns:
+        Recipe or ModifiedRecipe: The new recipe, not yet added to the session.
+    """
+    common = {"ingredients": fields["ingredients"],
+              "instructions": fields["instructions"],
+              "dietary_tags": create_dietary_tags(fields["dietary_tags"]),
+              "dietary_mask": dietary_tag_data_to_mask(fields["dietary_tags"])}
+    if fields["type"] == "recipe":
+        return Recipe(user_id=user_id, title=fields["title"], desc=fields["desc"],
+                      image_url=fields["image_url"], **common)
+    return ModifiedRecipe(modified_by_id=user_id, recipe_id=fields["recipe_id"],
+                          extended_desc=fields["extended_desc"], **common)
+
+
+def commit_import_batch(job, batch, rows_done, report):
+    """Inserts a batch of validated rows and records the job's progress, in one commit.
+
+    The batch's users and original recipes are looked up in one query each.
+    Rows with a user or original recipe that doesn't exist are skipped.
+
+    Args:
+        job (ImportJob): The import job.
+        batch (list): (row number, fields) tuples of validated rows.
+        rows_done (int): The number of the last row in the batch, including skipped rows.
+        report (callable): Called with a message for each skipped row.
+
+    Returns:
+        int: The number of recipes inserted.
+    """
+    usernames = {fields["username"] for _, fields in batch}
+    user_ids = dict(db.session.execute(
+        select(User.username, User.id).where(User.username.in_(usernames))).all()
+    ) if usernames else {}
+    recipe_ids = {fields["recipe_id"] for _, fields in batch if fields["type"] == "modified"}
+    existing_recipe_ids = set(db.session.scalars(
+        select(Recipe.id).where(Recipe.id.in_(recipe_ids)))) if recipe_ids else set()
+
+    recipes = []
+    for number, fields in batch:
+        if fields["username"] not in user_ids:
+            report(f"Row {number}: username: User does not exist: {fields['username']}")
+        elif fields["type"] == "modified" and fields["recipe_id"] not in existing_recipe_ids:
+            report(f"Row {number}: recipe_id: Recipe does not exist: {fields['recipe_id']}")
+        else:
+            recipes.append(create_recipe_from_fields(fields, user_ids[fields["username"]]))
+
+    # Inserted with multi-row INSERTs, the dietary tags first then the recipes
+    db.session.add_all(recipes)
+    job.rows_done = rows_done
+    job.updated_at = datetime.utcnow()
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(recipes)
+
+
+def import_recipes(path, file_format=None, batch_size=500, job_name=None,
+                   restart=False, report=print):
+    """Imports recipes and modified recipes from a JSON Lines or CSV file.
+
+    Invalid rows are reported and skipped. If the import was interrupted before,
+    it resumes after the last batch that was committed.
+
+    Args:
+        path (str): The path of the import file.
+        file_format (str): "jsonl" or "csv". Defaults to the file's extension.
+        batch_size (int): How many rows to insert per commit.
+        job_name (str): The name the import's progress is recorded under.
+            Defaults to the file's name.
+        restart (bool): Start from the first row, even if the file was imported before.
+        report (callable): Called with the progress and skipped row messages.
+
+    Returns:
+        dict: The counts of "rows" read, "imported" and "skipped" rows in this run,
+            "resumed_after" the rows done by previous runs, and the "seconds" taken.
+            None if the file has already been imported and restart isn't set.
+    """
+    file_format = file_format or get_import_format(path)
+    job_name = job_name or os.path.basename(path)
+    job = db.session.get(ImportJob, job_name)
+    if job is None:
+        job = ImportJob(name=job_name, rows_done=0)
+        db.session.add(job)
+    elif job.finished and not restart:
+        return None
+    if restart:
+        job.rows_done = 0
+    job.finished = False
+
+    stats = {"rows": 0, "imported": 0, "skipped": 0,
+             "resumed_after": job.rows_done, "seconds": 0}
+    start = time.perf_counter()
+    batch = []
+    number = job.rows_done
+
+    with app.test_request_context(), open(path, newline="", encoding="utf-8") as file:
+        for number, row, error in read_rows(file, file_format):
+            if number <= stats["resumed_after"]:
+                continue
+            stats["rows"] += 1
+            fields, error = validate_row(row) if error is None else (None, error)
+            if error:
+                report(f"Row {number}: {error}")
+            else:
+                batch.append((number, fields))
+
+            if stats["rows"] % batch_size == 0:
+                stats["imported"] += commit_import_batch(job, batch, number, report)
+                batch = []
+                rate = stats["rows"] / (time.perf_counter() - start)
+                report(f"Committed rows up to {number}: {stats['imported']} imported "
+                       f"({rate:.0f} rows/sec).")
+
+    job.finished = True
+    stats["imported"] += commit_import_batch(job, batch, number, report)
+    stats["skipped"] = stats["rows"] - stats["imported"]
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+
+
+def dietary_mask_to_data(dietary_mask):
+    """Converts a dietary tags bitmask back into dietary tag data, e.g. 18 -> ["v", "nf"]."""
+    return [tag for index, tag in enumerate(DIETARY_TAGS) if dietary_mask & (1 << index)]
+
+
+def get_export_queries():
+    """Returns the queries for the exported recipes and modified recipes.
+
+    They select plain columns, not models, so the rows aren't kept in the session.
+    """
+    saved_counts = (select(SavedRecipe.recipe_id, func.count().label("saved_count"))
+                    .group_by(SavedRecipe.recipe_id).subquery())
+    recipes = (select(Recipe.id, User.username, Recipe.title, Recipe.desc, Recipe.image_url,
+                      Recipe.ingredients, Recipe.instructions, Recipe.dietary_mask,
+                      func.coalesce(saved_counts.c.saved_count, 0).label("saved_count"),
+                      Recipe.updated_at)
+               .join(User, Recipe.user_id == User.id)
+               .outerjoin(saved_counts, saved_counts.c.recipe_id == Recipe.id)
+               .order_by(Recipe.id))
+    modified_recipes = (select(ModifiedRecipe.id, User.username, ModifiedRecipe.recipe_id,
+                               ModifiedRecipe.extended_desc, ModifiedRecipe.ingredients,
+                               ModifiedRecipe.instructions, ModifiedRecipe.dietary_mask,
+                               ModifiedRecipe.updated_at)
+                        .join(User, ModifiedRecipe.modified_by_id == User.id)
+                        .order_by(ModifiedRecipe.id))
+    return [("recipe", recipes), ("modified", modified_recipes)]
+
+
+def get_export_rows():
+    """Fetches the exported rows from the database, a batch at a time.
+
+    With yield_per, PostgreSQL streams the rows through a server-side cursor,
+    so only one batch is in memory at a time.
+
+    Yields:
+        list: A batch of rows, as dicts with the EXPORT_FIELDS they have.
+    """
+    for row_type, query in get_export_queries():
+        result = db.session.execute(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        for partition in result.mappings().partitions():
+            rows = []
+            for row in partition:
+                row = dict(row, type=row_type,
+                           dietary_tags=dietary_mask_to_data(row["dietary_mask"]))
+                if row["updated_at"] is not None:
+                    row["updated_at"] = row["updated_at"].isoformat()
+                rows.append({field: row[field] for field in EXPORT_FIELDS if field in row})
+            yield rows
+
+
+def export_recipes(file_format):
+    """Exports every recipe and modified recipe as JSON Lines or CSV.
+
+    The export can be imported again with import_recipes(). Each row's ID is
+    included, but the import gives the recipes new IDs.
+
+    Args:
+        file_format (str): "jsonl" or "csv".
+
+    Yields:
+        str: The export, a batch of rows at a time, starting with the header for CSV.
+    """
+    if file_format == "csv":
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, EXPORT_FIELDS)
+        writer.writeheader()
+        for rows in get_export_rows():
+            for row in rows:
+                row["dietary_tags"] = ",".join(row["dietary_tags"])
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        # The header is still in the buffer if there were no rows
+        if buffer.getvalue():
+            yield buffer.getvalue()
+        return
+
+    for rows in get_export_rows():
+        yield "".join(json.dumps(row) + "\n" for row in rows)
@@ -0,0 +1,389 @@
+"""
+Contains the page caching for My Recipe.
+
+Recipe pages support conditional GET requests. They send an ETag and Last-Modified
+based on the recipe's updated_at, and answer a matching If-None-Match or
+If-Modified-Since with 304 Not Modified, without loading or rendering the recipe.
+
+Anonymous visitors all see the same homepage and recipe pages, so the rendered HTML is
+cached in memory and reused until a commit changes a recipe on that page.
+
+Each cached page is tagged with what it shows, e.g. "feed" or "recipe:5".
+Mapper events collect the tags of the recipes changed in a session,
+and the pages with those tags are removed once the session commits.
+
+The cache is per worker, least recently used pages are evicted first,
+and the total size of the cached pages is capped at PAGE_CACHE_MAX_BYTES.
+Only the worker that commits a change invalidates its pages, so cached pages also
+expire after PAGE_CACHE_TTL seconds. Other workers show the change once theirs expire.
+
+Logged in users are loaded on every request, so each worker also caches their rows
+for USER_CACHE_TTL seconds. A user's entry is removed as soon as a commit changes them,
+e.g. their password or role. Other workers see the change once their entry expires.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import g, make_response, request, session
+from flask_login import current_user
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session, make_transient_to_detached
+from werkzeug.http import is_resource_modified
+from myrecipe import app, db
+from myrecipe.models import User, Recipe, ModifiedRecipe
+from myrecipe.helpers import get_recipe_last_modified, has_user_saved_recipe
+
+
+class PageCache:
+    """A thread-safe LRU cache of rendered pages, capped by total size in bytes,
+    whose pages expire after a time to live.
+
+    Attributes:
+        max_bytes (int): The most bytes of pages to keep cached.
+        ttl (float): Seconds a page is kept for.
+        size (int): The bytes of pages currently cached.
+        hits (int): Number of pages served from the cache.
+        misses (int): Number of pages that had to be rendered.
+        evictions (int): Number of pages evicted to stay under max_bytes.
+        invalidations (int): Number of pages removed because their recipes changed.
+        expirations (int): Number of pages removed because they expired.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.pages = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """Returns the cached page body, or None if it isn't cached.
+
+        Args:
+            key (str): The page's cache key.
+        """
+        with self.lock:
+            page = self.pages.get(key)
+            if page is not None and page[2] < time.monotonic():
+                self.discard(key)
+                self.expirations += 1
+                page = None
+            if page is None:
+                self.misses += 1
+                return None
+            self.pages.move_to_end(key)
+            self.hits += 1
+            return page[0]
+
+    def set(self, key, body, tags):
+        """Caches a page, evicting the least recently used pages if needed.
+
+        Args:
+            key (str): The page's cache key.
+            body (bytes): The rendered page.
+            tags (set): The tags of what's shown on the page.
+        """
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            self.discard(key)
+            self.pages[key] = (body, frozenset(tags), time.monotonic() + self.ttl)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (evicted, _, _) = self.pages.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def discard(self, key):
+        """Removes a page from the cache, if it's cached. The lock must be held."""
+        page = self.pages.pop(key, None)
+        if page is not None:
+            self.size -= len(page[0])
+
+    def invalidate(self, tags):
+        """Removes every cached page with any of the tags.
+
+        Args:
+            tags (set): The tags of what changed.
+        """
+        with self.lock:
+            stale = [key for key, (_, page_tags, _) in self.pages.items()
+                     if not page_tags.isdisjoint(tags)]
+            for key in stale:
+                self.discard(key)
+            self.invalidations += len(stale)
+
+    def clear(self):
+        """Removes every page from the cache."""
+        with self.lock:
+            self.pages.clear()
+            self.size = 0
+
+    def stats(self):
+        """Returns a dict of the cache's size and counters."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"pages": len(self.pages),
+                    "size": self.size,
+                    "max_bytes": self.max_bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0,
+                    "evictions": self.evictions,
+                    "invalidations": self.invalidations,
+                    "expirations": self.expirations}
+
+
+page_cache = PageCache(app.config["PAGE_CACHE_MAX_BYTES"], app.config["PAGE_CACHE_TTL"])
+
+
+def is_page_cacheable():
+    """Returns bool: True if the current request can be served from the cache.
+
+    Only GET requests from anonymous users without pending flash messages are cached.
+    """
+    return (app.config["PAGE_CACHE"]
+            and request.method == "GET"
+            and not current_user.is_authenticated
+            and not session.get("_flashes"))
+
+
+def add_page_cache_tags(*tags):
+    """Tags the page being rendered with what it shows, e.g. "feed" or "recipe:5"."""
+    g.setdefault("page_cache_tags", set()).update(tags)
+
+
+def cache_anonymous_page(view):
+    """Decorator: serves the page from the cache for anonymous users.
+
+    The view tags its page with add_page_cache_tags(), so it can be invalidated
+    when those recipes change. Only successful responses are cached.
+    """
+    @wraps(view)
+    def cached_view(*args, **kwargs):
+        if not is_page_cacheable():
+            return view(*args, **kwargs)
+
+        key = request.full_path
+        body = page_cache.get(key)
+        if body is not None:
+            return make_response(body)
+
+        response = make_response(view(*args, **kwargs))
+        if response.status_code == 200 and not response.direct_passthrough:
+            page_cache.set(key, response.get_data(),
+                           g.get("page_cache_tags", set()))
+        return response
+    return cached_view
+
+
+def get_page_cache_tags(recipe):
+    """Returns the tags of the pages that show the recipe."""
+    if isinstance(recipe, ModifiedRecipe):
+        return {"feed", f"modified:{recipe.id}"}
+    return {"feed", f"recipe:{recipe.id}"}
+
+
+@event.listens_for(Recipe, "after_insert")
+@event.listens_for(Recipe, "after_update")
+@event.listens_for(Recipe, "after_delete")
+@event.listens_for(ModifiedRecipe, "after_insert")
+@event.listens_for(ModifiedRecipe, "after_update")
+@event.listens_for(ModifiedRecipe, "after_delete")
+def queue_page_invalidation(mapper, connection, target):
+    """Mapper event: queues the pages showing a recipe to be invalidated once the session commits."""
+    if app.config["PAGE_CACHE"]:
+        object_session(target).info.setdefault(
+            "page_cache_tags", set()).update(get_page_cache_tags(target))
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_pages(session):
+    """Session event: invalidates the pages showing the recipes changed by the commit."""
+    tags = session.info.pop("page_cache_tags", None)
+    if tags:
+        page_cache.invalidate(tags)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def discard_page_invalidations(session, previous_transaction):
+    """Session event: discards the queued invalidations when the session rolls back."""
+    session.info.pop("page_cache_tags", None)
+
+
+def get_recipe_page_etag(recipe_id, get_modified, last_modified):
+    """Returns the ETag of a recipe page for the current user.
+
+    The page shows different buttons depending on who's viewing it and whether
+    they've saved the recipe, so those are part of the ETag too.
+
+    Args:
+        recipe_id (int): The ID of the recipe.
+        get_modified (bool): True if it's a modified recipe's page.
+        last_modified (datetime): When the recipe's page last changed.
+
+    Returns:
+        str: The ETag.
+    """
+    viewer = "anonymous"
+    if current_user.is_authenticated:
+        viewer = f"{current_user.id}:{current_user.user_type}"
+        if not get_modified:
+            viewer += f":{has_user_saved_recipe(current_user.id, recipe_id)}"
+    page = f"{'m' if get_modified else 'r'}{recipe_id}:{last_modified.isoformat()}:{viewer}"
+    return hashlib.sha1(page.encode("utf-8")).hexdigest()
+
+
+def conditional_recipe_page(get_modified=False):
+    """Decorator: adds conditional GET support to a recipe page.
+
+    Answers with 304 Not Modified if the client's copy is still current.
+    Otherwise the page is rendered as usual and sent with an ETag and Last-Modified.
+
+    Args:
+        get_modified (bool): True if the view is for modified recipes.
+    """
+    def decorator(view):
+        @wraps(view)
+        def conditional_view(recipe_id, *args, **kwargs):
+            if request.method != "GET":
+                return view(recipe_id, *args, **kwargs)
+
+            last_modified = get_recipe_last_modified(recipe_id, get_modified)
+            if last_modified is None:
+                return view(recipe_id, *args, **kwargs)
+
+            etag = get_recipe_page_etag(recipe_id, get_modified, last_modified)
+            if not is_resource_modified(request.environ, etag=etag,
+                                        last_modified=last_modified):
+                response = make_response("", 304)
+            else:
+                response = make_response(view(recipe_id, *args, **kwargs))
+
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            # Browsers and proxies must check the page is still current before reusing it
+            response.cache_control.no_cache = True
+            response.vary.add("Cookie")
+            return response
+        return conditional_view
+    return decorator
+
+
+class UserCache:
+    """A thread-safe cache of user rows, whose entries expire after a time to live.
+
+    Attributes:
+        ttl (float): Seconds an entry is kept for.
+        max_users (int): The most users to keep cached. The oldest entries are evicted first.
+    """
+
+    def __init__(self, ttl, max_users=10000):
+        self.ttl = ttl
+        self.max_users = max_users
+        self.lock = threading.Lock()
+        self.users = OrderedDict()
+
+    def get(self, user_id):
+        """Returns the cached column values of a user, or None if they aren't cached.
+
+        Args:
+            user_id (int): The ID of the user.
+        """
+        with self.lock:
+            entry = self.users.get(user_id)
+            if entry is None:
+                return None
+            expires, data = entry
+            if expires < time.monotonic():
+                del self.users[user_id]
+                return None
+            return data
+
+    def set(self, user_id, data):
+        """Caches the column values of a user.
+
+        Args:
+            user_id (int): The ID of the user.
+            data (dict): The user's column values.
+        """
+        with self.lock:
+            self.users.pop(user_id, None)
+            self.users[user_id] = (time.monotonic() + self.ttl, data)
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+
+    def invalidate(self, user_ids):
+        """Removes users from the cache.
+
+        Args:
+            user_ids (set): The IDs of the users.
+        """
+        with self.lock:
+            for user_id in user_ids:
+                self.users.pop(user_id, None)
+
+    def clear(self):
+        """Removes every user from the cache."""
+        with self.lock:
+            self.users.clear()
+
+
+user_cache = UserCache(app.config["USER_CACHE_TTL"])
+
+
+def load_cached_user(user_id):
+    """Loads a user, from the user cache if possible.
+
+    A cached user is added to the session without a query, so it can be used
+    and changed just like a user loaded from the database.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        User: The user, or None if they don't exist.
+    """
+    if user_cache.ttl <= 0:
+        return db.session.get(User, user_id)
+
+    data = user_cache.get(user_id)
+    if data is None:
+        user = db.session.get(User, user_id)
+        if user is not None:
+            user_cache.set(user_id, {attr.key: getattr(user, attr.key)
+                                     for attr in inspect(User).column_attrs})
+        return user
+
+    user = User(**data)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def queue_user_invalidation(mapper, connection, target):
+    """Mapper event: queues a changed user to be removed from the cache once the session commits."""
+    object_session(target).info.setdefault("user_cache_ids", set()).add(target.id)
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_users(session):
+    """Session event: removes the users changed by the commit from the cache."""
+    user_ids = session.info.pop("user_cache_ids", None)
+    if user_ids:
+        user_cache.invalidate(user_ids)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def discard_user_invalidations(session, previous_transaction):
+    """Session event: discards the queued user invalidations when the session rolls back."""
+    session.info.pop("user_cache_ids", None)
@@ -0,0 +1,216 @@
+"""
+Contains the Flask CLI commands for My Recipe.
+
+Run them with "flask --app myrecipe <command>".
+Schema changes are migrations, run with "flask --app myrecipe db upgrade" (see migrations/).
+
+Functions:
+
+    create_admin_command(): Creates the admin user with the default password.
+    rebuild_search_index_command(): Creates and refills the full-text search index.
+    backfill_image_variants_command(): Creates the missing variants of locally saved images.
+    reconcile_images_command(): Brings the image registry in line with the stored images.
+    benchmark_bcrypt_command(): Measures password hashes per second at different bcrypt costs.
+    import_recipes_command(path): Imports recipes from a JSON Lines or CSV file.
+    export_recipes_command(output): Exports every recipe as JSON Lines or CSV.
+    seed_data_command(recipes): Fills the database with synthetic recipes for benchmarking.
+    benchmark_command(): Times the hot pages at several catalogue sizes.
+"""
+
+import json
+from datetime import datetime
+import click
+from myrecipe import app
+from myrecipe.helpers import reconcile_image_registry, create_default_admin
+from myrecipe.search import rebuild_search_index
+from myrecipe.images import backfill_image_variants
+from myrecipe.passwords import benchmark_hashing
+from myrecipe.bulk import import_recipes, export_recipes, get_import_format
+from myrecipe.benchmarks import seed_data, run_benchmarks, compare_results
+
+
+@app.cli.command("create-admin")
+def create_admin_command():
+    """Creates the "admin" user with DEFAULT_ADMIN_PASSWORD, if there's no admin yet.
+
+    Run once when deploying. Safe to run more than once.
+    """
+    if create_default_admin() is None:
+        click.echo("An admin user already exists.")
+    else:
+        click.echo('Created the "admin" user with the default password.')
+
+
+@app.cli.command("rebuild-search-index")
+def rebuild_search_index_command():
+    """Creates the full-text search indexes and re-indexes every recipe.
+
+    "db upgrade" creates them, but the SQLite index is only kept up to date while
+    the "fulltext" backend is enabled. Run once after enabling it, if recipes changed while it was off.
+    """
+    count = rebuild_search_index()
+    click.echo(f"Indexed {count} recipes.")
+
+
+@app.cli.command("backfill-image-variants")
+def backfill_image_variants_command():
+    """Creates the downscaled variants of images uploaded before variants existed.
+
+    Only needed for images saved locally. Requires Pillow.
+    """
+    count = backfill_image_variants()
+    click.echo(f"Created variants for {count} images.")
+
+
+@app.cli.command("reconcile-images")
+def reconcile_images_command():
+    """Brings the image registry in line with the images actually stored.
+
+    Run once after upgrading to register existing images, then periodically,
+    e.g. daily with Heroku Scheduler, to catch images changed outside the app.
+    """
+    counts = reconcile_image_registry()
+    click.echo(f"Checked {counts['checked']} images, "
+               f"registered {counts['added']} and removed {counts['removed']}.")
+
+
+@app.cli.command("benchmark-bcrypt")
+@click.option("--rounds", "-r", "rounds_list", type=int, multiple=True,
+              help="A bcrypt cost to measure. Can be given more than once. Defaults to 10-14.")
+@click.option("--seconds", type=float, default=1.0, help="How long to measure each cost for.")
+def benchmark_bcrypt_command(rounds_list, seconds):
+    """Measures how many passwords one core can hash per second at each bcrypt cost.
+
+    Use it to choose BCRYPT_LOG_ROUNDS. Each login or sign-up costs one hash.
+    """
+    for rounds in rounds_list or range(10, 15):
+        rate = benchmark_hashing(rounds, seconds)
+        current = " (current)" if rounds == app.config["BCRYPT_LOG_ROUNDS"] else ""
+        click.echo(f"cost {rounds:>2}: {rate:8.1f} hashes/sec, "
+                   f"{1000 / rate:7.1f} ms per hash{current}")
+
+
+@app.cli.command("import-recipes")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "file_format", type=click.Choice(["jsonl", "csv"]),
+              help="The file's format. Defaults to its extension, .jsonl or .csv.")
+@click.option("--batch-size", type=click.IntRange(min=1), default=500, show_default=True,
+              help="How many rows to insert per commit.")
+@click.option("--job", "job_name",
+              help="The name to record the import's progress under. Defaults to the file name.")
+@click.option("--restart", is_flag=True,
+              help="Start from the first row, even if the file was imported before.")
+def import_recipes_command(path, file_format, batch_size, job_name, restart):
+    """Imports recipes and modified recipes from a JSON Lines or CSV file.
+
+    Rows are validated like the add recipe pages, invalid rows are reported and skipped.
+    If an import fails, run the same command again to resume after the last batch
+    that was committed. See myrecipe/bulk.py for the row fields.
+    """
+    file_format = file_format or get_import_format(path)
+    if file_format is None:
+        raise click.BadParameter("Use a .jsonl or .csv file, or give --format.",
+                                 param_hint="PATH")
+    try:
+        stats = import_recipes(path, file_format, batch_size, job_name, restart,
+                               report=click.echo)
+    except Exception as error:
+        raise click.ClickException(
+            f"Import failed: {error}\nRun the same command again to resume "
+            "after the last committed batch.") from error
+
+    if stats is None:
+        click.echo("This file has already been imported. Use --restart to import it again.")
+        return
+    if stats["resumed_after"]:
+        click.echo(f"Resumed after row {stats['resumed_after']}.")
+    rate = stats["rows"] / stats["seconds"] if stats["seconds"] else 0
+    click.echo(f"Imported {stats['imported']} recipes and skipped {stats['skipped']} rows "
+               f"in {stats['seconds']:.1f}s ({rate:.0f} rows/sec).")
+
+
+@app.cli.command("export-recipes")
+@click.argument("output", type=click.File("w", encoding="utf-8", lazy=True), default="-")
+@click.option("--format", "file_format", type=click.Choice(["jsonl", "csv"]),
+              help="The file's format. Defaults to OUTPUT's extension, or jsonl.")
+def export_recipes_command(output, file_format):
+    """Exports every recipe and modified recipe, with its dietary tags and save count.
+
+    Writes to OUTPUT, or to the terminal if it's not given. The file can be
+    imported again with "import-recipes".
+    """
+    file_format = file_format or get_import_format(output.name) or "jsonl"
+    for chunk in export_recipes(file_format):
+        output.write(chunk)
+
+
+@app.cli.command("seed-data")
+@click.argument("recipes", type=click.IntRange(min=1))
+@click.option("--users", type=click.IntRange(min=1),
+              help="How many users to create. Defaults to one per 10 recipes.")
+@click.option("--modified-recipes", type=click.IntRange(min=0),
+              help="How many modified recipes to create. Defaults to one per 5 recipes.")
+@click.option("--saves-per-user", type=click.IntRange(min=0), default=10, show_default=True,
+              help="How many recipes each user saves.")
+@click.option("--seed", type=int, default=0, show_default=True, help="The random seed.")
+@click.confirmation_option(prompt="This adds synthetic users and recipes to the database. "
+                                  "Continue?")
+def seed_data_command(recipes, users, modified_recipes, saves_per_user, seed):
+    """Fills the database with synthetic data until it has RECIPES recipes.
+
+    For benchmarking and testing only. The users are "bench1", "bench2" and so on,
+    all with the password "bench-password".
+    """
+    counts = seed_data(recipes, users, modified_recipes, saves_per_user, seed)
+    click.echo(f"The database has {counts['users']} users, {counts['recipes']} recipes, "
+               f"{counts['modified_recipes']} modified recipes and "
+               f"{counts['saved_recipes']} saved recipes.")
+
+
+@app.cli.command("benchmark")
+@click.option("--sizes", default="100,1000,10000", show_default=True,
+              help="The numbers of recipes to benchmark at, comma separated.")
+@click.option("--repeat", type=click.IntRange(min=1), default=20, show_default=True,
+              help="How many times to time each request.")
+@click.option("--only", "names", multiple=True,
+              help="Only run this benchmark, e.g. home or search_text. Can be given more than once.")
+@click.option("--output", type=click.Path(dir_okay=False, writable=True),
+              help="Where to save the results. Defaults to benchmark-<date and time>.json.")
+@click.option("--compare", "previous_path", type=click.Path(exists=True, dir_okay=False),
+              help="Earlier results to compare the median latencies with.")
+@click.confirmation_option(prompt="This adds synthetic users and recipes to the database. "
+                                  "Continue?")
+def benchmark_command(sizes, repeat, names, output, previous_path):
+    """Times the hot pages through the test client at several catalogue sizes.
+
+    Seeds the database up to each size with "seed-data", then requests each page
+    --repeat times and reports the latency percentiles and SQL statements per request.
+    Run it against a scratch database.
+    """
+    try:
+        sizes = [int(size) for size in sizes.split(",")]
+    except ValueError:
+        raise click.BadParameter("Give whole numbers, e.g. 100,1000.", param_hint="--sizes")
+
+    results = run_benchmarks(sizes, repeat, names, report=click.echo)
+    for run in results["runs"]:
+        click.echo(f"\n{run['size']} recipes:")
+        click.echo(f"  {'benchmark':<20} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+                   f"{'SQL/req':>8} {'errors':>7}")
+        for name, summary in run["benchmarks"].items():
+            click.echo(f"  {name:<20} {summary['p50_ms']:>9.2f} {summary['p95_ms']:>9.2f} "
+                       f"{summary['p99_ms']:>9.2f} {summary['sql_mean']:>8.1f} "
+                       f"{summary['errors']:>7}")
+
+    if previous_path:
+        with open(previous_path, encoding="utf-8") as file:
+            changes = compare_results(results, json.load(file))
+        click.echo("\nMedian latency compared with " + previous_path + ":")
+        for size, name, before, after, change in changes:
+            click.echo(f"  {size:>7} {name:<20} {before:>9.2f} -> {after:>9.2f} ms "
+                       f"({change:+.1f}%)")
+
+    output = output or f"benchmark-{datetime.utcnow():%Y%m%d-%H%M%S}.json"
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=2)
+    click.echo(f"\nSaved the results to {output}.")
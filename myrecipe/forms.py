@@ -17,8 +17,11 @@ from flask_wtf.file import FileField, FileAllowed
 from flask_login import current_user
 from wtforms import PasswordField, SelectMultipleField, StringField, TextAreaField
 from wtforms.validators import DataRequired, Length, EqualTo, ValidationError
-from myrecipe.routes import bcrypt, get_user
+from werkzeug.datastructures import FileStorage
+from myrecipe.routes import get_user
+from myrecipe.passwords import check_password
 from myrecipe.models import User
+from myrecipe.images import is_readable_image
 
 DIETARY_TAG_OPTIONS = [("vv", "Vegan"),
                        ("v", "Vegetarian"),
@@ -46,21 +49,27 @@ class RegistrationForm(FlaskForm):
 
 
 class LoginForm(FlaskForm):
-    """Flask form for loggin in"""
+    """Flask form for loggin in
+
+    Attributes:
+        user (User): The user with the entered username, once validated. Looked up
+            once and shared by the validators and the login route.
+    """
     username = StringField("Username:", validators=[
                            DataRequired(), Length(min=2, max=20)])
     password = PasswordField("Password:", validators=[
                              DataRequired(), Length(min=8, max=20)])
+    user = None
 
     def validate_username(self, username):
         """If username does not exist, raise ValidationError."""
-        if not get_user(username.data):
+        self.user = get_user(username.data)
+        if not self.user:
             raise ValidationError(f"Username does not exist: {username.data}")
 
     def validate_password(self, password):
         """If password is wrong, raise ValidationError."""
-        user = get_user(self.username.data)
-        if user and not bcrypt.check_password_hash(user.password, password.data):
+        if self.user and not check_password(self.user.password, password.data):
             raise ValidationError("Password is incorrect.")
 
 
@@ -85,6 +94,11 @@ class AddRecipeForm(FlaskForm):
     # Dietary tags
     dietary_tags = SelectMultipleField(choices=DIETARY_TAG_OPTIONS)
 
+    def validate_image(self, image):
+        """If the uploaded file isn't really an image, raise ValidationError."""
+        if isinstance(image.data, FileStorage) and not is_readable_image(image.data.stream):
+            raise ValidationError("Please only upload an image (jpg, png, or webp).")
+
 
 class AddModifiedRecipeForm(FlaskForm):
     """Flask form for adding a modified recipe."""
@@ -130,7 +144,7 @@ class NewPasswordForm(FlaskForm):
 
     def validate_current_password(self, current_password):
         """If current password is incorrect, raise ValidationError."""
-        if not bcrypt.check_password_hash(
+        if not check_password(
                 User.query.get(current_user.id).password, current_password.data):
             raise ValidationError("Current password is incorrect.")
 
@@ -139,6 +153,6 @@ class NewPasswordForm(FlaskForm):
 
         If not, raise ValidationError.
         """
-        if bcrypt.check_password_hash(User.query.get(current_user.id).password, new_password.data):
+        if check_password(User.query.get(current_user.id).password, new_password.data):
             raise ValidationError(
                 "New password cannot be the same as the current password.")
@@ -2,12 +2,31 @@
 Contains all the functions used by routes in My Recipe.
 """
 import os
+import hashlib
+import tempfile
+from datetime import datetime
 import cloudinary
 import cloudinary.uploader
 import cloudinary.api
+from sqlalchemy import delete, inspect, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import joinedload, load_only, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 from werkzeug.utils import secure_filename
-from myrecipe.models import DietaryTags, User, Recipe, SavedRecipe, ModifiedRecipe
-from myrecipe import app, db, UserType, DIETARY_TAGS
+from flask_login import current_user
+from myrecipe.models import (DietaryTags, User, Recipe, SavedRecipe, ModifiedRecipe,
+                             StoredImage)
+from myrecipe import app, db, UserType, DIETARY_TAGS, DEFAULT_ADMIN_PASSWORD
+from myrecipe.passwords import hash_password, check_password
+from myrecipe.images import (create_image_variants, delete_image_variants,
+                             get_cloudinary_variant_options, get_upload_folder_path,
+                             get_image_backend, register_image, unregister_image)
+from myrecipe.search import (is_fulltext_available, is_trigram_enabled, get_search_terms,
+                             fulltext_search, trigram_search, has_dietary_mask)
+
+# Bytes read at a time when streaming an uploaded image to disk
+IMAGE_CHUNK_SIZE = 64 * 1024
 
 
 def get_user(username):
@@ -33,6 +52,111 @@ def get_all_recipes():
     return all_recipes
 
 
+def get_recipe_feed(cursor=None, per_page=None, user_id=None, dietary_mask=0, columns=None):
+    """Retrieves one page of the recipe feed using keyset pagination.
+
+    Original recipes come first, ordered by ID, followed by the modified recipes.
+    The cursor marks the last recipe on the previous page, so each page is a
+    range scan on the primary key no matter how far into the feed it is.
+
+    Given a user_id, only the recipes created and modified by that user are included,
+    filtered in SQL, so the cost depends on how many recipes they have.
+
+    The recipes aren't hydrated, so callers only pay for the data they show,
+    e.g. with hydrate_recipes() for the recipe templates.
+
+    Args:
+        cursor (str): The cursor returned with the previous page, None for the first page.
+        per_page (int): The number of recipes per page. Defaults to RECIPES_PER_PAGE.
+        user_id (int): Only include the recipes owned by this user. Defaults to everyone's.
+        dietary_mask (int): Only include the recipes with all of these dietary tags.
+        columns (list): Only load these columns, e.g. ["title", "desc"], see
+            get_feed_load_option(). Defaults to every column.
+
+    Returns:
+        tuple: The recipes on the page and the cursor of the next page (None if last page).
+    """
+    per_page = per_page or app.config["RECIPES_PER_PAGE"]
+    kind, last_id = parse_feed_cursor(cursor)
+
+    # Fetch one extra recipe to find out if there is another page
+    recipes = []
+    if kind == "r":
+        query = Recipe.query.filter(Recipe.id > last_id,
+                                    has_dietary_mask(Recipe, dietary_mask))
+        if user_id is not None:
+            query = query.filter(Recipe.user_id == user_id)
+        if columns is not None:
+            query = query.options(get_feed_load_option(Recipe, columns))
+        recipes = query.order_by(Recipe.id).limit(per_page + 1).all()
+        last_id = 0
+
+    if len(recipes) <= per_page:
+        query = ModifiedRecipe.query.filter(ModifiedRecipe.id > last_id,
+                                            has_dietary_mask(ModifiedRecipe, dietary_mask))
+        if user_id is not None:
+            query = query.filter(ModifiedRecipe.modified_by_id == user_id)
+        if columns is not None:
+            query = query.options(get_feed_load_option(ModifiedRecipe, columns))
+        recipes.extend(query.order_by(
+            ModifiedRecipe.id).limit(per_page + 1 - len(recipes)).all())
+
+    next_cursor = None
+    if len(recipes) > per_page:
+        recipes = recipes[:per_page]
+        next_cursor = get_feed_cursor(recipes[-1])
+    return recipes, next_cursor
+
+
+def get_feed_load_option(model, columns):
+    """Returns the query option that only loads some of a recipe model's columns.
+
+    The ID, the keys linking the recipe to its users and original recipe, the dietary mask
+    and updated_at are always loaded. Columns the model doesn't have are ignored,
+    so the same list works for recipes and modified recipes.
+
+    Args:
+        model: The Recipe or ModifiedRecipe model.
+        columns (list): The names of the columns to load.
+
+    Returns:
+        The load_only() option.
+    """
+    names = set(columns) | {"user_id", "modified_by_id", "recipe_id",
+                            "dietary_mask", "updated_at"}
+    return load_only(*[getattr(model, name) for name in model.__table__.columns.keys()
+                       if name in names])
+
+
+def get_feed_cursor(recipe):
+    """Returns the feed cursor pointing at the given recipe.
+
+    The cursor is "r" for a recipe or "m" for a modified recipe, followed by its ID.
+    """
+    return f"{'m' if is_modified_recipe(recipe) else 'r'}{recipe.id}"
+
+
+def parse_feed_cursor(cursor):
+    """Splits a feed cursor into the recipe kind and ID.
+
+    Invalid or missing cursors start the feed from the beginning.
+
+    Args:
+        cursor (str): The feed cursor from the URL.
+
+    Returns:
+        tuple: The kind ("r" or "m") and the ID of the last recipe shown.
+    """
+    if is_feed_cursor(cursor):
+        return cursor[0], int(cursor[1:])
+    return "r", 0
+
+
+def is_feed_cursor(cursor):
+    """Returns bool: True if the cursor is well formed, e.g. "r24" or "m3"."""
+    return bool(cursor) and cursor[0] in ("r", "m") and cursor[1:].isdigit()
+
+
 def get_all_modified_recipes():
     """Retrieves all modified recipes from the database.
 
@@ -40,10 +164,7 @@ def get_all_modified_recipes():
         modified recipes (list): A list of modified recipes.
     """
     modified_recipes = ModifiedRecipe.query.all()
-
-    for m_recipe in modified_recipes:
-        m_recipe = get_modified_recipe(m_recipe.id)
-
+    add_recipe_data_to_modified_recipes(modified_recipes)
     return modified_recipes
 
 
@@ -64,19 +185,158 @@ def get_recipe(recipe_id, get_modified=False):
     return recipe
 
 
-def add_recipe_data_to_modified_recipes(modified_recipe):
-    """Adds the data from the original recipe to the modified recipe.
+def get_recipe_for_delete(recipe_id, get_modified=False):
+    """Gets a recipe with everything deleted along with it already loaded.
+
+    Deleting a recipe also deletes its dietary tags, saves and modified recipes,
+    and their dietary tags. Loading them up front takes one query per table,
+    instead of one query per modified recipe when the delete cascades.
 
     Args:
-        modified_recipe (list): A list of modified recipe objects.
+        recipe_id (int): The ID of the recipe.
+        get_modified (bool): If True, get a modified recipe.
+
+    Returns:
+        Recipe or ModifiedRecipe: The recipe, or None if it doesn't exist.
+    """
+    model = ModifiedRecipe if get_modified else Recipe
+    query = model.query.options(joinedload(model.dietary_tags))
+    if not get_modified:
+        query = query.options(selectinload(Recipe.saved_recipes),
+                              selectinload(Recipe.recipe_copies).joinedload(
+                                  ModifiedRecipe.dietary_tags))
+    recipe = query.filter(model.id == recipe_id).first()
+    if get_modified and recipe is not None:
+        add_recipe_data_to_modified_recipes([recipe])
+    return recipe
+
+
+def hydrate_recipes(recipes):
+    """Adds everything the recipe templates need to a list of recipes.
+
+    Works on any mix of recipes and modified recipes using a constant number of
+    queries: one for the original recipes, one for the usernames, one for the
+    dietary tags and, for logged in users, one for which recipes they've saved,
+    however many recipes there are.
+
+    Args:
+        recipes (list): The recipes and modified recipes to hydrate.
+    """
+    modified_recipes = [recipe for recipe in recipes if is_modified_recipe(recipe)]
+    load_original_recipes(modified_recipes)
+
+    user_ids = {recipe.original_recipe.user_id if is_modified_recipe(recipe)
+                else recipe.user_id for recipe in recipes}
+    user_ids.update(m_recipe.modified_by_id for m_recipe in modified_recipes)
+    usernames = get_usernames(user_ids)
+
+    copy_original_recipe_data(modified_recipes, usernames)
+    set_created_by(recipes, usernames)
+    add_dietary_tags_to_recipes(recipes)
+    if current_user.is_authenticated:
+        add_saved_state_to_recipes(recipes, current_user.id)
+
+
+def load_original_recipes(modified_recipes):
+    """Loads the original recipe of each modified recipe in a single query.
+
+    The original recipes are set on the "original_recipe" relationship,
+    so accessing it later (including from templates) doesn't query the database.
+
+    Args:
+        modified_recipes (list): A list of modified recipe objects.
     """
-    for m_recipe in modified_recipe:
-        recipe = Recipe.query.get(m_recipe.recipe_id)
+    unloaded = [m_recipe for m_recipe in modified_recipes
+                if "original_recipe" in inspect(m_recipe).unloaded]
+    recipe_ids = {m_recipe.recipe_id for m_recipe in unloaded}
+    if not recipe_ids:
+        return
+
+    originals = {recipe.id: recipe for recipe in
+                 Recipe.query.filter(Recipe.id.in_(recipe_ids)).all()}
+    for m_recipe in unloaded:
+        set_committed_value(m_recipe, "original_recipe",
+                            originals.get(m_recipe.recipe_id))
+
+
+def get_usernames(user_ids):
+    """Retrieves the usernames of several users in a single query.
+
+    Args:
+        user_ids (iterable): The IDs of the users.
+
+    Returns:
+        dict: The usernames keyed by user ID.
+    """
+    if not user_ids:
+        return {}
+    return dict(db.session.query(User.id, User.username).filter(
+        User.id.in_(set(user_ids))).all())
+
+
+def copy_original_recipe_data(modified_recipes, usernames):
+    """Copies the original recipe's data and the modifier's username onto modified recipes.
+
+    The original recipes must already be loaded, see load_original_recipes().
+
+    Args:
+        modified_recipes (list): A list of modified recipe objects.
+        usernames (dict): The usernames keyed by user ID.
+    """
+    for m_recipe in modified_recipes:
+        recipe = m_recipe.original_recipe
         m_recipe.title = recipe.title
         m_recipe.desc = recipe.desc
         m_recipe.image_url = recipe.image_url
-        m_recipe.modified_by = User.query.filter_by(
-            id=m_recipe.modified_by_id).first().username
+        m_recipe.modified_by = usernames.get(m_recipe.modified_by_id)
+
+
+def set_created_by(recipes, usernames):
+    """Sets the created_by attribute of each recipe from the usernames given.
+
+    For a modified recipe, this is the user who created the original recipe.
+
+    Args:
+        recipes (list): The recipes to add the created_by attribute to.
+        usernames (dict): The usernames keyed by user ID.
+    """
+    for recipe in recipes:
+        user_id = recipe.original_recipe.user_id if is_modified_recipe(
+            recipe) else recipe.user_id
+        recipe.created_by = usernames.get(user_id)
+
+
+def get_recipe_last_modified(recipe_id, get_modified=False):
+    """Returns when the content of a recipe's page last changed, without loading the recipe.
+
+    A modified recipe's page also shows its original recipe, so the later of the two is used.
+
+    Args:
+        recipe_id (int): The ID of the recipe.
+        get_modified (bool): If True, the ID is of a modified recipe.
+
+    Returns:
+        datetime: The last modified time, or None if unknown or the recipe doesn't exist.
+    """
+    if get_modified:
+        row = db.session.query(ModifiedRecipe.updated_at, Recipe.updated_at).join(
+            ModifiedRecipe.original_recipe).filter(ModifiedRecipe.id == recipe_id).first()
+        if row is None or None in row:
+            return None
+        return max(row)
+    return db.session.query(Recipe.updated_at).filter(Recipe.id == recipe_id).scalar()
+
+
+def add_recipe_data_to_modified_recipes(modified_recipe):
+    """Adds the data from the original recipe to the modified recipe.
+
+    Args:
+        modified_recipe (list): A list of modified recipe objects.
+    """
+    load_original_recipes(modified_recipe)
+    usernames = get_usernames(
+        {m_recipe.modified_by_id for m_recipe in modified_recipe})
+    copy_original_recipe_data(modified_recipe, usernames)
 
 
 def get_modified_recipe(recipe_id):
@@ -93,24 +353,24 @@ def get_modified_recipe(recipe_id):
     return recipe
 
 
-def add_dietary_tags_to_db(form_dietary_tags):
-    """Add dietary tags to the database.
+def create_dietary_tags(form_dietary_tags):
+    """Creates the dietary tags for a new recipe.
+
+    They aren't added to the session. Set them as the recipe's "dietary_tags"
+    and they're inserted along with the recipe, in the same commit.
 
     Args:
         form_dietary_tags (str list): A list of dietary tags strings.
 
     Returns:
-        int: The ID of the added dietary tags.
-    """
-    dietary_tags = DietaryTags(is_vegan="vv" in form_dietary_tags,
-                               is_vegetarian="v" in form_dietary_tags,
-                               is_gluten_free="gf" in form_dietary_tags,
-                               is_dairy_free="df" in form_dietary_tags,
-                               is_nut_free="nf" in form_dietary_tags,
-                               is_egg_free="ef" in form_dietary_tags)
-    db.session.add(dietary_tags)
-    db.session.commit()
-    return dietary_tags.id
+        DietaryTags: The new dietary tags.
+    """
+    return DietaryTags(is_vegan="vv" in form_dietary_tags,
+                       is_vegetarian="v" in form_dietary_tags,
+                       is_gluten_free="gf" in form_dietary_tags,
+                       is_dairy_free="df" in form_dietary_tags,
+                       is_nut_free="nf" in form_dietary_tags,
+                       is_egg_free="ef" in form_dietary_tags)
 
 
 def add_created_by_to_recipes(recipes):
@@ -119,10 +379,11 @@ def add_created_by_to_recipes(recipes):
     Args:
         recipes (list): The recipes to add the created_by attribute to.
     """
-    for recipe in recipes:
-        user_id = recipe.original_recipe.user_id if is_modified_recipe(
-            recipe) else recipe.user_id
-        recipe.created_by = User.query.filter_by(id=user_id).first().username
+    load_original_recipes([recipe for recipe in recipes
+                           if is_modified_recipe(recipe)])
+    user_ids = {recipe.original_recipe.user_id if is_modified_recipe(recipe)
+                else recipe.user_id for recipe in recipes}
+    set_created_by(recipes, get_usernames(user_ids))
 
 
 def has_user_saved_recipe(user_id, recipe_id):
@@ -135,7 +396,64 @@ def has_user_saved_recipe(user_id, recipe_id):
     returns: 
         bool: True if user has saved the recipe else false.
     """
-    return bool(SavedRecipe.query.filter_by(user_id=user_id, recipe_id=recipe_id).first())
+    return recipe_id in get_saved_recipe_ids(user_id, [recipe_id])
+
+
+def get_saved_recipe_ids(user_id, recipe_ids):
+    """Finds which of the recipes the user has saved, in a single query.
+
+    Args:
+        user_id (int): The user id.
+        recipe_ids (list): The recipe ids to check.
+
+    Returns:
+        set: The ids of the recipes the user has saved.
+    """
+    if not recipe_ids:
+        return set()
+    return set(db.session.scalars(select(SavedRecipe.recipe_id).where(
+        SavedRecipe.user_id == user_id, SavedRecipe.recipe_id.in_(recipe_ids))))
+
+
+def add_saved_state_to_recipes(recipes, user_id):
+    """Sets "is_saved" on each recipe, for whether the user has saved it, in a single query.
+
+    Only original recipes can be saved, so modified recipes are never saved.
+
+    Args:
+        recipes (list): The recipes and modified recipes.
+        user_id (int): The user id.
+    """
+    saved_ids = get_saved_recipe_ids(
+        user_id, {recipe.id for recipe in recipes if not is_modified_recipe(recipe)})
+    for recipe in recipes:
+        recipe.is_saved = not is_modified_recipe(recipe) and recipe.id in saved_ids
+
+
+def set_recipe_saved(user_id, recipe_id, saved):
+    """Saves or unsaves a recipe for the user.
+
+    Idempotent: saving a saved recipe, or unsaving an unsaved one, changes nothing.
+    On PostgreSQL and SQLite it's a single statement, relying on the unique
+    (user_id, recipe_id) index, so concurrent requests can't save a recipe twice.
+
+    Args:
+        user_id (int): The user id.
+        recipe_id (int): The recipe id.
+        saved (bool): True to save the recipe, False to unsave it.
+    """
+    if not saved:
+        db.session.execute(delete(SavedRecipe).where(
+            SavedRecipe.user_id == user_id, SavedRecipe.recipe_id == recipe_id))
+    elif db.engine.dialect.name in ("postgresql", "sqlite"):
+        insert = (postgresql_insert if db.engine.dialect.name == "postgresql"
+                  else sqlite_insert)
+        db.session.execute(insert(SavedRecipe).values(
+            user_id=user_id, recipe_id=recipe_id).on_conflict_do_nothing(
+            index_elements=["user_id", "recipe_id"]))
+    elif not has_user_saved_recipe(user_id, recipe_id):
+        db.session.add(SavedRecipe(user_id=user_id, recipe_id=recipe_id))
+    db.session.commit()
 
 
 def save_image(image):
@@ -149,6 +467,9 @@ def save_image(image):
     """
     if app.config["SAVE_IMAGES_LOCALLY"]:
         return save_image_locally(image)
+    elif app.config["BACKGROUND_IMAGE_UPLOADS"]:
+        # Stored locally as a placeholder until it's uploaded in the background
+        return save_image_locally(image)
     else:
         return upload_image(image)
 
@@ -165,40 +486,53 @@ def upload_image(image):
 
     filename = remove_filename_extension(image.filename)
     result = cloudinary.uploader.upload(
-        image, public_id=filename, folder="myrecipe/image-uploads")
+        image, public_id=filename, folder="myrecipe/image-uploads",
+        eager=get_cloudinary_variant_options())
     image_url = result['secure_url']
+    register_image(image_url, result.get("bytes"))
     return image_url
 
 
 def save_image_locally(image):
-    """Saves an image locally
+    """Saves an image locally under the hash of its content, along with its downscaled variants.
+
+    The image is streamed to a temporary file while it's hashed, then linked to its final name.
+    Linking fails if the name is taken, so concurrent uploads can't overwrite each other,
+    and uploading an image that's already stored reuses the stored file.
 
     Args:
         file: The image to be saved.
 
     returns: The image URL
     """
-    filename = secure_filename(image.filename)
-    save_path = app.config["PACKAGE_NAME"] + "/" + app.config['UPLOAD_FOLDER']
-    if not os.path.exists(save_path):
-        os.makedirs(save_path)
-
-    counter = 2
-    # If file with same name exists, add a number to the end of the filename.
-    # Increment until a unique filename is found
-    while os.path.isfile(os.path.join(save_path, filename)):
-        filename_parts = filename.split(".")
-        filename_name = filename_parts[0]
-        if "_" in filename_name:
-            filename_name = filename_name.split("_")[0] + f"_{counter}"
-        else:
-            filename_name = filename_name + "_2"
-        filename = f'{filename_name}.{".".join(filename_parts[1:])}'
-        counter += 1
+    extension = os.path.splitext(secure_filename(image.filename))[1].lower()
+    save_path = get_upload_folder_path()
+    os.makedirs(save_path, exist_ok=True)
+
+    digest = hashlib.sha256()
+    temp_fd, temp_path = tempfile.mkstemp(dir=save_path, prefix=".upload-")
+    with os.fdopen(temp_fd, "wb") as temp_file:
+        for chunk in iter(lambda: image.stream.read(IMAGE_CHUNK_SIZE), b""):
+            digest.update(chunk)
+            temp_file.write(chunk)
+
+    filename = digest.hexdigest() + extension
+    image_path = os.path.join(save_path, filename)
+    image_url = "/" + app.config["UPLOAD_FOLDER"] + "/" + filename
+    try:
+        os.link(temp_path, image_path)
+        register_image(image_url, os.path.getsize(image_path))
+        create_image_variants(image_path)
+    except FileExistsError:
+        pass  # The same image is already stored, and registered
+    finally:
+        os.remove(temp_path)
+    return image_url
 
-    image.save(os.path.join(save_path, filename))
 
-    return "/" + app.config["UPLOAD_FOLDER"] + "/" + filename
+def is_local_image_url(image_url):
+    """Returns bool: True if the image is stored locally rather than on Cloudinary."""
+    return get_image_backend(image_url) == "local"
 
 
 def remove_filename_extension(filename):
@@ -229,36 +563,136 @@ def get_public_id(image_url):
 def delete_image(image_url):
     """Deletes an image from the local storage or cloud storage.
 
+    Identical images share a file, so the image is only deleted if the recipe
+    being changed is the last one using it. Call this before the recipe stops
+    referencing the image.
+
+    Its variants are deleted too. Cloudinary deletes them along with the image.
+
     Args:
         image_url (str): The URL of the image to be deleted.
     """
-    if app.config["SAVE_IMAGES_LOCALLY"]:
+    if count_image_references(image_url) > 1:
+        return
+    if is_local_image_url(image_url):
         os.remove(app.config["PACKAGE_NAME"] + "/" + image_url)
+        delete_image_variants(app.config["PACKAGE_NAME"] + "/" + image_url)
+        unregister_image(image_url)
     else:
         public_id = get_public_id(image_url)
         cloudinary.uploader.destroy(public_id)
+        # Every version of the image is gone along with its public id
+        for record in get_image_versions(public_id):
+            unregister_image(record.image_url)
+
+
+def get_image_versions(public_id):
+    """Returns list: The registered Cloudinary images with the public id, one per uploaded version."""
+    return StoredImage.query.filter(
+        StoredImage.backend == "cloudinary",
+        StoredImage.image_url.contains(f"/{public_id}.", autoescape=True)).all()
+
+
+def count_image_references(image_url):
+    """Returns the number of recipes that use the image.
+
+    Cloudinary images are counted by public id, not URL. Uploading an image again
+    under the same public id gives it a new versioned URL, but it's the same image.
+
+    Args:
+        image_url (str): The URL of the image.
+
+    Returns:
+        int: The number of recipes with that image.
+    """
+    if is_local_image_url(image_url):
+        return Recipe.query.filter(Recipe.image_url == image_url).count()
+    return Recipe.query.filter(Recipe.image_url.contains(
+        f"/{get_public_id(image_url)}.", autoescape=True)).count()
 
 
 def image_exists(image_url):
     """Check if the image exists in the specified path.
 
+    Reads the image registry. Images that aren't registered, e.g. ones stored
+    before the registry existed, are looked up in their backend and registered if found.
+
     Args:
         image_url (str): The URL of the image file.
 
     Returns:
        bool: True if the image file exists, False otherwise.
     """
-    if app.config["SAVE_IMAGES_LOCALLY"]:
-        return os.path.exists(app.config["PACKAGE_NAME"] + "/" + image_url)
-    else:
-        try:
-            public_id = get_public_id(image_url)
+    if not image_url:
+        return False
+    if db.session.get(StoredImage, image_url) is not None:
+        return True
+
+    size = get_stored_image_size(image_url)
+    if size is None:
+        return False
+    register_image(image_url, size)
+    return True
+
+
+def get_stored_image_size(image_url):
+    """Looks up an image in the backend it's stored in.
+
+    Args:
+        image_url (str): The URL of the image file.
+
+    Returns:
+        int: The size of the image in bytes, or None if it doesn't exist.
+    """
+    if is_local_image_url(image_url):
+        path = app.config["PACKAGE_NAME"] + "/" + image_url
+        return os.path.getsize(path) if os.path.exists(path) else None
+    try:
+        public_id = get_public_id(image_url)
+
+        # Will raise exception if not found
+        result = cloudinary.uploader.explicit(public_id, type="upload")
+        return result.get("bytes", 0)
+    except Exception:
+        return None
+
 
-            # Will raise exception if not found
-            cloudinary.uploader.explicit(public_id, type="upload")
-            return True
-        except Exception:
-            return False
+def reconcile_image_registry():
+    """Brings the image registry in line with the images actually stored.
+
+    Removes the records of images that no longer exist, refreshes the records
+    of those that do, and registers recipe images that are stored but not registered.
+
+    Returns:
+        dict: The number of images "checked", "removed" and "added".
+    """
+    counts = {"checked": 0, "removed": 0, "added": 0}
+    checked = set()
+    for record in StoredImage.query.all():
+        checked.add(record.image_url)
+        counts["checked"] += 1
+        size = get_stored_image_size(record.image_url)
+        if size is None:
+            db.session.delete(record)
+            counts["removed"] += 1
+        else:
+            record.size = size
+            record.checked_at = datetime.utcnow()
+
+    unregistered = db.session.query(Recipe.image_url).distinct().outerjoin(
+        StoredImage, StoredImage.image_url == Recipe.image_url).filter(
+        Recipe.image_url.isnot(None), StoredImage.image_url.is_(None))
+    for (image_url,) in unregistered.all():
+        if image_url in checked:
+            continue
+        counts["checked"] += 1
+        size = get_stored_image_size(image_url)
+        if size is not None:
+            register_image(image_url, size)
+            counts["added"] += 1
+
+    db.session.commit()
+    return counts
 
 
 def user_owns_recipe(user_id, recipe):
@@ -282,48 +716,76 @@ def user_owns_recipe(user_id, recipe):
 def search_all_recipes(search_query, *args):
     """Search for recipes that match the given search query and apply dietary tags filter.
 
+    Uses the full-text or trigram search backend if one is enabled, otherwise only
+    titles and descriptions are searched. So does full-text search if its index is missing.
+
     Args:
         search_query (str): The search query to match against recipe titles and descriptions.
         *args: Variable number of arguments representing dietary tags filter.
 
     Returns:
         list: Recipes that match the search query and dietary tags filter.
+            Ordered by relevance when using the full-text or trigram search backend.
+    """
+    # The dietary tags filter is applied in SQL using the recipe's dietary mask
+    dietary_mask = dietary_tag_data_to_mask(args[0])
+
+    if not search_query and dietary_mask:
+        return filter_recipes_by_dietary_mask(dietary_mask)
+    if get_search_terms(search_query) and is_fulltext_available():
+        return fulltext_search(search_query, dietary_mask)
+    if is_trigram_enabled() and get_search_terms(search_query):
+        return trigram_search(search_query, dietary_mask)
+    return search_recipe_titles_and_descs(search_query, dietary_mask)
+
+
+def search_recipe_titles_and_descs(search_query, dietary_mask=0):
+    """Search recipe titles and descriptions using ILIKE.
+
+    Modified recipes are matched on the title and description of their original recipe.
+
+    Args:
+        search_query (str): The search query to match against recipe titles and descriptions.
+        dietary_mask (int): Only return recipes with all of these dietary tags.
+
+    Returns:
+        list: Recipes and modified recipes that match the search query.
     """
     # Get all recipes that match the search query
     recipes = Recipe.query.filter(
-        Recipe.title.ilike(f"%{search_query}%")).all()
+        Recipe.title.ilike(f"%{search_query}%"),
+        has_dietary_mask(Recipe, dietary_mask)).all()
     recipes.extend(Recipe.query.filter(
-        Recipe.desc.ilike(f"%{search_query}%")).all())
+        Recipe.desc.ilike(f"%{search_query}%"),
+        has_dietary_mask(Recipe, dietary_mask)).all())
 
     # Get all modified recipes that match the search query
     modified_recipes = ModifiedRecipe.query.join(ModifiedRecipe.original_recipe).filter(
-        Recipe.title.ilike(f"%{search_query}%")).all()
+        Recipe.title.ilike(f"%{search_query}%"),
+        has_dietary_mask(ModifiedRecipe, dietary_mask)).all()
     modified_recipes.extend(ModifiedRecipe.query.join(ModifiedRecipe.original_recipe).filter(
-        Recipe.desc.ilike(f"%{search_query}%")).all())
-    add_recipe_data_to_modified_recipes(modified_recipes)
+        Recipe.desc.ilike(f"%{search_query}%"),
+        has_dietary_mask(ModifiedRecipe, dietary_mask)).all())
 
     # Extend recipes with modified recipes
     recipes.extend(modified_recipes)
-    recipes = set(recipes)  # Remove duplicates
+    return list(set(recipes))  # Remove duplicates
 
-    # Create dietary tags boolean filter
-    add_dietary_tags_to_recipes(recipes)
-    dietary_tags_filter = dietary_tag_data_to_bools(args[0])
-
-    # Apply dietary tags filter
-    if True in dietary_tags_filter:
-        filtered_recipes = []
-        for recipe in recipes:
-            recipe_filter = get_recipe_dietary_tags_bools(recipe)
-            passed = [recipe_filter[i] for i in range(
-                len(dietary_tags_filter)) if dietary_tags_filter[i]]
-
-            if all(passed):
-                filtered_recipes.append(recipe)
-    else:
-        filtered_recipes = recipes
 
-    return filtered_recipes
+def filter_recipes_by_dietary_mask(dietary_mask):
+    """Retrieves the recipes and modified recipes that have all of the dietary tags.
+
+    Args:
+        dietary_mask (int): The required dietary tags as a bitmask.
+
+    Returns:
+        list: The recipes and modified recipes with those dietary tags.
+    """
+    recipes = Recipe.query.filter(
+        has_dietary_mask(Recipe, dietary_mask)).all()
+    recipes.extend(ModifiedRecipe.query.filter(
+        has_dietary_mask(ModifiedRecipe, dietary_mask)).all())
+    return recipes
 
 
 def set_form_dietary_tags(form, dietary_tag_values):
@@ -347,8 +809,12 @@ def add_dietary_tags_to_recipes(recipes):
     Args:
         recipes (list): List of recipes.
     """
+    tag_ids = {recipe.dietary_tags_id for recipe in recipes}
+    all_tags = {tags.id: tags for tags in DietaryTags.query.filter(
+        DietaryTags.id.in_(tag_ids)).all()} if tag_ids else {}
+
     for recipe in recipes:
-        tags = DietaryTags.query.filter_by(id=recipe.dietary_tags_id).first()
+        tags = all_tags.get(recipe.dietary_tags_id)
         if tags:
             recipe.is_vegan = tags.is_vegan
             recipe.is_vegetarian = tags.is_vegetarian
@@ -372,6 +838,21 @@ def dietary_tag_data_to_bools(dietary_tags):
     return [tag in dietary_tags for tag in DIETARY_TAGS]
 
 
+def dietary_tag_data_to_mask(dietary_tags):
+    """Converts dietary tag data from the select fields into a bitmask.
+
+    Each tag in DIETARY_TAGS sets the bit at its index, so "vv" is 1 and "ef" is 32.
+
+    Args:
+        dietary_tags (list): A list of dietary tag data.
+
+    Returns:
+        int: The dietary tags bitmask.
+    """
+    return sum(1 << index for index, tag in enumerate(DIETARY_TAGS)
+               if tag in dietary_tags)
+
+
 def dietary_tag_data_to_names(dietary_tags):
     """Converts dietary tag data from select fields into humane-readable names.
 
@@ -415,13 +896,14 @@ def get_recipe_dietary_tags_bools(recipe):
 
 def is_modified_recipe(recipe):
     """Returns bool: True if the recipe is a modified recipe else false."""
-    return hasattr(recipe, "original_recipe")
+    return isinstance(recipe, ModifiedRecipe)
 
 
 def update_recipe(recipe, title, desc, ingredients, instructions, image):
     """Update the recipe with the new proposed new version.
 
     Checks whether the data has changed before updating.
+    Nothing is committed, see commit_recipe_changes().
 
     Args:
         recipe (Recipe): The recipe to be updated.
@@ -440,18 +922,21 @@ def update_recipe(recipe, title, desc, ingredients, instructions, image):
     if instructions != recipe.instructions:
         recipe.instructions = instructions
     if image:
-        if image.filename != recipe.image_url.split("/")[-1] or not image_exists(recipe.image_url):
-            if image_exists(recipe.image_url):
-                delete_image(recipe.image_url)
-            recipe.image_url = save_image(image)
-    db.session.add(recipe)
-    db.session.commit()
+        current_filename = recipe.image_url.split("/")[-1] if recipe.image_url else None
+        if image.filename != current_filename or not image_exists(recipe.image_url):
+            # Saving the same image again gives the same URL, so only replace a different image
+            image_url = save_image(image)
+            if image_url != recipe.image_url:
+                if recipe.image_url and image_exists(recipe.image_url):
+                    delete_image(recipe.image_url)
+                recipe.image_url = image_url
 
 
 def update_modified_recipe(recipe, instructions, ingredients, extended_desc):
     """Update the modified recipe with the proposed new version.
 
     Checks whether the data has changed before updating.
+    Nothing is committed, see commit_recipe_changes().
 
     Args:
         recipe (Recipe): The recipe to be updated.
@@ -465,32 +950,52 @@ def update_modified_recipe(recipe, instructions, ingredients, extended_desc):
         recipe.ingredients = ingredients
     if instructions != recipe.instructions:
         recipe.instructions = instructions
-    db.session.add(recipe)
-    db.session.commit()
 
 
 def update_dietary_tags(recipe, new_dietary_tags_data):
     """Update the dietary tags of a recipe in the db with proposed new version.
 
     Checks whether the data is different to what's already in the db before updating.
+    Nothing is committed, see commit_recipe_changes().
 
     Args:
         recipe (Recipe): The recipe object to update the dietary tags for.
         new_dietary_tags_data (str): The new dietary tags data to update the recipe with.
 
     """
-    dietary_tags = DietaryTags.query.get(recipe.dietary_tags_id)
     dietart_tag_data = dietary_tag_bools_to_data(
         get_recipe_dietary_tags_bools(recipe))
     if dietart_tag_data != new_dietary_tags_data:
+        # Already loaded by hydrate_recipes(), so this doesn't query the database
+        dietary_tags = recipe.dietary_tags
         dietary_tags.is_vegan = "vv" in new_dietary_tags_data
         dietary_tags.is_vegetarian = "v" in new_dietary_tags_data
         dietary_tags.is_gluten_free = "gf" in new_dietary_tags_data
         dietary_tags.is_dairy_free = "df" in new_dietary_tags_data
         dietary_tags.is_nut_free = "nf" in new_dietary_tags_data
         dietary_tags.is_egg_free = "ef" in new_dietary_tags_data
-        db.session.add(dietary_tags)
-        db.session.commit()
+        recipe.dietary_mask = dietary_tag_data_to_mask(new_dietary_tags_data)
+
+
+def commit_recipe_changes(recipe):
+    """Commits the changes to a recipe and its dietary tags in a single transaction.
+
+    Use after update_recipe() or update_modified_recipe() and update_dietary_tags().
+    If nothing changed, nothing is written and there's no commit.
+
+    Args:
+        recipe (Recipe): The recipe or modified recipe that was updated.
+
+    Returns:
+        bool: True if there were changes to commit.
+    """
+    if not db.session.is_modified(recipe) and not (
+            "dietary_tags" not in inspect(recipe).unloaded
+            and db.session.is_modified(recipe.dietary_tags)):
+        return False
+    recipe.updated_at = datetime.utcnow()
+    db.session.commit()
+    return True
 
 
 def is_user_admin(user_id):
@@ -505,3 +1010,40 @@ def is_user_admin(user_id):
 
     return User.query.filter_by(id=user_id,
                                 user_type=UserType.ADMIN.value).first() is not None
+
+
+def is_current_user_admin():
+    """Check if the logged in user is an admin, without querying the database.
+
+    Returns:
+        bool: True if the current user is logged in and an admin else false.
+    """
+    return (current_user.is_authenticated
+            and current_user.user_type == UserType.ADMIN.value)
+
+
+def create_default_admin():
+    """Creates the admin user with the default password, if there's no admin yet.
+
+    Admins that still have the default password are flagged, so they're asked to
+    change it when they log in. Run by the "create-admin" command, not per request,
+    as checking a password with bcrypt is slow on purpose.
+
+    Returns:
+        User: The admin user created, or None if there already was one.
+    """
+    admins = User.query.filter_by(user_type=UserType.ADMIN.value).all()
+    if not admins:
+        admin = User(username="admin", password=hash_password(
+            DEFAULT_ADMIN_PASSWORD), user_type=UserType.ADMIN.value,
+            must_change_password=True)
+        db.session.add(admin)
+        db.session.commit()
+        return admin
+
+    for admin in admins:
+        if (not admin.must_change_password
+                and check_password(admin.password, DEFAULT_ADMIN_PASSWORD)):
+            admin.must_change_password = True
+    db.session.commit()
+    return None
@@ -0,0 +1,278 @@
+"""
+Contains the image processing for My Recipe.
+
+Recipe cards only need small images, so each uploaded image also gets downscaled
+WebP variants at the widths in IMAGE_VARIANT_WIDTHS. Templates offer them with srcset.
+
+Images saved locally have their variants created with Pillow, with metadata stripped.
+If Pillow isn't installed, images are stored without variants.
+Images uploaded to Cloudinary have their variants created by Cloudinary at upload time.
+
+Stored images are recorded in the stored_images table, so image_exists() can check
+the registry instead of asking Cloudinary. The registry is kept up to date as images
+are saved and deleted, and can be reconciled with the storage by "reconcile-images".
+
+Images saved locally are served by send_image(). Images named by their content hash
+never change, so browsers may cache them for a year without checking back.
+The file is sent with the server's sendfile support, or left to a front proxy
+when IMAGE_PROXY_HEADER is set.
+"""
+
+import os
+import re
+from datetime import datetime
+from urllib.parse import quote
+from flask import request
+from werkzeug.utils import send_from_directory
+from myrecipe import app, db
+from myrecipe.models import StoredImage
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+IMAGE_VARIANT_WIDTHS = [320, 640, 1024]
+VARIANT_SUFFIX = re.compile(r"-\d+w\.webp$")
+# Images and variants named by the SHA-256 of their content
+IMMUTABLE_IMAGE_NAME = re.compile(r"^[0-9a-f]{64}(-\d+w)?\.\w+$")
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def get_upload_folder_path():
+    """Returns the path of the folder where images are saved locally."""
+    return app.config["PACKAGE_NAME"] + "/" + app.config['UPLOAD_FOLDER']
+
+
+def is_immutable_image_name(filename):
+    """Returns bool: True if the image is named by its content hash, so it never changes."""
+    return IMMUTABLE_IMAGE_NAME.match(filename) is not None
+
+
+def send_image(filename):
+    """Sends a locally saved image, to be shown inline.
+
+    Images named by their content hash are cached for a year, with the hash as their ETag.
+    Other images must be revalidated, with an ETag from their modification time and size.
+    Conditional and Range requests are supported.
+
+    With IMAGE_PROXY_HEADER set to "X-Sendfile" or "X-Accel-Redirect", the response
+    only names the file and the front proxy sends it, handling Range requests itself.
+
+    Args:
+        filename (str): The name of the image file in the UPLOAD_FOLDER.
+
+    Returns:
+        Response: The image, or 304 Not Modified. Raises NotFound if it doesn't exist.
+    """
+    immutable = is_immutable_image_name(filename)
+    proxy_header = app.config["IMAGE_PROXY_HEADER"]
+    response = send_from_directory(
+        os.path.join(app.root_path, app.config["UPLOAD_FOLDER"]), filename,
+        request.environ,
+        etag=os.path.splitext(filename)[0] if immutable else True,
+        max_age=IMMUTABLE_MAX_AGE if immutable else None,
+        use_x_sendfile=bool(proxy_header),
+        conditional=not proxy_header,
+        response_class=app.response_class)
+    if immutable:
+        response.cache_control.immutable = True
+
+    if proxy_header:
+        if proxy_header == "X-Accel-Redirect":
+            response.headers.pop("X-Sendfile")
+            response.headers["X-Accel-Redirect"] = (
+                app.config["IMAGE_ACCEL_REDIRECT_PREFIX"] + quote(filename))
+        # Only answer 304s here, so Range requests reach the proxy
+        response.make_conditional(request.environ)
+        if response.status_code == 304:
+            response.headers.pop(proxy_header, None)
+    return response
+
+
+def get_image_backend(image_url):
+    """Returns where the image is stored, "local" or "cloudinary"."""
+    if image_url.startswith("/" + app.config["UPLOAD_FOLDER"] + "/"):
+        return "local"
+    return "cloudinary"
+
+
+def register_image(image_url, size=None):
+    """Records a stored image in the registry, or refreshes its record.
+
+    The record is added to the session and saved when the session commits.
+
+    Args:
+        image_url (str): The URL of the image.
+        size (int): The size of the image in bytes, if known.
+    """
+    record = db.session.get(StoredImage, image_url)
+    if record is None:
+        record = StoredImage(image_url=image_url, backend=get_image_backend(image_url))
+        db.session.add(record)
+    if size is not None:
+        record.size = size
+    record.checked_at = datetime.utcnow()
+
+
+def unregister_image(image_url):
+    """Removes a deleted image from the registry, when the session commits.
+
+    Args:
+        image_url (str): The URL of the image.
+    """
+    record = db.session.get(StoredImage, image_url)
+    if record is not None:
+        db.session.delete(record)
+
+
+def get_variant_name(filename, width):
+    """Returns the filename of an image's variant, e.g. "pizza.jpg" -> "pizza-320w.webp"."""
+    return f"{os.path.splitext(filename)[0]}-{width}w.webp"
+
+
+def is_variant_name(filename):
+    """Returns bool: True if the filename is of an image variant."""
+    return VARIANT_SUFFIX.search(filename) is not None
+
+
+def create_image_variants(path):
+    """Creates the downscaled WebP variants of a locally saved image.
+
+    Variants are only created for widths smaller than the image.
+    The image is rotated to match its EXIF orientation, then the variants are
+    saved without any of its metadata.
+    Images Pillow can't read are left without variants.
+
+    Args:
+        path (str): The path of the saved image.
+
+    Returns:
+        list: The widths of the variants created.
+    """
+    if Image is None:
+        return []
+
+    widths = []
+    try:
+        with Image.open(path) as image:
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+
+            for width in IMAGE_VARIANT_WIDTHS:
+                if width >= image.width:
+                    break
+                height = round(image.height * width / image.width)
+                variant = image.resize((width, height), Image.LANCZOS)
+                variant_path = os.path.join(os.path.dirname(path),
+                                            get_variant_name(os.path.basename(path), width))
+                variant.save(variant_path, "WEBP", quality=80, method=4)
+                widths.append(width)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        # The image is kept and shown as uploaded, just without variants
+        app.logger.warning("Couldn't create variants of %s.", path, exc_info=True)
+        delete_image_variants(path)
+        return []
+    return widths
+
+
+def is_readable_image(file):
+    """Checks that an uploaded file is an image Pillow can read, e.g. not a text file named .png.
+
+    Args:
+        file: The uploaded file. It's rewound after being checked.
+
+    Returns:
+        bool: True if it's an image, or if Pillow isn't installed to check.
+    """
+    if Image is None:
+        return True
+    position = file.tell()
+    try:
+        with Image.open(file) as image:
+            image.verify()
+        return True
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError):
+        return False
+    finally:
+        file.seek(position)
+
+
+def delete_image_variants(path):
+    """Deletes the variants of a locally saved image.
+
+    Args:
+        path (str): The path of the saved image.
+    """
+    for width in IMAGE_VARIANT_WIDTHS:
+        variant_path = os.path.join(os.path.dirname(path),
+                                    get_variant_name(os.path.basename(path), width))
+        if os.path.exists(variant_path):
+            os.remove(variant_path)
+
+
+def get_cloudinary_variant_options():
+    """Returns the Cloudinary "eager" transformations that create the image variants."""
+    return [{"width": width, "crop": "limit", "format": "webp", "quality": "auto"}
+            for width in IMAGE_VARIANT_WIDTHS]
+
+
+def get_cloudinary_variant_url(image_url, width):
+    """Returns the Cloudinary URL of an image's variant.
+
+    Must match the transformations from get_cloudinary_variant_options().
+    """
+    url = image_url.replace("/upload/", f"/upload/c_limit,f_webp,q_auto,w_{width}/", 1)
+    return os.path.splitext(url)[0] + ".webp"
+
+
+@app.template_global()
+def image_srcset(image_url):
+    """Returns the srcset attribute value for a recipe image.
+
+    Used by the templates, e.g. srcset="{{ image_srcset(recipe.image_url) }}".
+
+    Args:
+        image_url (str): The URL of the original image.
+
+    Returns:
+        str: The variant URLs with their widths, or an empty string if there are none.
+    """
+    if not image_url:
+        return ""
+
+    if image_url.startswith("http"):
+        return ", ".join(f"{get_cloudinary_variant_url(image_url, width)} {width}w"
+                         for width in IMAGE_VARIANT_WIDTHS)
+
+    folder, filename = image_url.rsplit("/", 1)
+    sources = []
+    for width in IMAGE_VARIANT_WIDTHS:
+        variant_name = get_variant_name(filename, width)
+        if os.path.isfile(os.path.join(get_upload_folder_path(), variant_name)):
+            sources.append(f"{folder}/{variant_name} {width}w")
+    return ", ".join(sources)
+
+
+def backfill_image_variants():
+    """Creates the missing variants of every image saved locally.
+
+    Returns:
+        int: The number of images that had variants created.
+    """
+    folder = get_upload_folder_path()
+    if not os.path.isdir(folder):
+        return 0
+
+    count = 0
+    for filename in sorted(os.listdir(folder)):
+        path = os.path.join(folder, filename)
+        # Skip variants and temporary files of uploads in progress
+        if is_variant_name(filename) or filename.startswith(".") or not os.path.isfile(path):
+            continue
+        missing = [width for width in IMAGE_VARIANT_WIDTHS if not os.path.isfile(
+            os.path.join(folder, get_variant_name(filename, width)))]
+        if missing and create_image_variants(path):
+            count += 1
+    return count
@@ -10,11 +10,15 @@ Classes:
     ModifiedRecipe: Represents the modified_recipes table in SQL.
     DietaryTags: Represents the dietary_tags table in SQL.
     SavedRecipe: Represents the saved_recipes table in SQL.
+    StoredImage: Represents the stored_images table in SQL.
+    ImportJob: Represents the import_jobs table in SQL.
 
 The attributes in each class represent the columns in the table.
 """
 
+from datetime import datetime
 from flask_login import UserMixin
+from sqlalchemy import false
 from myrecipe import db
 
 
@@ -26,6 +30,7 @@ class User(db.Model, UserMixin):
         username (str)
         password (str)
         user_type (str): Type/role of user (e.g., admin, standard user).
+        must_change_password (bool): True if the user still has a default password.
         
         recipes (relationship): Recipes created by user.
         saved_recipes (relationship): Users saved recipes.
@@ -39,6 +44,8 @@ class User(db.Model, UserMixin):
     username = db.Column(db.String(20), unique=True, nullable=False)
     password = db.Column(db.String(), nullable=False)
     user_type = db.Column(db.String(20), nullable=False)
+    must_change_password = db.Column(db.Boolean, nullable=False, default=False,
+                                     server_default=false())
 
     recipes = db.relationship("Recipe", backref="user", cascade="all, delete")
     saved_recipes = db.relationship(
@@ -62,6 +69,8 @@ class Recipe(db.Model):
         instructions (str): Recipe instructions.
         image_url (str): Recipe image URL.
         dietary_tags_id (int): Foreign key - the recipe's dietary tags.
+        dietary_mask (int): The recipe's dietary tags as a bitmask, for filtering in SQL.
+        updated_at (datetime): When the recipe was created or last edited (UTC).
         
         saved_recipes (relationship): SavedRecipe entries associated with the recipe.
         recipe_copies (relationship): Modified recipes based on the recipe.
@@ -72,22 +81,27 @@ class Recipe(db.Model):
     """
     __tablename__ = "recipes"
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False, index=True)
     title = db.Column(db.String(40), nullable=False)
     desc = db.Column(db.String(200), nullable=False)
     ingredients = db.Column(db.String(500), nullable=False)
     instructions = db.Column(db.String(1000), nullable=False)
     image_url = db.Column(db.String(300), nullable=True)
     dietary_tags_id = db.Column(db.Integer, db.ForeignKey(
-        "dietary_tags.id"), nullable=False)
+        "dietary_tags.id"), nullable=False, index=True)
+    dietary_mask = db.Column(db.Integer, nullable=False, default=0,
+                             server_default="0", index=True)
+    updated_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
 
     saved_recipes = db.relationship(
         "SavedRecipe", backref="recipe", cascade="all, delete")
     recipe_copies = db.relationship(
         "ModifiedRecipe", backref="original_recipe", cascade="all, delete")
 
+    # passive_deletes stops deleting the dietary tags from loading their recipes back
     dietary_tags = db.relationship(
-        "DietaryTags", backref="recipe", cascade="all, delete")
+        "DietaryTags", backref=db.backref("recipe", passive_deletes=True),
+        cascade="all, delete")
 
     def __repr__(self):
         return f"{self.title} [ID: {self.id}]"
@@ -104,6 +118,8 @@ class ModifiedRecipe(db.Model):
         ingredients (str): The modified ingredients.
         instructions (str): The modified instructions.
         dietary_tags_id (int): Foreign key - The modified recipe's dietary tags.
+        dietary_mask (int): The modified recipe's dietary tags as a bitmask, for filtering in SQL.
+        updated_at (datetime): When the modified recipe was created or last edited (UTC).
         dietary_tags (relationship): DietaryTags associated with the recipe.
 
     Methods:
@@ -112,19 +128,23 @@ class ModifiedRecipe(db.Model):
     __tablename__ = "modified_recipes"
     id = db.Column(db.Integer, primary_key=True)
     modified_by_id = db.Column(
-        db.Integer, db.ForeignKey("users.id"), nullable=False)
+        db.Integer, db.ForeignKey("users.id"), nullable=False, index=True)
 
     recipe_id = db.Column(db.Integer, db.ForeignKey(
-        "recipes.id"), nullable=False)
+        "recipes.id"), nullable=False, index=True)
 
     extended_desc = db.Column(db.String(100), nullable=False)
     ingredients = db.Column(db.String(500), nullable=False)
     instructions = db.Column(db.String(1000), nullable=False)
     dietary_tags_id = db.Column(db.Integer, db.ForeignKey(
-        "dietary_tags.id"), nullable=False)
+        "dietary_tags.id"), nullable=False, index=True)
+    dietary_mask = db.Column(db.Integer, nullable=False, default=0,
+                             server_default="0", index=True)
+    updated_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
 
     dietary_tags = db.relationship(
-        "DietaryTags", backref="modified_recipe", cascade="all, delete")
+        "DietaryTags", backref=db.backref("modified_recipe", passive_deletes=True),
+        cascade="all, delete")
 
     def __repr__(self):
         return f'{self.original_recipe.title} (Modified recipe) [ID: {self.id}]'
@@ -134,6 +154,7 @@ class DietaryTags(db.Model):
     """Represents dietary tags in SQL.
     
     To be associated with a recipe.
+    The recipe also stores the tags as a bitmask, see dietary_tag_data_to_mask().
 
     Attributes:
         id (int): Primary key.
@@ -166,13 +187,61 @@ class DietaryTags(db.Model):
 class SavedRecipe(db.Model):
     """Represents a saved recipe.
 
+    A user can only save a recipe once, which a unique index enforces.
+
     Attributes:
         id (int): Primary key.
         user_id (int): Foreign key - the user who saved the recipe.
         recipe_id (int): Foreign key - the recipe that's saved.
     """
     __tablename__ = "saved_recipes"
+    __table_args__ = (db.Index("ix_saved_recipes_user_id_recipe_id",
+                               "user_id", "recipe_id", unique=True),)
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
     recipe_id = db.Column(db.Integer, db.ForeignKey(
-        "recipes.id"), nullable=False)
+        "recipes.id"), nullable=False, index=True)
+
+
+class StoredImage(db.Model):
+    """Represents an image stored locally or on Cloudinary.
+
+    A registry of the stored images, so checking whether an image exists
+    doesn't need a call to Cloudinary. Identical images share a URL,
+    so there's one row per URL however many recipes use it.
+
+    Attributes:
+        image_url (str): Primary key - the image URL, as stored in Recipe.image_url.
+        backend (str): Where the image is stored, "local" or "cloudinary".
+        size (int): The size of the image in bytes, if known.
+        checked_at (datetime): When the image was stored or last found in its backend (UTC).
+    """
+    __tablename__ = "stored_images"
+    image_url = db.Column(db.String(300), primary_key=True)
+    backend = db.Column(db.String(20), nullable=False)
+    size = db.Column(db.Integer, nullable=True)
+    checked_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"{self.backend} image {self.image_url}"
+
+
+class ImportJob(db.Model):
+    """Represents a bulk import of recipes, so it can resume after a failure.
+
+    Updated in the same commit as each batch of imported rows.
+
+    Attributes:
+        name (str): Primary key - the name of the import, by default its file name.
+        rows_done (int): How many rows of the file have been committed, counting skipped rows.
+        finished (bool): True once the whole file has been imported.
+        updated_at (datetime): When the last batch was committed (UTC).
+    """
+    __tablename__ = "import_jobs"
+    name = db.Column(db.String(300), primary_key=True)
+    rows_done = db.Column(db.Integer, nullable=False, default=0)
+    finished = db.Column(db.Boolean, nullable=False, default=False, server_default=false())
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"Import {self.name} - {self.rows_done} rows"
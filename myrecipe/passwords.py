@@ -0,0 +1,113 @@
+"""
+Contains the password hashing for My Recipe.
+
+Passwords are hashed with bcrypt at the cost set by BCRYPT_LOG_ROUNDS.
+Hashes made at a different cost are rehashed when their user next logs in.
+
+bcrypt is slow on purpose, so with PASSWORD_HASH_WORKERS set, hashing runs on a pool
+of that many threads. A burst of logins or sign-ups then uses at most that many cores,
+leaving the rest for serving pages. If no thread is free within PASSWORD_HASH_TIMEOUT
+seconds, the request fails with 503 Service Unavailable.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import abort
+from myrecipe import app, bcrypt
+
+executor = None
+executor_slots = None
+executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Returns the hashing thread pool and the semaphore bounding its queue.
+
+    Returns:
+        tuple: (ThreadPoolExecutor, BoundedSemaphore), or (None, None) if hashing runs inline.
+    """
+    global executor, executor_slots
+    workers = app.config["PASSWORD_HASH_WORKERS"]
+    if workers <= 0:
+        return None, None
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=workers,
+                                          thread_name_prefix="password-hash")
+            # Allow a queue as long as the pool, so waiting requests are bounded too
+            executor_slots = threading.BoundedSemaphore(workers * 2)
+        return executor, executor_slots
+
+
+def run_hashing(function, *args):
+    """Runs a bcrypt function inline or on the hashing thread pool.
+
+    Args:
+        function (callable): The bcrypt function.
+        *args: Its arguments.
+
+    Returns:
+        The function's result.
+    """
+    pool, slots = get_executor()
+    if pool is None:
+        return function(*args)
+    if not slots.acquire(timeout=app.config["PASSWORD_HASH_TIMEOUT"]):
+        abort(503, "Too many people are logging in right now. Please try again shortly.")
+    try:
+        return pool.submit(function, *args).result()
+    finally:
+        slots.release()
+
+
+def hash_password(password, rounds=None):
+    """Hashes a password with bcrypt.
+
+    Args:
+        password (str): The password to hash.
+        rounds (int): The bcrypt cost. Defaults to BCRYPT_LOG_ROUNDS.
+
+    Returns:
+        str: The password hash.
+    """
+    rounds = rounds or app.config["BCRYPT_LOG_ROUNDS"]
+    return run_hashing(bcrypt.generate_password_hash, password, rounds).decode("utf-8")
+
+
+def check_password(password_hash, password):
+    """Returns bool: True if the password matches the hash."""
+    return run_hashing(bcrypt.check_password_hash, password_hash, password)
+
+
+def get_hash_rounds(password_hash):
+    """Returns int: The bcrypt cost of a hash, e.g. 12 for "$2b$12$...", or None if unknown."""
+    try:
+        return int(password_hash.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def password_needs_rehash(password_hash):
+    """Returns bool: True if the hash wasn't made at the current BCRYPT_LOG_ROUNDS."""
+    return get_hash_rounds(password_hash) != app.config["BCRYPT_LOG_ROUNDS"]
+
+
+def benchmark_hashing(rounds, seconds=1.0):
+    """Measures how many passwords a single thread can hash per second at a bcrypt cost.
+
+    Args:
+        rounds (int): The bcrypt cost.
+        seconds (float): How long to keep hashing for.
+
+    Returns:
+        float: Hashes per second.
+    """
+    count = 0
+    start = time.perf_counter()
+    while True:
+        bcrypt.generate_password_hash("benchmark-password", rounds)
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return count / elapsed
@@ -0,0 +1,177 @@
+"""
+Contains the SQL query guard for My Recipe.
+
+With QUERY_GUARD set to "warn" or "raise", the SQL statements each request runs
+are counted with SQLAlchemy engine events. Once the view returns, the request is checked for:
+
+    More statements than the view's budget, declared with @query_budget.
+    The same statement run QUERY_GUARD_REPEAT_LIMIT or more times with different
+    parameters, the signature of an N+1 query, e.g. loading each recipe's user in a loop.
+
+"warn" logs a warning for each problem found. "raise" raises QueryBudgetExceeded,
+which fails the request, and with TESTING set, the test that made it.
+
+A budget is the most statements a view may run however many recipes there are.
+Budgets include loading the logged in user, which the user cache usually saves.
+
+count_queries() counts the statements run by a block of code, for use in tests.
+"""
+
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from myrecipe import app
+
+# The most SQL statements each view may run, keyed by endpoint
+QUERY_BUDGETS = {}
+
+active_counters = threading.local()
+listener_lock = threading.Lock()
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised when QUERY_GUARD is "raise" and a request runs too many SQL statements."""
+
+
+class QueryCounter:
+    """Counts the SQL statements run on a thread.
+
+    Attributes:
+        count (int): The number of statements run.
+        statements (Counter): How many times each statement was run. Statements are
+            compared without their parameters, so the same query for different rows matches.
+        parameters (defaultdict): The distinct parameters each statement was run with.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.statements = Counter()
+        self.parameters = defaultdict(set)
+
+    def add(self, statement, parameters=None):
+        """Records a statement being run, with its parameters."""
+        self.count += 1
+        self.statements[statement] += 1
+        # Parameters may be lists or dicts, which can't go in a set
+        self.parameters[statement].add(repr(parameters))
+
+    def get_repeated(self, limit):
+        """Returns dict: The statements run at least limit times with different parameters,
+        with how many times.
+
+        Running the very same query again, e.g. a count before and after a change,
+        isn't a query in a loop, so statements always run with the same parameters are left out.
+        """
+        return {statement: times for statement, times in self.statements.items()
+                if times >= limit and len(self.parameters[statement]) > 1}
+
+
+def get_active_counters():
+    """Returns list: The counters counting this thread's statements."""
+    if not hasattr(active_counters, "stack"):
+        active_counters.stack = []
+    return active_counters.stack
+
+
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    """Engine event: adds a statement to this thread's active counters."""
+    for counter in get_active_counters():
+        counter.add(statement, parameters)
+
+
+def listen_for_statements():
+    """Starts counting statements on every engine. Does nothing if already counting."""
+    with listener_lock:
+        if not event.contains(Engine, "before_cursor_execute", count_statement):
+            event.listen(Engine, "before_cursor_execute", count_statement)
+
+
+@contextmanager
+def count_queries():
+    """Counts the SQL statements run by a block of code on this thread.
+
+    For example, in a test:
+
+        with count_queries() as counter:
+            client.get("/")
+        assert counter.count <= QUERY_BUDGETS["home"]
+
+    Yields:
+        QueryCounter: The counter, complete once the block ends.
+    """
+    listen_for_statements()
+    counter = QueryCounter()
+    get_active_counters().append(counter)
+    try:
+        yield counter
+    finally:
+        get_active_counters().remove(counter)
+
+
+def query_budget(max_queries):
+    """Decorator: declares the most SQL statements a view may run.
+
+    The budget is looked up by endpoint, which is the view function's name,
+    so it can go anywhere in the view's decorators.
+
+    Args:
+        max_queries (int): The most statements the view may run in one request.
+    """
+    def decorator(view):
+        QUERY_BUDGETS[view.__name__] = max_queries
+        return view
+    return decorator
+
+
+def start_counting_request():
+    """Starts counting the current request's SQL statements."""
+    g.query_counter = QueryCounter()
+    get_active_counters().append(g.query_counter)
+
+
+def check_request_queries(response):
+    """Checks the current request's SQL statements against its budget and for N+1 queries.
+
+    Statements run after the view returns, e.g. while streaming a response, aren't checked.
+
+    Returns:
+        Response: The response, unchanged. Raises QueryBudgetExceeded in "raise" mode.
+    """
+    counter = g.get("query_counter")
+    # Only check once, not again for the error page if the check fails
+    if counter is None or g.get("queries_checked"):
+        return response
+    g.queries_checked = True
+
+    problems = []
+    budget = QUERY_BUDGETS.get(request.endpoint)
+    if budget is not None and counter.count > budget:
+        problems.append(f"{request.method} {request.path} ({request.endpoint}) ran "
+                        f"{counter.count} SQL statements, over its budget of {budget}.")
+    for statement, times in counter.get_repeated(
+            app.config["QUERY_GUARD_REPEAT_LIMIT"]).items():
+        problems.append(f"{request.method} {request.path} ({request.endpoint}) ran the same "
+                        f"statement {times} times, a likely N+1 query: {statement}")
+
+    if problems and app.config["QUERY_GUARD"] == "raise":
+        raise QueryBudgetExceeded("\n".join(problems))
+    for problem in problems:
+        app.logger.warning(problem)
+    return response
+
+
+def stop_counting_request(exception):
+    """Stops counting the current request's SQL statements."""
+    counter = g.pop("query_counter", None)
+    if counter is not None and counter in get_active_counters():
+        get_active_counters().remove(counter)
+
+
+if app.config["QUERY_GUARD"]:
+    listen_for_statements()
+    app.before_request(start_counting_request)
+    app.after_request(check_request_queries)
+    app.teardown_request(stop_counting_request)
@@ -15,12 +15,17 @@ Functions:
     view_modified_recipe(recipe_id): Route for page to view a modified recipe.
     add_recipe(): Route for page to add a recipe.
     add_modified_recipe(recipe_id): Route for page to add a modified recipe.
+    cache_stats(): Route for the page cache statistics.
+    export_recipes_file(file_format): Route for the streamed recipe export.
+
+Each route declares the most SQL statements it may run with @query_budget,
+checked when QUERY_GUARD is set (see queries.py).
 """
 
 import os
 from datetime import datetime
 from flask import (url_for, redirect, render_template,
-                   request, send_from_directory, flash)
+                   request, flash, jsonify, abort, Response, stream_with_context)
 from flask_login import (login_user, logout_user,
                          current_user, login_required)
 from sqlalchemy import null
@@ -29,18 +34,25 @@ import cloudinary
 import cloudinary.uploader
 import cloudinary.api
 
-from myrecipe import db, app, UserType, bcrypt, DEFAULT_ADMIN_PASSWORD, login_manager
+from myrecipe import db, app, UserType, login_manager
 from myrecipe.models import User, Recipe, ModifiedRecipe, SavedRecipe
-from myrecipe.helpers import (get_all_recipes, add_created_by_to_recipes,
-                              add_dietary_tags_to_recipes, get_user,
-                              user_owns_recipe, is_user_admin, save_image,
-                              has_user_saved_recipe, get_modified_recipe,
+from myrecipe.helpers import (get_recipe_feed, hydrate_recipes,
+                              get_user, user_owns_recipe, is_current_user_admin, save_image,
+                              has_user_saved_recipe, set_recipe_saved, get_modified_recipe,
                               is_modified_recipe, update_modified_recipe,
-                              update_recipe, update_dietary_tags,
+                              update_recipe, update_dietary_tags, commit_recipe_changes,
                               delete_image, search_all_recipes,
                               dietary_tag_bools_to_data, get_recipe_dietary_tags_bools,
                               set_form_dietary_tags, dietary_tag_data_to_names,
-                              add_dietary_tags_to_db, get_recipe, image_exists)
+                              dietary_tag_data_to_mask, create_dietary_tags,
+                              get_recipe, get_recipe_for_delete, image_exists)
+from myrecipe.cache import (page_cache, cache_anonymous_page, add_page_cache_tags,
+                            conditional_recipe_page, load_cached_user)
+from myrecipe.uploads import queue_image_upload
+from myrecipe.images import send_image
+from myrecipe.passwords import hash_password, password_needs_rehash
+from myrecipe.bulk import export_recipes, EXPORT_MIMETYPES
+from myrecipe.queries import query_budget
 # Import wtforms
 from myrecipe.forms import (RegistrationForm, LoginForm,
                             AddRecipeForm, AddModifiedRecipeForm,
@@ -56,7 +68,7 @@ if not app.config["SAVE_IMAGES_LOCALLY"]:
 
 @login_manager.user_loader
 def load_user(user_id):
-    """Used by login manager to load the user from the database.
+    """Used by login manager to load the user from the user cache or the database.
 
     Args:
         user_id (int): The ID of the user to load.
@@ -64,7 +76,7 @@ def load_user(user_id):
     Returns:
         User: The user.
     """
-    return User.query.get(int(user_id))
+    return load_cached_user(int(user_id))
 
 
 @app.context_processor
@@ -77,27 +89,33 @@ def inject_date():
 
 # Homepage
 @app.route("/")
+@query_budget(5)
+@cache_anonymous_page
 def home():
     """View the homepage.
 
+    Shows one page of the recipe feed, starting after the "after" cursor in the URL.
+
     Returns:
         Rendered template: The homepage.
     """
+    add_page_cache_tags("feed")
     search_form = SearchForm()
-    recipes = get_all_recipes()
-    add_created_by_to_recipes(recipes)
-    add_dietary_tags_to_recipes(recipes)
-    return render_template("index.html", recipes=recipes, search_form=search_form)
+    recipes, next_cursor = get_recipe_feed(request.args.get("after"))
+    hydrate_recipes(recipes)
+    return render_template("index.html", recipes=recipes, next_cursor=next_cursor,
+                           search_form=search_form)
 
 
 # Login user
 @app.route("/login", methods=["GET", "POST"])
+@query_budget(2)
 def login():
     """Logs in the user
 
     If the user is already logged in, it redirects to the homepage.
-    If there is no admin user, it creates an admin user with default password.
-    If the login form is  valid, it logs the user in and redirects to the homepage.
+    If the login form is  valid, it logs the user in and redirects to the homepage,
+    or to the profile page if they still have to change a default password.
 
     Returns:
         Rendered template: The homempage if successful.
@@ -105,20 +123,17 @@ def login():
     if current_user.is_authenticated:
         return redirect(url_for("home"))
 
-    if User.query.filter_by(user_type=UserType.ADMIN.value).first() is None:
-        admin = User(username="admin", password=bcrypt.generate_password_hash(
-            DEFAULT_ADMIN_PASSWORD).decode("utf-8"), user_type=UserType.ADMIN.value)
-        db.session.add(admin)
-        db.session.commit()
-
     form = LoginForm()
 
     if request.method == "POST":
-        user = get_user(request.form.get("username"))
         if form.validate_on_submit():
+            user = form.user
+            if password_needs_rehash(user.password):
+                # Upgrade the hash to the current bcrypt cost while we have the password
+                user.password = hash_password(form.password.data)
+                db.session.commit()
             login_user(user)
-            if (user.user_type == UserType.ADMIN.value
-                    and bcrypt.check_password_hash(user.password, DEFAULT_ADMIN_PASSWORD)):
+            if user.must_change_password:
                 flash("Please change the admin password from default.", "danger")
                 return redirect(url_for("profile"))
             flash(f"Welcome back, {user.username}!", "success")
@@ -128,6 +143,7 @@ def login():
 
 # Logout user
 @app.route("/logout", methods=["GET", "POST"])
+@query_budget(1)
 @login_required
 def logout():
     """Logs user out.
@@ -141,6 +157,7 @@ def logout():
 
 # Register user
 @app.route("/register", methods=["GET", "POST"])
+@query_budget(2)
 def register():
     """Register a new user.
 
@@ -158,8 +175,7 @@ def register():
         if form.validate_on_submit():
             username = form.username.data
             password = form.password.data
-            encrypted_pass = bcrypt.generate_password_hash(
-                password).decode("utf-8")
+            encrypted_pass = hash_password(password)
             user = User(username=username,
                         password=encrypted_pass, user_type=UserType.STANDARD.value)
             db.session.add(user)
@@ -171,6 +187,7 @@ def register():
 
 # Profile
 @app.route("/profile", methods=["GET", "POST"])
+@query_budget(3)
 @login_required
 def profile():
     """View the current user's profile page.
@@ -185,8 +202,8 @@ def profile():
 
     if request.method == "POST":
         if form.validate_on_submit():
-            user.password = bcrypt.generate_password_hash(
-                form.new_password.data).decode("utf-8")
+            user.password = hash_password(form.new_password.data)
+            user.must_change_password = False
             db.session.add(user)
             db.session.commit()
             flash("Password updated.", "success")
@@ -195,21 +212,25 @@ def profile():
 
 # My recipes
 @app.route("/my-recipes")
+@query_budget(8)
 @login_required
 def my_recipes():
-    """View all recipes created by the current user.
+    """View the recipes created and modified by the current user, a page at a time.
 
     Returns:
         Rendered template: The my recipes page.
     """
-    recipes = [recipe for recipe in get_all_recipes()
-               if user_owns_recipe(current_user.id, recipe)]
-    add_created_by_to_recipes(recipes)
-    return render_template("my-recipes.html", recipes=recipes)
+    recipes, next_cursor = get_recipe_feed(request.args.get("after"),
+                                           user_id=current_user.id)
+    hydrate_recipes(recipes)
+    return render_template("my-recipes.html", recipes=recipes, next_cursor=next_cursor)
 
 
 # View recipe
 @app.route("/recipe/<int:recipe_id>", methods=["GET", "POST"])
+@query_budget(7)
+@conditional_recipe_page()
+@cache_anonymous_page
 def view_recipe(recipe_id):
     """View recipe page.
 
@@ -219,14 +240,12 @@ def view_recipe(recipe_id):
     Returns:
         Rendered template: The recipe page.
     """
-    recipe_is_saved = has_user_saved_recipe(
-        current_user.id, recipe_id) if current_user.is_authenticated else False
     recipe = Recipe.query.get(recipe_id)
-    add_created_by_to_recipes([recipe])
-    add_dietary_tags_to_recipes([recipe])
+    hydrate_recipes([recipe])
+    recipe_is_saved = recipe.is_saved if current_user.is_authenticated else False
+    add_page_cache_tags(f"recipe:{recipe_id}")
 
-    is_admin = is_user_admin(
-        current_user.id) if current_user.is_authenticated else False
+    is_admin = is_current_user_admin()
 
     return render_template("view-recipe.html",
                            recipe=recipe,
@@ -236,6 +255,9 @@ def view_recipe(recipe_id):
 
 # View modified recipe
 @app.route("/modified-recipe/<int:recipe_id>", methods=["GET", "POST"])
+@query_budget(7)
+@conditional_recipe_page(get_modified=True)
+@cache_anonymous_page
 def view_modified_recipe(recipe_id):
     """View modified recipe page.
 
@@ -246,11 +268,10 @@ def view_modified_recipe(recipe_id):
         Rendered template: The recipe page.
     """
     recipe = get_modified_recipe(recipe_id)
-    add_dietary_tags_to_recipes([recipe])
-    add_created_by_to_recipes([recipe])
+    hydrate_recipes([recipe])
+    add_page_cache_tags(f"modified:{recipe_id}", f"recipe:{recipe.recipe_id}")
 
-    is_admin = is_user_admin(
-        current_user.id) if current_user.is_authenticated else False
+    is_admin = is_current_user_admin()
 
     return render_template("view-recipe.html",
                            recipe=recipe,
@@ -260,6 +281,7 @@ def view_modified_recipe(recipe_id):
 
 # Add recipe
 @app.route("/add-recipe", methods=["GET", "POST"])
+@query_budget(6)
 @login_required
 def add_recipe():
     """Adds a new recipe to the database.
@@ -279,13 +301,15 @@ def add_recipe():
             if image:
                 image_url = save_image(image)
 
-            dietary_tags_id = add_dietary_tags_to_db(form.dietary_tags.data)
+            # The recipe and its dietary tags are inserted in the same commit
             recipe = Recipe(user_id=current_user.id, title=title, desc=desc,
                             ingredients=ingredients, instructions=instructions,
                             image_url=image_url if image else null(),
-                            dietary_tags_id=dietary_tags_id)
+                            dietary_tags=create_dietary_tags(form.dietary_tags.data),
+                            dietary_mask=dietary_tag_data_to_mask(form.dietary_tags.data))
             db.session.add(recipe)
             db.session.commit()
+            queue_image_upload(recipe)
 
             return redirect(url_for("view_recipe", recipe_id=recipe.id))
     return render_template("add-recipe.html", form=form)
@@ -293,6 +317,7 @@ def add_recipe():
 
 # Add modified recipe
 @app.route("/add-modified-recipe/<int:recipe_id>", methods=["GET", "POST"])
+@query_budget(8)
 @login_required
 def add_modified_recipe(recipe_id):
     """Adds a modified recipe.
@@ -302,18 +327,19 @@ def add_modified_recipe(recipe_id):
     """
     form = AddModifiedRecipeForm()
     original_recipe = Recipe.query.get(recipe_id)
-    original_recipe.created_by = User.query.filter_by(
-        id=original_recipe.user_id).first().username
+    hydrate_recipes([original_recipe])
 
     if request.method == "POST":
         if form.validate_on_submit():
             ingredients = form.ingredients.data.strip()
             instructions = form.instructions.data.strip()
             extended_desc = form.extended_desc.data
-            dietary_tags_id = add_dietary_tags_to_db(form.dietary_tags.data)
             modified_recipe = ModifiedRecipe(modified_by_id=current_user.id,
                                              recipe_id=recipe_id,
-                                             dietary_tags_id=dietary_tags_id,
+                                             dietary_tags=create_dietary_tags(
+                                                 form.dietary_tags.data),
+                                             dietary_mask=dietary_tag_data_to_mask(
+                                                 form.dietary_tags.data),
                                              extended_desc=extended_desc,
                                              ingredients=ingredients,
                                              instructions=instructions)
@@ -325,7 +351,6 @@ def add_modified_recipe(recipe_id):
 
     form.ingredients.data = original_recipe.ingredients
     form.instructions.data = original_recipe.instructions
-    add_dietary_tags_to_recipes([original_recipe])
     form.dietary_tags.data = dietary_tag_bools_to_data(
         get_recipe_dietary_tags_bools(original_recipe))
 
@@ -336,6 +361,7 @@ def add_modified_recipe(recipe_id):
 # Edit recipe
 @app.route("/edit-recipe/<int:recipe_id>/<int:modified_recipe>",
            methods=["GET", "POST"])
+@query_budget(14)
 @login_required
 def edit_recipe(recipe_id, modified_recipe):
     """Updates recipe in the database.
@@ -348,9 +374,8 @@ def edit_recipe(recipe_id, modified_recipe):
         redirect: The page of the recipe that was edited.
     """
     recipe = get_recipe(recipe_id, modified_recipe)
-    add_dietary_tags_to_recipes([recipe])
-    add_created_by_to_recipes([recipe])
-    if user_owns_recipe(current_user.id, recipe) or is_user_admin(current_user.id):
+    hydrate_recipes([recipe])
+    if user_owns_recipe(current_user.id, recipe) or is_current_user_admin():
         form = AddRecipeForm() if not is_modified_recipe(
             recipe) else AddModifiedRecipeForm()
         if request.method == "POST":
@@ -371,6 +396,8 @@ def edit_recipe(recipe_id, modified_recipe):
                                   ingredients, instructions, image)
 
                 update_dietary_tags(recipe, form.dietary_tags.data)
+                if commit_recipe_changes(recipe) and not is_modified_recipe(recipe):
+                    queue_image_upload(recipe)
                 return redirect(url_for("view_modified_recipe" if is_modified_recipe(recipe)
                                         else "view_recipe", recipe_id=recipe.id))
             if not is_modified_recipe(recipe):
@@ -398,6 +425,7 @@ def edit_recipe(recipe_id, modified_recipe):
 
 # Delete recipe
 @app.route("/delete-recipe/<int:recipe_id>/<int:modified_recipe>", methods=["GET", "POST"])
+@query_budget(10)
 @login_required
 def delete_recipe(recipe_id, modified_recipe):
     """Delete recipe from the database.
@@ -409,8 +437,8 @@ def delete_recipe(recipe_id, modified_recipe):
     Returns:
         redirect: Redirects the user to the "my_recipes" page after deleting the recipe.
     """
-    recipe = get_recipe(recipe_id, modified_recipe)
-    if user_owns_recipe(current_user.id, recipe) or is_user_admin(current_user.id):
+    recipe = get_recipe_for_delete(recipe_id, modified_recipe)
+    if user_owns_recipe(current_user.id, recipe) or is_current_user_admin():
         if recipe.image_url and image_exists(recipe.image_url) and not is_modified_recipe(recipe):
             delete_image(recipe.image_url)
         flash(f'Recipe "{recipe}" deleted.', "success")
@@ -424,6 +452,7 @@ def delete_recipe(recipe_id, modified_recipe):
 
 # Saved recipes
 @app.route("/view-saved-recipes", methods=["GET"])
+@query_budget(5)
 @login_required
 def view_saved_recipes():
     """App route for displaying saved recipes.
@@ -434,38 +463,45 @@ def view_saved_recipes():
     Returns:
         Rendered template: The saved recipes page.
     """
-    saved_recipes_keys = SavedRecipe.query.filter_by(
-        user_id=current_user.id).all()
-
-    saved_recipes = [recipe_key.recipe for recipe_key in saved_recipes_keys]
-    add_created_by_to_recipes(saved_recipes)
+    saved_recipes = Recipe.query.join(Recipe.saved_recipes).filter(
+        SavedRecipe.user_id == current_user.id).order_by(SavedRecipe.id).all()
+    hydrate_recipes(saved_recipes)
 
     return render_template("saved-recipes.html", saved_recipes=saved_recipes)
 
 
 # Save/unsave recipe
 @app.route("/toggle-save-recipe/<int:recipe_id>", methods=["POST"])
+@query_budget(4)
 @login_required
 def toggle_save_recipe(recipe_id):
     """Toggle whether user current user has saved recipe.
 
+    The "saved" form value ("true" or "false") sets whether the recipe is saved,
+    so repeating the request, e.g. on a double click, changes nothing.
+    Without it, the save is toggled.
+
     Args:
         recipe_id (int): The ID of the recipe to toggle the save for.
+
+    Returns:
+        JSON: Whether the recipe is now saved, e.g. {"saved": true}.
     """
-    if has_user_saved_recipe(current_user.id, recipe_id):
-        saved_recipe = SavedRecipe.query.filter_by(
-            user_id=current_user.id, recipe_id=recipe_id).first()
-        db.session.delete(saved_recipe)
-    else:
-        saved_recipe = SavedRecipe(
-            user_id=current_user.id, recipe_id=recipe_id)
-        db.session.add(saved_recipe)
+    if db.session.get(Recipe, recipe_id) is None:
+        abort(404)
 
-    db.session.commit()
+    saved = request.form.get("saved")
+    if saved is None:
+        saved = not has_user_saved_recipe(current_user.id, recipe_id)
+    else:
+        saved = saved == "true"
+    set_recipe_saved(current_user.id, recipe_id, saved)
+    return jsonify(saved=saved)
 
 
 # Search recipes
 @app.route("/search", methods=["GET"])
+@query_budget(9)
 def search():
     """Handles the GET request when searching and returns the results.
 
@@ -493,22 +529,68 @@ def search():
         search_query = search_query.replace("+", " ")
         recipes = search_all_recipes(search_query, dietary_tags)
 
-        add_created_by_to_recipes(recipes)
+        hydrate_recipes(recipes)
         search_form = SearchForm()
         dietary_tags = dietary_tag_data_to_names(dietary_tags)
         return render_template("search-results.html",
                                recipes=recipes, search_query=search_query,
                                dietary_tags=dietary_tags, search_form=search_form)
     # If doesn't validate, redirect to home with error message.
-    recipes = get_all_recipes()
-    add_created_by_to_recipes(recipes)
+    recipes, next_cursor = get_recipe_feed()
+    hydrate_recipes(recipes)
     return render_template("index.html",
-                           recipes=recipes, search_form=search_form,
-                           scroll="search-box")
+                           recipes=recipes, next_cursor=next_cursor,
+                           search_form=search_form, scroll="search-box")
+
+
+# Page cache statistics
+@app.route("/cache-stats", methods=["GET"])
+@query_budget(1)
+@login_required
+def cache_stats():
+    """Returns the page cache's size and hit/miss counters for this worker.
+
+    Only available to admins.
+
+    Returns:
+        JSON: The page cache statistics.
+    """
+    if not is_current_user_admin():
+        abort(401)
+    return jsonify(page_cache.stats())
+
+
+# Export recipes
+@app.route("/export/recipes.<file_format>", methods=["GET"])
+# Loading the admin, then one query each for recipes and modified recipes while streaming
+@query_budget(3)
+@login_required
+def export_recipes_file(file_format):
+    """Streams every recipe and modified recipe as a JSON Lines or CSV download.
+
+    Only available to admins. The rows are sent as they're read from the database,
+    so the download starts straight away and the worker's memory use stays flat.
+
+    Args:
+        file_format (str): "jsonl" or "csv".
+
+    Returns:
+        Response: The export, sent in chunks.
+    """
+    if not is_current_user_admin():
+        abort(401)
+    if file_format not in EXPORT_MIMETYPES:
+        abort(404)
+    response = Response(stream_with_context(export_recipes(file_format)),
+                        mimetype=EXPORT_MIMETYPES[file_format])
+    response.headers["Content-Disposition"] = (
+        f"attachment; filename=recipes-{datetime.utcnow():%Y-%m-%d}.{file_format}")
+    return response
 
 
 # Get image - From Flask documentation
 @app.route("/image-uploads/<path:filename>")
+@query_budget(1)
 def get_image(filename):
     """Retrieve image file from the UPLOAD_FOLDER.
 
@@ -516,11 +598,10 @@ def get_image(filename):
         filename (str): The name of the image file to retrieve.
 
     Returns:
-        (image): The image file as an attachment.
+        (image): The image file, shown inline. See send_image().
 
     """
-    return send_from_directory(app.config["UPLOAD_FOLDER"], filename,
-                               as_attachment=True)
+    return send_image(filename)
 
 
 # Error handling
@@ -546,3 +627,9 @@ def method_not_allowed(e):
 def internal_server_error(e):
     """Handles 500 error."""
     return render_template("error-pages/500.html", e=e), 500
+
+
+@app.errorhandler(503)
+def service_unavailable(e):
+    """Handles 503 error."""
+    return render_template("error-pages/503.html", e=e), 503
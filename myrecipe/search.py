@@ -0,0 +1,592 @@
+"""
+Contains the search backends for My Recipe.
+
+Used by search_all_recipes depending on SEARCH_BACKEND.
+
+"fulltext" uses the database's full-text search:
+    PostgreSQL matches recipes against weighted tsvector expressions, each backed by a GIN index.
+    SQLite matches against an FTS5 table, kept in sync with the recipe tables by mapper events.
+    If the FTS5 table is missing, search falls back to ILIKE and recipes are saved without it.
+    Both search the title, description, ingredients and instructions.
+
+"trigram" uses an in-memory index of the words in each recipe's title, description and ingredients.
+    Search words are matched to indexed words by trigram similarity, so typos still find results.
+    Each worker builds its index once, then keeps it up to date as recipes are committed.
+
+All backends rank results by relevance.
+A modified recipe matches on its own text or on the text of its original recipe.
+"""
+
+import re
+import threading
+from collections import defaultdict
+from sqlalchemy import DDL, event, or_, select, text, true
+from sqlalchemy.orm import Session, object_session
+from myrecipe import app, db
+from myrecipe.models import Recipe, ModifiedRecipe
+
+FTS_TABLE = "recipe_search"
+
+# Weighted tsvector expressions. The GIN indexes and the search queries must use
+# the exact same expression for PostgreSQL to use the index.
+RECIPE_DOCUMENT = ("setweight(to_tsvector('english', recipes.title), 'A') || "
+                   "setweight(to_tsvector('english', recipes.\"desc\"), 'B') || "
+                   "setweight(to_tsvector('english', recipes.ingredients), 'C') || "
+                   "setweight(to_tsvector('english', recipes.instructions), 'D')")
+MODIFIED_RECIPE_DOCUMENT = (
+    "setweight(to_tsvector('english', modified_recipes.extended_desc), 'B') || "
+    "setweight(to_tsvector('english', modified_recipes.ingredients), 'C') || "
+    "setweight(to_tsvector('english', modified_recipes.instructions), 'D')")
+
+POSTGRES_INDEXES = [
+    f"CREATE INDEX IF NOT EXISTS ix_recipes_search ON recipes "
+    f"USING gin (({RECIPE_DOCUMENT.replace('recipes.', '')}))",
+    f"CREATE INDEX IF NOT EXISTS ix_modified_recipes_search ON modified_recipes "
+    f"USING gin (({MODIFIED_RECIPE_DOCUMENT.replace('modified_recipes.', '')}))"]
+
+SQLITE_FTS_TABLE = (f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+                    "title, description, ingredients, instructions, "
+                    "tokenize='porter unicode61')")
+
+
+# Minimum trigram similarity between a search word and an indexed word for them to match
+TRIGRAM_SIMILARITY = 0.4
+
+
+def is_fulltext_enabled():
+    """Returns bool: True if the full-text search backend is enabled."""
+    return app.config["SEARCH_BACKEND"] == "fulltext"
+
+
+def is_trigram_enabled():
+    """Returns bool: True if the in-memory trigram search backend is enabled."""
+    return app.config["SEARCH_BACKEND"] == "trigram"
+
+
+def has_dietary_mask(model, dietary_mask):
+    """Returns a SQL filter for recipes that have all of the dietary tags in the mask.
+
+    Args:
+        model: The Recipe or ModifiedRecipe model.
+        dietary_mask (int): The required dietary tags as a bitmask.
+
+    Returns:
+        The filter expression "dietary_mask & required = required".
+    """
+    if not dietary_mask:
+        return true()
+    return model.dietary_mask.op("&")(dietary_mask) == dietary_mask
+
+
+def get_search_terms(search_query):
+    """Splits a search query into lowercase words, dropping any punctuation.
+
+    Args:
+        search_query (str): The search query from the search bar.
+
+    Returns:
+        list: The words to search for.
+    """
+    return re.findall(r"\w+", search_query.lower())
+
+
+def fulltext_search(search_query, dietary_mask=0):
+    """Search recipes and modified recipes using the database's full-text search.
+
+    Every word in the query must match, and the last word is treated as a prefix
+    so partly typed words still find results.
+
+    Args:
+        search_query (str): The search query from the search bar.
+        dietary_mask (int): Only return recipes with all of these dietary tags.
+
+    Returns:
+        list: Recipes and modified recipes that match, most relevant first.
+    """
+    terms = get_search_terms(search_query)
+    if not terms:
+        return []
+
+    if db.engine.dialect.name == "postgresql":
+        recipe_ranks, modified_ranks = match_postgres(terms)
+    else:
+        recipe_ranks, modified_ranks = match_sqlite(terms)
+
+    return load_ranked_recipes(recipe_ranks, modified_ranks, dietary_mask)
+
+
+def match_postgres(terms):
+    """Match the search terms against the tsvector GIN indexes.
+
+    Args:
+        terms (list): The words to search for.
+
+    Returns:
+        tuple: Dicts of rank keyed by ID, for recipes and modified recipes.
+    """
+    tsquery = " & ".join(f"{term}:*" for term in terms)
+    params = {"tsquery": tsquery}
+
+    recipe_rows = db.session.execute(text(
+        f"SELECT recipes.id, ts_rank({RECIPE_DOCUMENT}, query) FROM recipes, "
+        "to_tsquery('english', :tsquery) query "
+        f"WHERE {RECIPE_DOCUMENT} @@ query"), params)
+    modified_rows = db.session.execute(text(
+        f"SELECT modified_recipes.id, ts_rank({MODIFIED_RECIPE_DOCUMENT}, query) "
+        "FROM modified_recipes, to_tsquery('english', :tsquery) query "
+        f"WHERE {MODIFIED_RECIPE_DOCUMENT} @@ query"), params)
+
+    return dict(recipe_rows.all()), dict(modified_rows.all())
+
+
+def match_sqlite(terms):
+    """Match the search terms against the FTS5 table.
+
+    Args:
+        terms (list): The words to search for.
+
+    Returns:
+        tuple: Dicts of rank keyed by ID, for recipes and modified recipes.
+    """
+    match = " ".join(f'"{term}"*' for term in terms)
+
+    # bm25() is lower for better matches, so it's negated to match ts_rank().
+    # Columns are weighted in the same order as the PostgreSQL setweight() calls.
+    rows = db.session.execute(text(
+        f"SELECT rowid, -bm25({FTS_TABLE}, 10.0, 5.0, 2.0, 1.0) FROM {FTS_TABLE} "
+        f"WHERE {FTS_TABLE} MATCH :match"), {"match": match})
+
+    recipe_ranks = {}
+    modified_ranks = {}
+    for rowid, rank in rows:
+        kind, recipe_id = split_fts_rowid(rowid)
+        if kind == "m":
+            modified_ranks[recipe_id] = rank
+        else:
+            recipe_ranks[recipe_id] = rank
+    return recipe_ranks, modified_ranks
+
+
+def load_ranked_recipes(recipe_ranks, modified_ranks, dietary_mask=0):
+    """Loads the matched recipes and sorts them by rank.
+
+    Modified recipes of matching original recipes are included, ranked by
+    whichever is higher of their own rank and their original recipe's rank.
+
+    Args:
+        recipe_ranks (dict): Ranks of the matching recipes keyed by ID.
+        modified_ranks (dict): Ranks of the matching modified recipes keyed by ID.
+        dietary_mask (int): Only load recipes with all of these dietary tags.
+
+    Returns:
+        list: Recipes and modified recipes, most relevant first.
+    """
+    recipes = Recipe.query.filter(
+        Recipe.id.in_(recipe_ranks),
+        has_dietary_mask(Recipe, dietary_mask)).all() if recipe_ranks else []
+    for recipe in recipes:
+        recipe.search_rank = recipe_ranks[recipe.id]
+
+    modified_recipes = []
+    if recipe_ranks or modified_ranks:
+        modified_recipes = ModifiedRecipe.query.filter(or_(
+            ModifiedRecipe.id.in_(modified_ranks),
+            ModifiedRecipe.recipe_id.in_(recipe_ranks)),
+            has_dietary_mask(ModifiedRecipe, dietary_mask)).all()
+    for m_recipe in modified_recipes:
+        m_recipe.search_rank = max(modified_ranks.get(m_recipe.id, 0),
+                                   recipe_ranks.get(m_recipe.recipe_id, 0))
+
+    recipes.extend(modified_recipes)
+    recipes.sort(key=lambda recipe: recipe.search_rank, reverse=True)
+    return recipes
+
+
+def get_fts_rowid(recipe):
+    """Returns the FTS5 rowid of a recipe.
+
+    Recipes use even rowids and modified recipes use odd rowids,
+    so rows can be found by rowid instead of scanning the table.
+    """
+    if isinstance(recipe, ModifiedRecipe):
+        return recipe.id * 2 + 1
+    return recipe.id * 2
+
+
+def split_fts_rowid(rowid):
+    """Returns the kind ("r" or "m") and the ID of the recipe with the FTS5 rowid."""
+    return ("m" if rowid % 2 else "r"), rowid // 2
+
+
+def get_fts_values(recipe):
+    """Returns the columns of the FTS5 row for a recipe.
+
+    Modified recipes only index their own text, their original recipe's row covers the rest.
+    """
+    if isinstance(recipe, ModifiedRecipe):
+        return {"title": "", "description": recipe.extended_desc,
+                "ingredients": recipe.ingredients, "instructions": recipe.instructions}
+    return {"title": recipe.title, "description": recipe.desc,
+            "ingredients": recipe.ingredients, "instructions": recipe.instructions}
+
+
+def write_fts_row(connection, recipe, delete_only=False):
+    """Replaces or deletes the FTS5 row of a recipe.
+
+    Args:
+        connection (Connection): The connection of the current flush.
+        recipe (Recipe): The recipe or modified recipe that changed.
+        delete_only (bool): If True, only delete the row.
+    """
+    rowid = get_fts_rowid(recipe)
+    connection.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :rowid"),
+                       {"rowid": rowid})
+    if not delete_only:
+        connection.execute(text(
+            f"INSERT INTO {FTS_TABLE} (rowid, title, description, ingredients, instructions) "
+            "VALUES (:rowid, :title, :description, :ingredients, :instructions)"),
+            {"rowid": rowid, **get_fts_values(recipe)})
+
+
+def has_fts_table(connection):
+    """Returns bool: True if the FTS5 table exists.
+
+    Checked once per database connection. If it's missing, e.g. the migrations
+    haven't been run, a warning is logged and search falls back to ILIKE,
+    rather than every recipe write failing.
+
+    Args:
+        connection (Connection): A connection to the SQLite database.
+    """
+    exists = connection.info.get("has_fts_table")
+    if exists is None:
+        exists = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {"name": FTS_TABLE}).first() is not None
+        connection.info["has_fts_table"] = exists
+        if not exists:
+            app.logger.warning(
+                "The %s table is missing, so full-text search is off. Run "
+                '"flask --app myrecipe db upgrade", then restart the app.', FTS_TABLE)
+    return exists
+
+
+def is_fulltext_available():
+    """Returns bool: True if the full-text search backend is enabled and its index exists.
+
+    PostgreSQL can always search, its GIN indexes only make it faster.
+    """
+    if not is_fulltext_enabled():
+        return False
+    connection = db.session.connection()
+    return connection.dialect.name != "sqlite" or has_fts_table(connection)
+
+
+def should_sync_fts(connection):
+    """Returns bool: True if the FTS5 table needs to be kept in sync."""
+    return (is_fulltext_enabled() and connection.dialect.name == "sqlite"
+            and has_fts_table(connection))
+
+
+@event.listens_for(Recipe, "after_insert")
+@event.listens_for(Recipe, "after_update")
+@event.listens_for(ModifiedRecipe, "after_insert")
+@event.listens_for(ModifiedRecipe, "after_update")
+def sync_fts_row(mapper, connection, target):
+    """Mapper event: updates the FTS5 row of a recipe after it's added or edited."""
+    if should_sync_fts(connection):
+        write_fts_row(connection, target)
+
+
+@event.listens_for(Recipe, "after_delete")
+@event.listens_for(ModifiedRecipe, "after_delete")
+def delete_fts_row(mapper, connection, target):
+    """Mapper event: deletes the FTS5 row of a recipe after it's deleted."""
+    if should_sync_fts(connection):
+        write_fts_row(connection, target, delete_only=True)
+
+
+@event.listens_for(db.metadata, "after_create")
+def create_search_indexes(target, connection, **kw):
+    """Metadata event: creates the search indexes along with the tables.
+
+    Only runs if the full-text search backend is enabled.
+    """
+    if not is_fulltext_enabled():
+        return
+    if connection.dialect.name == "postgresql":
+        for statement in POSTGRES_INDEXES:
+            connection.execute(DDL(statement))
+    elif connection.dialect.name == "sqlite":
+        connection.execute(DDL(SQLITE_FTS_TABLE))
+        connection.info["has_fts_table"] = True
+
+
+def rebuild_search_index():
+    """Creates the search indexes if they're missing and refills the FTS5 table.
+
+    PostgreSQL indexes are expressions over the recipe tables, so they only need creating.
+    On SQLite, every recipe is re-indexed.
+
+    Returns:
+        int: The number of recipes and modified recipes indexed.
+    """
+    connection = db.session.connection()
+    if connection.dialect.name == "postgresql":
+        for statement in POSTGRES_INDEXES:
+            connection.execute(DDL(statement))
+        db.session.commit()
+        return Recipe.query.count() + ModifiedRecipe.query.count()
+
+    connection.execute(DDL(SQLITE_FTS_TABLE))
+    connection.info["has_fts_table"] = True
+    connection.execute(text(f"DELETE FROM {FTS_TABLE}"))
+    count = 0
+    for model in (Recipe, ModifiedRecipe):
+        for recipe in db.session.execute(
+                db.select(model).execution_options(yield_per=500)).scalars():
+            write_fts_row(connection, recipe)
+            count += 1
+    db.session.commit()
+    return count
+
+
+class TrigramIndex:
+    """An in-memory, typo-tolerant search index of recipes.
+
+    Each recipe is indexed by the words in its text, and each word by its trigrams.
+    A search word is looked up by its trigrams to find similar indexed words,
+    so the cost of a search depends on the size of the vocabulary, not the number of recipes.
+
+    Recipes are keyed by ("r", id) and modified recipes by ("m", id).
+    The index is shared by the threads of a worker, so every method holds the lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.is_built = False
+        self.word_recipes = defaultdict(set)
+        self.trigram_words = defaultdict(set)
+        self.recipe_words = {}
+
+    def add(self, key, recipe_text):
+        """Adds a recipe to the index, replacing it if it's already there.
+
+        Args:
+            key (tuple): The recipe's key.
+            recipe_text (str): The text to index.
+        """
+        words = set(get_search_terms(recipe_text))
+        with self.lock:
+            self.remove(key)
+            self.recipe_words[key] = words
+            for word in words:
+                if not self.word_recipes[word]:
+                    for trigram in get_trigrams(word):
+                        self.trigram_words[trigram].add(word)
+                self.word_recipes[word].add(key)
+
+    def remove(self, key):
+        """Removes a recipe from the index, if it's there.
+
+        Args:
+            key (tuple): The recipe's key.
+        """
+        with self.lock:
+            for word in self.recipe_words.pop(key, ()):
+                recipes = self.word_recipes[word]
+                recipes.discard(key)
+                if not recipes:
+                    del self.word_recipes[word]
+                    for trigram in get_trigrams(word):
+                        self.trigram_words[trigram].discard(word)
+                        if not self.trigram_words[trigram]:
+                            del self.trigram_words[trigram]
+
+    def clear(self):
+        """Removes every recipe from the index."""
+        with self.lock:
+            self.word_recipes.clear()
+            self.trigram_words.clear()
+            self.recipe_words.clear()
+            self.is_built = False
+
+    def find_similar_words(self, term):
+        """Finds the indexed words that are similar to a search word.
+
+        Args:
+            term (str): The search word.
+
+        Returns:
+            dict: The similarity of each matching word, keyed by word.
+        """
+        term_trigrams = get_trigrams(term)
+        shared = defaultdict(int)
+        for trigram in term_trigrams:
+            for word in self.trigram_words.get(trigram, ()):
+                shared[word] += 1
+
+        similar = {}
+        for word, count in shared.items():
+            similarity = count / (len(term_trigrams) + len(get_trigrams(word)) - count)
+            if similarity >= TRIGRAM_SIMILARITY:
+                similar[word] = similarity
+        return similar
+
+    def search(self, terms):
+        """Finds the recipes that contain a word similar to every search word.
+
+        Args:
+            terms (list): The search words.
+
+        Returns:
+            tuple: Dicts of rank keyed by ID, for recipes and modified recipes.
+        """
+        with self.lock:
+            ranks = None
+            for term in terms:
+                term_ranks = defaultdict(float)
+                for word, similarity in self.find_similar_words(term).items():
+                    for key in self.word_recipes[word]:
+                        term_ranks[key] = max(term_ranks[key], similarity)
+
+                if ranks is None:
+                    ranks = term_ranks
+                else:
+                    ranks = {key: rank + term_ranks[key] for key, rank in ranks.items()
+                             if key in term_ranks}
+                if not ranks:
+                    break
+
+        recipe_ranks = {}
+        modified_ranks = {}
+        for (kind, recipe_id), rank in (ranks or {}).items():
+            if kind == "m":
+                modified_ranks[recipe_id] = rank
+            else:
+                recipe_ranks[recipe_id] = rank
+        return recipe_ranks, modified_ranks
+
+
+trigram_index = TrigramIndex()
+
+
+def get_trigrams(word):
+    """Returns the set of trigrams in a word.
+
+    The word is padded like PostgreSQL's pg_trgm, so short words and
+    the start of a word have trigrams of their own.
+    """
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def get_trigram_entry(recipe):
+    """Returns the trigram index key and text of a recipe."""
+    if isinstance(recipe, ModifiedRecipe):
+        return ("m", recipe.id), f"{recipe.extended_desc} {recipe.ingredients}"
+    return ("r", recipe.id), f"{recipe.title} {recipe.desc} {recipe.ingredients}"
+
+
+def build_trigram_index():
+    """Builds the trigram index from the database, if this worker hasn't already.
+
+    Only the indexed columns are selected, streamed in batches,
+    so building doesn't load every recipe into memory at once.
+    """
+    with trigram_index.lock:
+        if trigram_index.is_built:
+            return
+
+        recipe_rows = db.session.execute(select(
+            Recipe.id, Recipe.title, Recipe.desc, Recipe.ingredients).execution_options(
+            yield_per=1000))
+        for recipe_id, title, desc, ingredients in recipe_rows:
+            trigram_index.add(("r", recipe_id), f"{title} {desc} {ingredients}")
+
+        modified_rows = db.session.execute(select(
+            ModifiedRecipe.id, ModifiedRecipe.extended_desc,
+            ModifiedRecipe.ingredients).execution_options(yield_per=1000))
+        for recipe_id, extended_desc, ingredients in modified_rows:
+            trigram_index.add(("m", recipe_id), f"{extended_desc} {ingredients}")
+
+        trigram_index.is_built = True
+
+
+@app.before_request
+def build_trigram_index_on_first_request():
+    """Builds this worker's trigram index before it handles its first request."""
+    if is_trigram_enabled() and not trigram_index.is_built:
+        build_trigram_index()
+
+
+def trigram_search(search_query, dietary_mask=0):
+    """Search recipes and modified recipes using the in-memory trigram index.
+
+    Every word in the query must match a similar word in the recipe.
+
+    Args:
+        search_query (str): The search query from the search bar.
+        dietary_mask (int): Only return recipes with all of these dietary tags.
+
+    Returns:
+        list: Recipes and modified recipes that match, most relevant first.
+    """
+    terms = get_search_terms(search_query)
+    if not terms:
+        return []
+
+    build_trigram_index()
+    recipe_ranks, modified_ranks = trigram_index.search(terms)
+    return load_ranked_recipes(recipe_ranks, modified_ranks, dietary_mask)
+
+
+@event.listens_for(Recipe, "after_insert")
+@event.listens_for(Recipe, "after_update")
+@event.listens_for(ModifiedRecipe, "after_insert")
+@event.listens_for(ModifiedRecipe, "after_update")
+def queue_trigram_update(mapper, connection, target):
+    """Mapper event: queues a recipe to be re-indexed once the session commits."""
+    if is_trigram_enabled():
+        key, recipe_text = get_trigram_entry(target)
+        get_pending_trigram_changes(target).append((key, recipe_text))
+
+
+@event.listens_for(Recipe, "after_delete")
+@event.listens_for(ModifiedRecipe, "after_delete")
+def queue_trigram_removal(mapper, connection, target):
+    """Mapper event: queues a recipe to be removed from the index once the session commits."""
+    if is_trigram_enabled():
+        key, _ = get_trigram_entry(target)
+        get_pending_trigram_changes(target).append((key, None))
+
+
+def get_pending_trigram_changes(recipe):
+    """Returns the list of trigram index changes waiting for the recipe's session to commit."""
+    return object_session(recipe).info.setdefault("trigram_changes", [])
+
+
+@event.listens_for(Session, "after_commit")
+def apply_trigram_changes(session):
+    """Session event: applies the queued changes to the trigram index after a commit.
+
+    Changes are only applied once committed, so a rollback leaves the index untouched.
+    """
+    changes = session.info.pop("trigram_changes", None)
+    if not changes:
+        return
+    with trigram_index.lock:
+        # An index that isn't built yet will read these changes from the database
+        if not trigram_index.is_built:
+            return
+        for key, recipe_text in changes:
+            if recipe_text is None:
+                trigram_index.remove(key)
+            else:
+                trigram_index.add(key, recipe_text)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def discard_trigram_changes(session, previous_transaction):
+    """Session event: discards the queued trigram index changes when the session rolls back."""
+    session.info.pop("trigram_changes", None)
@@ -0,0 +1,149 @@
+"""
+Contains the database timing for My Recipe.
+
+Both are off by default, and when off no engine events are registered, so they cost nothing.
+
+    DB_TIMING: Each response gets a Server-Timing header with the time the request
+        spent running SQL statements and how many it ran, e.g.
+        Server-Timing: db;dur=12.4;desc="7 queries", app;dur=31.0
+    SLOW_QUERY_MS: Statements slower than this many milliseconds are logged as a
+        single line of JSON, with the statement, the shape of its parameters (never their
+        values), the function in My Recipe that ran it and the endpoint of the request.
+
+Statements are timed with SQLAlchemy engine events, from just before the cursor executes
+to just after, so the time doesn't include loading rows into models.
+Statements run after the view returns, e.g. while streaming a response, aren't in the header.
+"""
+
+import json
+import sys
+import time
+from flask import g, has_app_context, has_request_context, request, request_started
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from myrecipe import app
+
+
+class RequestTiming:
+    """The time a request has spent running SQL statements.
+
+    Attributes:
+        started (float): When the request started, from time.perf_counter().
+        db_time (float): Seconds spent running statements.
+        statements (int): The number of statements run.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_time = 0.0
+        self.statements = 0
+
+    def get_server_timing(self):
+        """Returns str: The Server-Timing header value, with durations in milliseconds."""
+        app_time = (time.perf_counter() - self.started) * 1000
+        return (f'db;dur={self.db_time * 1000:.1f};desc="{self.statements} queries", '
+                f"app;dur={app_time:.1f}")
+
+
+def get_parameters_shape(parameters, executemany):
+    """Describes a statement's parameters without their values, which may be personal data.
+
+    Args:
+        parameters (tuple, dict or list): The parameters passed to the cursor.
+        executemany (bool): True if parameters is a list of parameter sets.
+
+    Returns:
+        dict: e.g. {"positional": 3} or {"rows": 500, "named": ["title", "user_id"]}.
+    """
+    shape = {}
+    # Batched inserts are flagged executemany but may pass one flat tuple for the batch
+    if executemany and parameters and isinstance(parameters[0], (dict, list, tuple)):
+        shape["rows"] = len(parameters)
+        parameters = parameters[0]
+    if isinstance(parameters, dict):
+        shape["named"] = sorted(parameters)
+    else:
+        shape["positional"] = len(parameters or ())
+    return shape
+
+
+def get_calling_function():
+    """Returns str: The function in My Recipe that ran the current statement,
+    e.g. "myrecipe.helpers.get_recipe_feed:412", or None if it wasn't run from My Recipe."""
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if module.startswith("myrecipe.") and module != __name__:
+            return f"{module}.{frame.f_code.co_name}:{frame.f_lineno}"
+        frame = frame.f_back
+    return None
+
+
+def start_timing_request(sender, **extra):
+    """Signal: starts timing the current request's SQL statements."""
+    g.request_timing = RequestTiming()
+
+
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    """Engine event: notes when a statement starts running.
+
+    Statements on a connection run one at a time, so a failed statement's start
+    is simply replaced by the next one's.
+    """
+    conn.info["statement_started"] = time.perf_counter()
+
+
+def stop_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    """Engine event: adds a statement's time to the request and logs it if it was slow."""
+    started = conn.info.pop("statement_started", None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+
+    timing = g.get("request_timing") if has_app_context() else None
+    if timing is not None:
+        timing.db_time += elapsed
+        timing.statements += 1
+
+    slow_query_ms = app.config["SLOW_QUERY_MS"]
+    if slow_query_ms and elapsed * 1000 >= slow_query_ms:
+        log_slow_query(statement, parameters, executemany, elapsed)
+
+
+def log_slow_query(statement, parameters, executemany, elapsed):
+    """Logs a slow statement as a single line of JSON.
+
+    Args:
+        statement (str): The SQL that was run.
+        parameters (tuple, dict or list): Its parameters. Only their shape is logged.
+        executemany (bool): True if it was run once for each of several parameter sets.
+        elapsed (float): How long it took, in seconds.
+    """
+    in_request = has_request_context()
+    app.logger.warning(json.dumps({
+        "event": "slow_query",
+        "duration_ms": round(elapsed * 1000, 1),
+        "endpoint": request.endpoint if in_request else None,
+        "method": request.method if in_request else None,
+        "path": request.path if in_request else None,
+        "caller": get_calling_function(),
+        "statement": " ".join(statement.split()),
+        "parameters": get_parameters_shape(parameters, executemany),
+    }))
+
+
+def add_server_timing(response):
+    """Adds the Server-Timing header to the response."""
+    timing = g.get("request_timing")
+    if timing is not None:
+        response.headers.add("Server-Timing", timing.get_server_timing())
+    return response
+
+
+if app.config["DB_TIMING"] or app.config["SLOW_QUERY_MS"]:
+    event.listen(Engine, "before_cursor_execute", start_statement_timer)
+    event.listen(Engine, "after_cursor_execute", stop_statement_timer)
+
+if app.config["DB_TIMING"]:
+    request_started.connect(start_timing_request, app)
+    app.after_request(add_server_timing)
@@ -0,0 +1,215 @@
+"""
+Contains the background image upload pipeline for My Recipe.
+
+When BACKGROUND_IMAGE_UPLOADS is enabled and images are stored on Cloudinary,
+save_image stores the image locally and the recipe is committed with that local URL
+as a placeholder. queue_image_upload then hands the image to a pool of worker threads,
+which upload it with retries and swap the image URL of every recipe using it to the uploaded one.
+Identical images share a placeholder, which is only uploaded once.
+
+The uploader is a function set in app.config["IMAGE_UPLOADER"]. It's given the local
+path and filename of the image, and returns the image's remote URL.
+FakeUploader can be used in place of Cloudinary for testing.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import cloudinary.uploader
+from myrecipe import app, db
+from myrecipe.models import Recipe
+from myrecipe.images import get_cloudinary_variant_options, register_image
+from myrecipe.helpers import (is_local_image_url, delete_image,
+                              count_image_references, remove_filename_extension,
+                              get_public_id, get_image_versions)
+
+executor = None
+executor_lock = threading.Lock()
+# Uploads of the same placeholder run one at a time, so it's only uploaded once
+upload_locks = [threading.Lock() for _ in range(64)]
+
+
+def upload_to_cloudinary(path, filename):
+    """Uploads an image file to Cloudinary.
+
+    Args:
+        path (str): The path of the image file.
+        filename (str): The image's filename, used as its Cloudinary public id.
+
+    Returns:
+        str: The URL of the uploaded image.
+    """
+    result = cloudinary.uploader.upload(
+        path, public_id=remove_filename_extension(filename),
+        folder="myrecipe/image-uploads", eager=get_cloudinary_variant_options())
+    return result["secure_url"]
+
+
+class FakeUploader:
+    """An uploader that copies images to a local folder instead of Cloudinary.
+
+    Use it for testing by setting app.config["IMAGE_UPLOADER"] = FakeUploader().
+
+    Attributes:
+        folder (str): Where uploaded images are copied to.
+        fail_times (int): How many uploads should fail before they start succeeding.
+        uploads (list): The filenames of the successful uploads.
+    """
+
+    def __init__(self, folder=None, fail_times=0):
+        self.folder = folder or tempfile.mkdtemp(prefix="myrecipe-fake-uploads-")
+        self.fail_times = fail_times
+        self.uploads = []
+
+    def __call__(self, path, filename):
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            raise ConnectionError("Fake upload failed.")
+        shutil.copyfile(path, os.path.join(self.folder, filename))
+        self.uploads.append(filename)
+        return f"https://fake-uploads.invalid/myrecipe/image-uploads/{filename}"
+
+
+def is_background_upload_enabled():
+    """Returns bool: True if images are uploaded to Cloudinary in the background."""
+    return (app.config["BACKGROUND_IMAGE_UPLOADS"]
+            and not app.config["SAVE_IMAGES_LOCALLY"])
+
+
+def get_executor():
+    """Returns the worker pool for uploads, creating it on first use."""
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=app.config["IMAGE_UPLOAD_WORKERS"],
+                thread_name_prefix="image-upload")
+        return executor
+
+
+def queue_image_upload(recipe):
+    """Queues a recipe's placeholder image to be uploaded in the background.
+
+    Call after the recipe has been committed. Does nothing if background uploads
+    are disabled or the recipe's image isn't a local placeholder.
+
+    Args:
+        recipe (Recipe): The recipe whose image should be uploaded.
+
+    Returns:
+        Future: The queued upload, or None if nothing was queued.
+    """
+    if not is_background_upload_enabled() or not is_local_image_url(recipe.image_url):
+        return None
+    return get_executor().submit(upload_placeholder_image, recipe.image_url)
+
+
+def get_upload_lock(local_url):
+    """Returns the lock held while a placeholder is uploaded and swapped into its recipes."""
+    return upload_locks[hash(local_url) % len(upload_locks)]
+
+
+def upload_placeholder_image(local_url):
+    """Uploads a placeholder image and swaps it into the recipes using it. Runs on a worker thread.
+
+    Failed uploads are retried with exponential backoff. If every attempt fails,
+    the recipes keep their local placeholder, which is still served.
+    Any other error is logged, as nothing reads the result of the upload.
+
+    Args:
+        local_url (str): The URL of the placeholder image.
+
+    Returns:
+        str: The uploaded image's URL, or None if the upload failed.
+    """
+    with app.app_context(), get_upload_lock(local_url):
+        try:
+            return upload_and_swap_image(local_url)
+        except Exception:
+            app.logger.exception("Background upload of %s failed.", local_url)
+            db.session.rollback()
+            return None
+        finally:
+            db.session.remove()
+
+
+def get_uploaded_image_url(local_url):
+    """Returns str: The URL of an uploaded copy of a placeholder image, or None if there isn't one.
+
+    Placeholders are named by their content hash, which is also the public id they're
+    uploaded under, so an uploaded copy can be found in the image registry.
+    """
+    versions = get_image_versions(get_public_id(local_url))
+    return versions[0].image_url if versions else None
+
+
+def upload_and_swap_image(local_url):
+    """Uploads a placeholder image, then swaps every recipe using it to the uploaded image.
+
+    Identical images share a placeholder, and the placeholder of an image that's
+    already been uploaded isn't uploaded again. Its recipes are swapped to the uploaded copy.
+
+    Args:
+        local_url (str): The URL of the placeholder image.
+
+    Returns:
+        str: The uploaded image's URL, or None if the upload failed or wasn't needed.
+    """
+    # An earlier upload of the same placeholder may have swapped its recipes already
+    if count_image_references(local_url) == 0:
+        return None
+    image_url = get_uploaded_image_url(local_url)
+    if image_url is not None:
+        swap_placeholder_image(local_url, image_url)
+        return image_url
+
+    path = app.config["PACKAGE_NAME"] + local_url
+    filename = local_url.split("/")[-1]
+    uploader = app.config["IMAGE_UPLOADER"]
+    attempts = app.config["IMAGE_UPLOAD_RETRIES"] + 1
+
+    for attempt in range(attempts):
+        try:
+            image_url = uploader(path, filename)
+            break
+        except Exception:
+            app.logger.warning("Upload of %s failed (attempt %s of %s).",
+                               filename, attempt + 1, attempts, exc_info=True)
+            if attempt + 1 < attempts:
+                time.sleep(app.config["IMAGE_UPLOAD_RETRY_DELAY"] * 2 ** attempt)
+    else:
+        app.logger.error("Giving up uploading %s, keeping the local image.", filename)
+        return None
+
+    register_image(image_url, os.path.getsize(path))
+    swap_placeholder_image(local_url, image_url)
+    return image_url
+
+
+def swap_placeholder_image(local_url, image_url):
+    """Swaps every recipe using a placeholder to its uploaded image, then deletes the placeholder.
+
+    Recipes edited in the meantime no longer use the placeholder, so they're left alone.
+
+    Args:
+        local_url (str): The URL of the placeholder image.
+        image_url (str): The URL of the uploaded image.
+    """
+    for recipe in Recipe.query.filter(Recipe.image_url == local_url).all():
+        recipe.image_url = image_url
+        recipe.updated_at = datetime.utcnow()
+    db.session.flush()
+
+    if count_image_references(local_url) == 0 and os.path.exists(
+            app.config["PACKAGE_NAME"] + local_url):
+        delete_image(local_url)
+    db.session.commit()
+
+
+if "IMAGE_UPLOADER" not in app.config:
+    app.config["IMAGE_UPLOADER"] = (FakeUploader() if os.environ.get("IMAGE_UPLOADER") == "fake"
+                                    else upload_to_cloudinary)
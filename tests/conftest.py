@@ -0,0 +1,140 @@
+"""
+Contains the pytest fixtures for My Recipe.
+
+The app reads its configuration when it's imported, so the test database and
+settings are set in the environment first. Each test gets a freshly seeded
+SQLite database, and requests are made through the Flask test client.
+
+Run the tests with "python -m pytest" from the repository root.
+"""
+
+import os
+import tempfile
+
+TEST_FOLDER = tempfile.mkdtemp(prefix="myrecipe-tests-")
+os.environ.update({
+    "DEVELOPMENT": "True",
+    "DB_URL": f"sqlite:///{os.path.join(TEST_FOLDER, 'test.sqlite')}",
+    "SECRET_KEY": "test-secret-key",
+    "DEFAULT_ADMIN_PASSWORD": "admin-password",
+    # Hashing passwords is slow on purpose, which tests don't need
+    "BCRYPT_LOG_ROUNDS": "4",
+    # Query budgets include loading the logged in user, so it isn't cached
+    "USER_CACHE_TTL": "0",
+})
+
+import pytest
+from flask_migrate import upgrade
+from sqlalchemy import select, text
+from myrecipe import app as flask_app, db, DEFAULT_ADMIN_PASSWORD
+from myrecipe.models import Recipe, ModifiedRecipe, User
+from myrecipe.helpers import create_default_admin
+from myrecipe.benchmarks import seed_data, SEED_USERNAME_PREFIX, SEED_PASSWORD
+
+# Enough rows for a page of the feed, so a query in a loop runs more than once
+SEED_RECIPES = 60
+SEED_USERS = 3
+SEED_MODIFIED_RECIPES = 30
+MIGRATIONS_FOLDER = os.path.join(os.path.dirname(os.path.dirname(__file__)), "migrations")
+
+
+@pytest.fixture
+def app():
+    """The app, with a freshly seeded database and CSRF protection off."""
+    flask_app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    with flask_app.app_context():
+        db.create_all()
+        create_default_admin()
+        seed_data(SEED_RECIPES, users=SEED_USERS, modified_recipes=SEED_MODIFIED_RECIPES,
+                  saves_per_user=5)
+    yield flask_app
+    with flask_app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def migrated_app():
+    """The app, with a seeded database built by the migrations, as "db upgrade" builds it.
+
+    Tables the models don't know about, like the full-text search table, are created too.
+    The data is seeded before the last migration, so it runs on a database with recipes.
+    """
+    flask_app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    with flask_app.app_context():
+        upgrade(directory=MIGRATIONS_FOLDER, revision="head-1")
+        create_default_admin()
+        seed_data(SEED_RECIPES, users=SEED_USERS, modified_recipes=SEED_MODIFIED_RECIPES,
+                  saves_per_user=5)
+        db.session.remove()
+        upgrade(directory=MIGRATIONS_FOLDER)
+    yield flask_app
+    with flask_app.app_context():
+        db.session.remove()
+        db.drop_all()
+        with db.engine.begin() as connection:
+            connection.execute(text("DROP TABLE IF EXISTS recipe_search"))
+            connection.execute(text("DROP TABLE IF EXISTS alembic_version"))
+        # Connections remember whether the search table exists
+        db.engine.dispose()
+
+
+def log_in(app, username, password):
+    """Returns a test client logged in as the user."""
+    client = app.test_client()
+    # Each request gets its own app context, as it would when served
+    with app.app_context():
+        response = client.post("/login", data={"username": username, "password": password})
+    assert response.status_code == 302, f"Couldn't log in as {username}."
+    return client
+
+
+@pytest.fixture
+def anonymous_client(app):
+    """A test client that isn't logged in."""
+    return app.test_client()
+
+
+@pytest.fixture
+def user_client(app):
+    """A test client logged in as the first seeded user."""
+    return log_in(app, f"{SEED_USERNAME_PREFIX}1", SEED_PASSWORD)
+
+
+@pytest.fixture
+def migrated_user_client(migrated_app):
+    """A test client logged in as the first seeded user of the migrated database."""
+    return log_in(migrated_app, f"{SEED_USERNAME_PREFIX}1", SEED_PASSWORD)
+
+
+@pytest.fixture
+def admin_client(app):
+    """A test client logged in as the default admin."""
+    return log_in(app, "admin", DEFAULT_ADMIN_PASSWORD)
+
+
+@pytest.fixture
+def recipe_ids(app):
+    """The IDs of seeded rows to request, by name.
+
+    recipe: A recipe with modified copies.
+    modified_recipe: A modified recipe.
+    own_recipe: A recipe of the logged in user with modified copies, if possible.
+    own_modified_recipe: A modified recipe of the logged in user.
+    """
+    with app.app_context():
+        user_id = db.session.scalar(select(User.id).where(
+            User.username == f"{SEED_USERNAME_PREFIX}1"))
+        copied = Recipe.recipe_copies.any()
+        own_recipe = (db.session.scalar(select(Recipe.id).where(
+            Recipe.user_id == user_id, copied).order_by(Recipe.id))
+            or db.session.scalar(select(Recipe.id).where(
+                Recipe.user_id == user_id).order_by(Recipe.id)))
+        return {
+            "recipe": db.session.scalar(select(Recipe.id).where(copied).order_by(Recipe.id)),
+            "modified_recipe": db.session.scalar(
+                select(ModifiedRecipe.id).order_by(ModifiedRecipe.id)),
+            "own_recipe": own_recipe,
+            "own_modified_recipe": db.session.scalar(select(ModifiedRecipe.id).where(
+                ModifiedRecipe.modified_by_id == user_id).order_by(ModifiedRecipe.id)),
+        }
@@ -0,0 +1,104 @@
+"""
+Checks the full-text search backend on a database built by the migrations.
+
+Recipes can be added, edited, deleted and searched with SEARCH_BACKEND set to "fulltext",
+and if the search table is missing, writes still work and search falls back to ILIKE.
+"""
+
+import pytest
+from sqlalchemy import select, text
+from myrecipe import db
+from myrecipe.models import Recipe, User
+from myrecipe.search import FTS_TABLE
+from myrecipe.benchmarks import SEED_USERNAME_PREFIX
+
+RECIPE_FORM = {"title": "Quokka crumble", "desc": "A crumble for testing",
+               "ingredients": "apples and oats", "instructions": "Bake it for an hour.",
+               "dietary_tags": ["vv"]}
+
+
+@pytest.fixture
+def fulltext_app(migrated_app):
+    """The migrated app, with the full-text search backend enabled."""
+    backend = migrated_app.config["SEARCH_BACKEND"]
+    migrated_app.config["SEARCH_BACKEND"] = "fulltext"
+    yield migrated_app
+    migrated_app.config["SEARCH_BACKEND"] = backend
+
+
+def request(app, client, method, url, data=None):
+    """Makes a request in its own app context, as it would be when served."""
+    with app.app_context():
+        return client.open(url, method=method, data=data)
+
+
+def search(app, client, query):
+    """Returns str: The search results page for the query."""
+    response = request(app, client, "GET", f"/search?search_bar={query}")
+    assert response.status_code == 200
+    return response.get_data(as_text=True)
+
+
+def get_own_recipe_id(app):
+    """Returns int: The ID of a recipe of the first seeded user."""
+    with app.app_context():
+        user_id = db.session.scalar(select(User.id).where(
+            User.username == f"{SEED_USERNAME_PREFIX}1"))
+        return db.session.scalar(select(Recipe.id).where(
+            Recipe.user_id == user_id).order_by(Recipe.id))
+
+
+def count_fts_rows(app):
+    """Returns int: The number of rows in the full-text search table."""
+    with app.app_context():
+        return db.session.scalar(text(f"SELECT count(*) FROM {FTS_TABLE}"))
+
+
+def test_migrations_index_existing_recipes(fulltext_app, anonymous_client):
+    with fulltext_app.app_context():
+        title = db.session.scalar(select(Recipe.title).order_by(Recipe.id))
+        recipes = db.session.scalar(select(db.func.count()).select_from(Recipe))
+    assert count_fts_rows(fulltext_app) >= recipes
+    assert title in search(fulltext_app, anonymous_client, title.split()[-1])
+
+
+def test_add_edit_delete_and_search(fulltext_app, migrated_user_client):
+    client = migrated_user_client
+
+    response = request(fulltext_app, client, "POST", "/add-recipe", RECIPE_FORM)
+    assert response.status_code == 302
+    assert "Quokka crumble" in search(fulltext_app, client, "quokka")
+    # Ingredients are searched too, not just titles and descriptions
+    assert "Quokka crumble" in search(fulltext_app, client, "oats")
+
+    recipe_id = get_own_recipe_id(fulltext_app)
+    response = request(fulltext_app, client, "POST", f"/edit-recipe/{recipe_id}/0",
+                       {**RECIPE_FORM, "title": "Wombat stew"})
+    assert response.status_code == 302
+    assert f'/recipe/{recipe_id}"' in search(fulltext_app, client, "wombat")
+
+    response = request(fulltext_app, client, "POST", f"/delete-recipe/{recipe_id}/0")
+    assert response.status_code == 302
+    # The title is still in the flash message, so look for the link to the recipe
+    assert f'/recipe/{recipe_id}"' not in search(fulltext_app, client, "wombat")
+
+
+def test_missing_search_table_falls_back_to_ilike(fulltext_app, migrated_user_client):
+    client = migrated_user_client
+    with fulltext_app.app_context():
+        db.session.execute(text(f"DROP TABLE {FTS_TABLE}"))
+        db.session.commit()
+    # Connections remember whether the table exists, so start with new ones
+    with fulltext_app.app_context():
+        db.engine.dispose()
+
+    response = request(fulltext_app, client, "POST", "/add-recipe", RECIPE_FORM)
+    assert response.status_code == 302
+    assert "Quokka crumble" in search(fulltext_app, client, "quokka")
+
+    recipe_id = get_own_recipe_id(fulltext_app)
+    response = request(fulltext_app, client, "POST", f"/edit-recipe/{recipe_id}/0",
+                       {**RECIPE_FORM, "title": "Wombat stew"})
+    assert response.status_code == 302
+    response = request(fulltext_app, client, "POST", f"/delete-recipe/{recipe_id}/0")
+    assert response.status_code == 302
@@ -0,0 +1,145 @@
+"""
+Checks that every route stays within the SQL query budget it declares with @query_budget.
+
+Each request is counted with count_queries() and fails the test if it runs more
+statements than its budget, or runs the same statement with different parameters
+QUERY_GUARD_REPEAT_LIMIT times, the signature of an N+1 query.
+"""
+
+import pytest
+from myrecipe.queries import QUERY_BUDGETS, count_queries
+
+RECIPE_FORM = {"title": "Test pie", "desc": "A pie for testing",
+               "ingredients": "flour and water", "instructions": "Bake it for an hour.",
+               "dietary_tags": ["vv", "gf"]}
+MODIFIED_RECIPE_FORM = {"extended_desc": "With more water", "ingredients": "flour and water",
+                        "instructions": "Bake it for an hour.", "dietary_tags": ["v"]}
+
+# Pages anyone can see: (endpoint, URL). {recipe} and {modified_recipe} are seeded IDs
+PUBLIC_PAGES = [
+    ("home", "/"),
+    ("home", "/?after=r30"),
+    ("view_recipe", "/recipe/{recipe}"),
+    ("view_modified_recipe", "/modified-recipe/{modified_recipe}"),
+    ("search", "/search?search_bar=pasta"),
+    ("search", "/search?search_bar=&dietary_tags=vv"),
+    ("search", "/search?search_bar=soup&dietary_tags=gf"),
+    ("search", "/search?search_bar="),
+    ("api_recipes", "/api/v1/recipes"),
+    ("api_recipes", "/api/v1/recipes?fields=id,title,created_by,modified_by&cursor=r30"),
+    ("api_recipes", "/api/v1/recipes?dietary_tags=vv&limit=100"),
+    ("api_recipe", "/api/v1/recipes/{recipe}"),
+    ("api_modified_recipe", "/api/v1/modified-recipes/{modified_recipe}"),
+    ("get_image", "/image-uploads/missing.png"),
+]
+
+# Pages for logged in users: (endpoint, method, URL, form data)
+USER_PAGES = [
+    ("login", "GET", "/login", None),
+    ("profile", "GET", "/profile", None),
+    ("my_recipes", "GET", "/my-recipes", None),
+    ("view_saved_recipes", "GET", "/view-saved-recipes", None),
+    ("toggle_save_recipe", "POST", "/toggle-save-recipe/{recipe}", {"saved": "true"}),
+    ("toggle_save_recipe", "POST", "/toggle-save-recipe/{recipe}", None),
+    ("add_recipe", "GET", "/add-recipe", None),
+    ("add_recipe", "POST", "/add-recipe", RECIPE_FORM),
+    ("add_modified_recipe", "GET", "/add-modified-recipe/{recipe}", None),
+    ("add_modified_recipe", "POST", "/add-modified-recipe/{recipe}", MODIFIED_RECIPE_FORM),
+    ("edit_recipe", "GET", "/edit-recipe/{own_recipe}/0", None),
+    ("edit_recipe", "POST", "/edit-recipe/{own_recipe}/0", RECIPE_FORM),
+    ("edit_recipe", "GET", "/edit-recipe/{own_modified_recipe}/1", None),
+    ("edit_recipe", "POST", "/edit-recipe/{own_modified_recipe}/1", MODIFIED_RECIPE_FORM),
+    ("delete_recipe", "POST", "/delete-recipe/{own_modified_recipe}/1", None),
+    ("delete_recipe", "POST", "/delete-recipe/{own_recipe}/0", None),
+    ("logout", "GET", "/logout", None),
+]
+
+# Pages for admins: (endpoint, method, URL)
+ADMIN_PAGES = [
+    ("cache_stats", "GET", "/cache-stats"),
+    ("export_recipes_file", "GET", "/export/recipes.jsonl"),
+    ("export_recipes_file", "GET", "/export/recipes.csv"),
+    ("delete_recipe", "POST", "/delete-recipe/{recipe}/0"),
+]
+
+# Pages for visitors who aren't logged in: (endpoint, method, URL, form data)
+ANONYMOUS_PAGES = [
+    ("login", "GET", "/login", None),
+    ("login", "POST", "/login", {"username": "bench2", "password": "bench-password"}),
+    ("login", "POST", "/login", {"username": "bench2", "password": "wrong-password"}),
+    ("register", "GET", "/register", None),
+    ("register", "POST", "/register",
+     {"username": "newcook", "password": "password1", "confirm_password": "password1"}),
+    ("register", "POST", "/register",
+     {"username": "bench3", "password": "password1", "confirm_password": "password1"}),
+]
+
+
+def request_counting_queries(app, client, method, url, data=None):
+    """Makes a request, counting the SQL statements it runs.
+
+    Streamed responses are read to the end, so their statements are counted too.
+
+    Returns:
+        tuple: The response and the QueryCounter.
+    """
+    with app.app_context(), count_queries() as counter:
+        response = client.open(url, method=method, data=data)
+        response.get_data()
+        response.close()
+    return response, counter
+
+
+def assert_within_budget(app, endpoint, response, counter):
+    """Fails if the request errored, went over its endpoint's budget or ran an N+1 query."""
+    assert response.status_code < 500, f"{endpoint} returned {response.status_code}."
+    budget = QUERY_BUDGETS[endpoint]
+    assert counter.count <= budget, (
+        f"{endpoint} ran {counter.count} SQL statements, over its budget of {budget}.")
+    repeated = counter.get_repeated(app.config["QUERY_GUARD_REPEAT_LIMIT"])
+    assert not repeated, f"{endpoint} ran a likely N+1 query: {repeated}"
+
+
+def test_every_route_has_a_budget(app):
+    endpoints = {rule.endpoint for rule in app.url_map.iter_rules()} - {"static"}
+    assert endpoints - set(QUERY_BUDGETS) == set()
+
+
+def test_every_budget_is_tested():
+    tested = {page[0] for pages in (PUBLIC_PAGES, USER_PAGES, ADMIN_PAGES, ANONYMOUS_PAGES)
+              for page in pages}
+    assert set(QUERY_BUDGETS) - tested == set()
+
+
+@pytest.mark.parametrize("endpoint, url", PUBLIC_PAGES)
+def test_public_page_for_anonymous_visitor(app, anonymous_client, recipe_ids, endpoint, url):
+    response, counter = request_counting_queries(
+        app, anonymous_client, "GET", url.format(**recipe_ids))
+    assert_within_budget(app, endpoint, response, counter)
+
+
+@pytest.mark.parametrize("endpoint, url", PUBLIC_PAGES)
+def test_public_page_for_user(app, user_client, recipe_ids, endpoint, url):
+    response, counter = request_counting_queries(
+        app, user_client, "GET", url.format(**recipe_ids))
+    assert_within_budget(app, endpoint, response, counter)
+
+
+@pytest.mark.parametrize("endpoint, method, url, data", USER_PAGES)
+def test_user_page(app, user_client, recipe_ids, endpoint, method, url, data):
+    response, counter = request_counting_queries(
+        app, user_client, method, url.format(**recipe_ids), data)
+    assert_within_budget(app, endpoint, response, counter)
+
+
+@pytest.mark.parametrize("endpoint, method, url", ADMIN_PAGES)
+def test_admin_page(app, admin_client, recipe_ids, endpoint, method, url):
+    response, counter = request_counting_queries(
+        app, admin_client, method, url.format(**recipe_ids))
+    assert_within_budget(app, endpoint, response, counter)
+
+
+@pytest.mark.parametrize("endpoint, method, url, data", ANONYMOUS_PAGES)
+def test_anonymous_page(app, anonymous_client, endpoint, method, url, data):
+    response, counter = request_counting_queries(app, anonymous_client, method, url, data)
+    assert_within_budget(app, endpoint, response, counter)